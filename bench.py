@@ -0,0 +1,972 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the Chess Game Analyzer (main.py)
+
+Usage:
+python bench.py <benchmark> [options]
+
+Benchmarks:
+infoparser    uci info line parsing, python-chess and uci_info_from_dict()
+              vs the old substring and list.index parsing of analyze_fen()
+              --log <recorded engine output, one line per engine line, a
+                     'position fen <fen>' line before the lines of a search>
+              --engine <uci engine filename, used to record a log if
+                        --log is not given>
+              --movetime <time in ms per position when recording, default: 200>
+              --savelog <filename to save the recorded log>
+              --repeat <number of passes over the log, default: 20>
+book          polyglot book probing, PolyglotBook vs opening the book
+              and searching it for every position
+              --book <polyglot book filename>
+              --pgn <games to probe, default: game.pgn>
+              --repeat <number of passes over the games, default: 5>
+sanpv         uci pv to san pv conversion, ucipv_to_sanpv() vs the old
+              push, pop and san conversion with float move numbers
+              --pgn <games whose next moves are used as pvs, default: game.pgn>
+              --plies <pv length, default: 7>
+              --repeat <number of passes over the pvs, default: 20>
+positions     board access per ply of annotate_game(), game_positions() on one
+              board vs game_node.board() that replays the game on every call
+              --plies <comma separated game lengths, default: 50,100,200,400>
+              --repeat <number of passes, default: 3>
+pgnread       reading games, MainlineVisitor vs chess.pgn.read_game() that
+              builds the whole game tree, on an annotated corpus
+              --pgn <annotated pgn, default: game.pgn with a comment, a nag
+                     and a variation added to every move>
+              --copies <copies of the default corpus, default: 200>
+              --repeat <number of passes, default: 3>
+ingest        pgn ingestion in MB/s, the memory-mapped MmapPgn whose games are
+              found with the offset index vs the open_pgn() text stream and vs
+              open().read() into a StringIO, for reading the games and for
+              reading them with a --player filter that matches no game
+              --pgn <uncompressed pgn, default: the pgnread corpus>
+              --copies <copies of the default corpus, default: 200>
+              --repeat <number of passes, default: 3>
+annotate      annotation throughput of analyze_games() on pgn fixtures,
+              every fixture is run in a new process
+              --pgn <fixture pgn filename, can be repeated, default: game.pgn>
+              --copies <games of a fixture are repeated to make a larger
+                        corpus, default: 1>
+              --engine <uci engine filename, default: app/stockfish_10_x64>
+              --movetime <time in ms per position, default: 100>
+              --jobs <games analyzed in parallel, default: 1>
+              --plyjobs <positions of a game analyzed in parallel, default: 1>
+              --json <filename to save the results>
+              --compare <results json of a previous run to compare with>
+"""
+
+
+from __future__ import print_function
+import sys
+import getopt
+import subprocess
+import time
+import os
+import json
+import resource
+import tempfile
+import contextlib
+import platform
+import random
+import io
+import tracemalloc
+import chess
+import chess.pgn
+import chess.polyglot
+import chess.engine
+import main
+
+
+BENCH_PGN = 'game.pgn'
+BENCH_ENGINE = 'app/stockfish_10_x64'
+
+
+def usage():
+    """ Print the module docstring """
+    print(__doc__)
+
+
+def game_fens(pgn_file=BENCH_PGN):
+    """ Returns the fen of every position in the main line of the games """
+    return [board.fen() for board, move in game_positions(pgn_file)]
+
+
+def game_positions(pgn_file=BENCH_PGN):
+    """ Returns (board, move) of every position in the main line of the games """
+    positions = []
+    with main.open_pgn(pgn_file) as ifo:
+        for game in main.read_games(ifo):
+            board = game.board()
+            for move in game.mainline_moves():
+                positions.append((board.copy(stack=False), move))
+                board.push(move)
+    return positions
+
+
+def record_engine_log(engineName, fens, movetimev, multipvv=2):
+    """ Search every fen and returns all the engine output lines """
+    log_lines = []
+    p = subprocess.Popen(engineName, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         universal_newlines=True, bufsize=1)
+
+    def send(command):
+        p.stdin.write(command + '\n')
+        p.stdin.flush()
+
+    def read_until(token):
+        while True:
+            line = p.stdout.readline().strip()
+            if line.startswith(token):
+                return line
+            log_lines.append(line)
+
+    try:
+        send('uci')
+        read_until('uciok')
+        del log_lines[:]
+        send('setoption name MultiPV value %d' % multipvv)
+        for fen in fens:
+            send('ucinewgame')
+            send('position fen ' + fen)
+            log_lines.append('position fen ' + fen)
+            send('go movetime %d' % movetimev)
+            log_lines.append(read_until('bestmove'))
+    finally:
+        send('quit')
+        p.wait()
+    return log_lines
+
+
+def legacy_parse_line(engine_output):
+    """ The info line parsing of analyze_fen() before the engines ran on
+        python-chess, returns [depth, multipv, time, score, pv] or None
+    """
+    if "depth" in engine_output\
+                and ("score cp" in engine_output)\
+                or ("score mate" in engine_output)\
+                and "time" in engine_output\
+                and "pv" in engine_output\
+                and not "upperbound" in engine_output\
+                and not "lowerbound" in engine_output:
+        b = engine_output.split(' ')
+
+        i = b.index("depth")
+        depthv = int(b[i+1])
+
+        if "multipv" in engine_output:
+            i = b.index("multipv")
+            multipvv = int(b[i+1])
+        else:
+            multipvv = 1
+
+        i = b.index("time")
+        timev = int(b[i+1])
+
+        if "mate" in engine_output:
+            i = b.index("score")
+            d2m = int(b[i+2])
+            scorev = main.mate_distance_to_value(d2m)
+        else:
+            i = b.index("score")
+            scorev = int(b[i+2])
+
+        i = b.index("pv")
+        pvv = ' '.join(b[i+1:]).strip()
+        return [depthv, multipvv, timev, scorev, pvv]
+    return None
+
+
+def python_chess_parser():
+    """ Returns the info line parsing of analyze_fen(), python-chess's uci
+        info parsing and uci_info_from_dict(). The pv is parsed on the
+        position of the last 'position fen' line of the log.
+    """
+    boards = [chess.Board()]
+
+    def parse_line(engine_output):
+        if engine_output.startswith('position fen '):
+            boards[0] = chess.Board(engine_output[len('position fen '):])
+            return None
+        if not engine_output.startswith('info '):
+            return None
+        info = main.uci_info_from_dict(chess.engine._parse_uci_info(engine_output[5:], boards[0]))
+        if info.depth is not None and info.has_score()\
+                    and info.time is not None and info.pv and info.bound is None:
+            multipvv = info.multipv if info.multipv is not None else 1
+            return [info.depth, multipvv, info.time, info.value(), info.pv]
+        return None
+
+    return parse_line
+
+
+def time_parser(parse_line, log_lines, repeat):
+    """ Returns (seconds of the fastest pass, accepted lines) of parsing
+        the log repeat times
+    """
+    best_time = None
+    for _ in range(repeat):
+        accepted = 0
+        t0 = time.perf_counter()
+        for line in log_lines:
+            if parse_line(line) is not None:
+                accepted += 1
+        pass_time = time.perf_counter() - t0
+        if best_time is None or pass_time < best_time:
+            best_time = pass_time
+    return best_time, accepted
+
+
+def bench_info_parser(log_lines, repeat=20):
+    """ Compare the old and the new info line parsing on an engine log """
+    legacy_time, legacy_accepted = time_parser(legacy_parse_line, log_lines, repeat)
+    new_time, new_accepted = time_parser(python_chess_parser(), log_lines, repeat)
+    num_lines = len(log_lines)
+    return {'lines': len(log_lines),
+            'repeat': repeat,
+            'legacy_lines_per_sec': num_lines/legacy_time,
+            'new_lines_per_sec': num_lines/new_time,
+            'speedup': legacy_time/new_time,
+            'legacy_accepted': legacy_accepted,
+            'new_accepted': new_accepted}
+
+
+def run_info_parser(argv):
+    """ infoparser benchmark command """
+    log_fn = None
+    engineName = None
+    save_fn = None
+    movetimev = 200
+    repeat = 20
+    opts, args = getopt.getopt(argv, '', ['log=', 'engine=', 'movetime=',
+                                          'savelog=', 'repeat='])
+    for opt, arg in opts:
+        if opt == '--log':
+            log_fn = arg
+        elif opt == '--engine':
+            engineName = arg
+        elif opt == '--movetime':
+            movetimev = int(arg)
+        elif opt == '--savelog':
+            save_fn = arg
+        elif opt == '--repeat':
+            repeat = int(arg)
+
+    if log_fn is not None:
+        with open(log_fn) as f:
+            log_lines = [line.strip() for line in f]
+    elif engineName is not None:
+        log_lines = record_engine_log(engineName, game_fens(), movetimev)
+        if save_fn is not None:
+            with open(save_fn, 'w') as f:
+                f.write('\n'.join(log_lines) + '\n')
+    else:
+        usage()
+        sys.exit(1)
+
+    res = bench_info_parser(log_lines, repeat)
+    print('Engine log lines: %d, passes: %d' %(res['lines'], res['repeat']))
+    print('Old parsing: %0.0f lines/s, %d lines accepted'
+          %(res['legacy_lines_per_sec'], res['legacy_accepted']))
+    print('python-chess and uci_info_from_dict: %0.0f lines/s, %d lines accepted'
+          %(res['new_lines_per_sec'], res['new_accepted']))
+    print('Speedup: %0.2fx' % res['speedup'])
+    return res
+
+
+def legacy_ucipv_to_sanpv(fen, pv):
+    """ The old ucipv_to_sanpv(), pushes the pv and pops it to get the san """
+    board = chess.Board(fen)
+    side = board.turn
+    # Store uci pv in a list and update the board
+    # then we pop and save the move in san
+    a = pv.split(' ')
+    for m in a:
+        try:
+            board.push_uci(m)
+        except ValueError:
+            print('Illegal move')
+    # Pop the moves, and save it in SAN
+    pvSan = []
+    for i in range(len(a)):
+        san = board.san(board.pop())
+        pvSan.append(san)
+    # Reverse it
+    pvSan = list(reversed(pvSan))
+    newPv = ' '.join(pvSan[0:])
+    # We put number to our pv 1. e4 e5 2. Nf3 ...
+    fmvn = fen.split(' ')
+    fmvn = fmvn[-1]
+    fmvn = int(fmvn)
+
+    numPv = []
+    newPvList = newPv.split(' ')
+    if side == main.WHITE:
+        for i, m in enumerate(newPvList):
+            if i == 0 or i%2 == 0:  # Even
+                c = fmvn + i/2
+                b = str(c) + '.' + m
+                numPv.append(b)
+            else:
+                b = m
+                numPv.append(b)
+    # else if side is black
+    else:
+        for i, m in enumerate(newPvList):
+            if i == 0:
+                c = fmvn
+                b = str(c) + '...' + m
+                numPv.append(b)
+            else:
+                if i%2 != 0:  # Even
+                    c = fmvn + i/2 + 1
+                    b = str(c) + '.' + m
+                    numPv.append(b)
+                else:
+                    b = m
+                    numPv.append(b)
+
+    numPv = ' '.join(numPv[0:])
+    return numPv
+
+
+def normalized_legacy_pv(san_pv):
+    """ Returns the old san pv with the move numbers as integers,
+        the old function printed 29.0.Rxf2 and 29.5.Rf1
+    """
+    tokens = []
+    for token in san_pv.split(' '):
+        number, dots, move = token.rpartition('.')
+        if not dots:
+            tokens.append(token)
+        elif number.endswith('..'):
+            tokens.append('%d...%s' %(int(float(number.rstrip('.'))), move))
+        else:
+            tokens.append('%d.%s' %(int(float(number)), move))
+    return ' '.join(tokens)
+
+
+def game_pvs(pgn_file=BENCH_PGN, plies=7):
+    """ Returns (board, uci pv) of every position of the games, the pv
+        is the next plies moves of the game
+    """
+    pvs = []
+    with main.open_pgn(pgn_file) as ifo:
+        for game in main.read_games(ifo):
+            moves = list(game.mainline_moves())
+            board = game.board()
+            for i, move in enumerate(moves):
+                pvs.append((board.copy(stack=False),
+                            ' '.join(m.uci() for m in moves[i:i+plies])))
+                board.push(move)
+    return pvs
+
+
+def bench_sanpv(pvs, repeat=20):
+    """ Compare the old and the new uci to san pv conversion """
+    fens = [board.fen() for board, pv in pvs]
+    mismatches = 0
+    for fen, (board, pv) in zip(fens, pvs):
+        if normalized_legacy_pv(legacy_ucipv_to_sanpv(fen, pv)) != main.ucipv_to_sanpv(board, pv):
+            mismatches += 1
+
+    legacy_time = None
+    new_time = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for fen, (board, pv) in zip(fens, pvs):
+            legacy_ucipv_to_sanpv(fen, pv)
+        t1 = time.perf_counter()
+        # The new function gets the board that analyze_fen() makes
+        for fen, (board, pv) in zip(fens, pvs):
+            main.ucipv_to_sanpv(chess.Board(fen), pv)
+        t2 = time.perf_counter()
+        legacy_time = t1 - t0 if legacy_time is None else min(legacy_time, t1 - t0)
+        new_time = t2 - t1 if new_time is None else min(new_time, t2 - t1)
+    return {'pvs': len(pvs),
+            'repeat': repeat,
+            'legacy_pvs_per_sec': len(pvs)/legacy_time,
+            'new_pvs_per_sec': len(pvs)/new_time,
+            'speedup': legacy_time/new_time,
+            'mismatches': mismatches}
+
+
+def run_sanpv(argv):
+    """ sanpv benchmark command """
+    pgn_file = BENCH_PGN
+    plies = 7
+    repeat = 20
+    opts, args = getopt.getopt(argv, '', ['pgn=', 'plies=', 'repeat='])
+    for opt, arg in opts:
+        if opt == '--pgn':
+            pgn_file = arg
+        elif opt == '--plies':
+            plies = int(arg)
+        elif opt == '--repeat':
+            repeat = int(arg)
+
+    res = bench_sanpv(game_pvs(pgn_file, plies), repeat)
+    print('Pvs: %d, plies: %d, passes: %d' %(res['pvs'], plies, res['repeat']))
+    print('Old push, pop and san: %0.0f pvs/s' % res['legacy_pvs_per_sec'])
+    print('ucipv_to_sanpv: %0.0f pvs/s' % res['new_pvs_per_sec'])
+    print('Speedup: %0.2fx, mismatches: %d' %(res['speedup'], res['mismatches']))
+    return res
+
+
+def legacy_book_probe(book_fn, board, uci_game_move):
+    """ The book probing of annotate_ply() before PolyglotBook,
+        returns (best book move, game move is in book)
+    """
+    bestPolyBookMove = None
+    moveIsInPolyglotBook = False
+    ployBookCnt = 0
+    with chess.polyglot.open_reader(book_fn) as reader:
+        for entry in reader.find_all(board):
+            ployBookCnt += 1
+            book_move = str(entry.move)
+            if ployBookCnt == 1:
+                bestPolyBookMove = book_move
+            if book_move == uci_game_move:
+                moveIsInPolyglotBook = True
+                break
+    return bestPolyBookMove, moveIsInPolyglotBook
+
+
+def bench_book(book_fn, positions, repeat=5):
+    """ Compare the old and the new book probing on the positions,
+        every pass is like another run over games with the same openings.
+        The results of both must be the same.
+    """
+    probes = [(board, move.uci()) for board, move in positions]
+
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        legacy_res = [legacy_book_probe(book_fn, board, uci_move) for board, uci_move in probes]
+    legacy_time = time.perf_counter() - t0
+
+    # The book is opened once for the run, like analyze_games() does
+    t0 = time.perf_counter()
+    book = main.PolyglotBook(book_fn)
+    for _ in range(repeat):
+        new_res = []
+        for board, uci_move in probes:
+            book_moves = book.book_moves(board)
+            new_res.append((book_moves[0] if book_moves else None, uci_move in book_moves))
+    book.close()
+    new_time = time.perf_counter() - t0
+
+    num_probes = len(probes) * repeat
+    return {'positions': len(probes),
+            'repeat': repeat,
+            'in_book': sum(1 for n in new_res if n[1]),
+            'legacy_probes_per_sec': num_probes/legacy_time,
+            'new_probes_per_sec': num_probes/new_time,
+            'speedup': legacy_time/new_time,
+            'mismatches': sum(1 for a, b in zip(legacy_res, new_res) if a != b)}
+
+
+def run_book(argv):
+    """ book benchmark command """
+    book_fn = None
+    pgn_file = BENCH_PGN
+    repeat = 5
+    opts, args = getopt.getopt(argv, '', ['book=', 'pgn=', 'repeat='])
+    for opt, arg in opts:
+        if opt == '--book':
+            book_fn = arg
+        elif opt == '--pgn':
+            pgn_file = arg
+        elif opt == '--repeat':
+            repeat = int(arg)
+
+    if book_fn is None:
+        usage()
+        sys.exit(1)
+
+    res = bench_book(book_fn, game_positions(pgn_file), repeat)
+    print('Positions: %d, in book: %d, passes: %d'
+          %(res['positions'], res['in_book'], res['repeat']))
+    print('Open and search per position: %0.0f probes/s' % res['legacy_probes_per_sec'])
+    print('PolyglotBook: %0.0f probes/s' % res['new_probes_per_sec'])
+    print('Speedup: %0.2fx, mismatches: %d' %(res['speedup'], res['mismatches']))
+    return res
+
+
+def random_game(num_plies, seed=1):
+    """ Returns a game of up to num_plies random legal moves """
+    rnd = random.Random(seed)
+    game = chess.pgn.Game()
+    node = game
+    board = game.board()
+    # Draw rules do not end the game, only mate and stalemate
+    while board.ply() < num_plies:
+        moves = list(board.legal_moves)
+        if not moves:
+            break
+        move = rnd.choice(moves)
+        node = node.add_variation(move)
+        board.push(move)
+    return game
+
+
+def legacy_ply_access(game):
+    """ The board access of the old annotate_game(), game_node.board()
+        replays the game from the start on every call
+    """
+    fmvn = 0
+    node = game
+    while len(node.variations):
+        fmvn = node.board().fullmove_number
+        node = node.variation(0)
+    node = game
+    while len(node.variations):
+        move = node.variation(0).move
+        node.board().turn
+        node.board().fullmove_number
+        san = node.board().san(move)
+        node.board().fen()
+        node.board().epd(bm=san)
+        node.board().push(move)
+        node.board().is_checkmate()
+        node.board().is_stalemate()
+        node.board().is_check()
+        if node.parent is not None:
+            node.parent.board()
+        node.board().san(move)
+        node = node.variation(0)
+    return fmvn
+
+
+def new_ply_access(game):
+    """ The same board access with main.game_positions() """
+    positions = main.game_positions(game)
+    fmvn = positions[-1].fullmove_number if positions else 0
+    for position in positions:
+        position.turn
+        position.fullmove_number
+        position.san
+        position.fen
+        board = position.board.copy(stack=False)
+        board.push(position.move)
+        position.board.is_checkmate()
+        position.board.is_stalemate()
+        position.board.is_check()
+        if position.parent is not None:
+            position.parent.board
+    return fmvn
+
+
+def bench_positions(lengths, repeat=3):
+    """ Returns the microseconds per ply of the old and new board access
+        on random games of every length
+    """
+    results = []
+    for num_plies in lengths:
+        # Random games can end in a mate, use the first seed that reaches the length
+        for seed in range(1, 100):
+            game = random_game(num_plies, seed)
+            plies = len(list(game.mainline_moves()))
+            if plies == num_plies:
+                break
+        times = {}
+        for name, access in (('legacy', legacy_ply_access), ('new', new_ply_access)):
+            best_time = None
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                access(game)
+                pass_time = time.perf_counter() - t0
+                if best_time is None or pass_time < best_time:
+                    best_time = pass_time
+            times[name] = best_time
+        results.append({'plies': plies,
+                        'legacy_us_per_ply': 1e6*times['legacy']/plies,
+                        'new_us_per_ply': 1e6*times['new']/plies,
+                        'speedup': times['legacy']/times['new']})
+    return results
+
+
+def run_positions(argv):
+    """ positions benchmark command """
+    lengths = [50, 100, 200, 400]
+    repeat = 3
+    opts, args = getopt.getopt(argv, '', ['plies=', 'repeat='])
+    for opt, arg in opts:
+        if opt == '--plies':
+            lengths = [int(n) for n in arg.split(',')]
+        elif opt == '--repeat':
+            repeat = int(arg)
+
+    res = bench_positions(lengths, repeat)
+    print('%6s %16s %16s %8s' %('plies', 'replay us/ply', 'one board us/ply', 'speedup'))
+    for n in res:
+        print('%6d %16.1f %16.1f %7.1fx' %(n['plies'], n['legacy_us_per_ply'],
+                                           n['new_us_per_ply'], n['speedup']))
+    return res
+
+
+def annotate_with_noise(game, rnd, plies=6):
+    """ Add a comment, a NAG and a variation of random moves to every
+        move of the main line, like an engine annotated database
+    """
+    for node in list(game.mainline()):
+        node.comment = '%+0.2f/%d' %(rnd.uniform(-2, 2), rnd.randint(10, 30))
+        node.nags.add(rnd.choice([1, 2, 6]))
+        board = node.parent.board()
+        others = [m for m in board.legal_moves if m != node.move]
+        if not others:
+            continue
+        var_node = node.parent.add_variation(rnd.choice(others))
+        var_node.comment = 'Also playable'
+        board.push(var_node.move)
+        for _ in range(plies - 1):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            var_node = var_node.add_variation(rnd.choice(moves))
+            board.push(var_node.move)
+        var_node.comment = '%+0.2f/%d' %(rnd.uniform(-2, 2), rnd.randint(10, 30))
+
+
+def annotated_corpus(pgn_file, copies):
+    """ Returns the text of the games of pgn_file with comments and
+        variations, repeated copies times
+    """
+    rnd = random.Random(1)
+    texts = []
+    with main.open_pgn(pgn_file) as ifo:
+        games = list(iter(lambda: chess.pgn.read_game(ifo), None))
+    for _ in range(copies):
+        for game in games:
+            annotate_with_noise(game, rnd)
+            texts.append(str(game))
+            for node in list(game.mainline()):
+                del node.parent.variations[1:]
+    return '\n\n'.join(texts) + '\n'
+
+
+def read_all(text, Visitor):
+    """ Returns the games of the pgn text read with the visitor """
+    ifo = io.StringIO(text)
+    return list(iter(lambda: chess.pgn.read_game(ifo, Visitor=Visitor), None))
+
+
+def bench_pgn_read(text, repeat=3):
+    """ Compare chess.pgn.read_game() with the MainlineVisitor on a pgn text """
+    times = {}
+    peaks = {}
+    games = {}
+    for name, Visitor in (('read_game', chess.pgn.GameBuilder),
+                          ('mainline', main.MainlineVisitor)):
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            games[name] = read_all(text, Visitor)
+            pass_time = time.perf_counter() - t0
+            times[name] = min(times.get(name, pass_time), pass_time)
+        del games[name]
+        tracemalloc.start()
+        games[name] = read_all(text, Visitor)
+        peaks[name] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    mismatches = 0
+    for game, mainline_game in zip(games['read_game'], games['mainline']):
+        if list(game.mainline_moves()) != mainline_game.moves\
+                or dict(game.headers) != dict(mainline_game.headers):
+            mismatches += 1
+    num_games = len(games['read_game'])
+    return {'games': num_games,
+            'megabytes': len(text.encode('utf-8'))/1e6,
+            'read_game_games_per_sec': num_games/times['read_game'],
+            'mainline_games_per_sec': num_games/times['mainline'],
+            'speedup': times['read_game']/times['mainline'],
+            'read_game_peak_mb': peaks['read_game']/1e6,
+            'mainline_peak_mb': peaks['mainline']/1e6,
+            'mismatches': mismatches}
+
+
+def run_pgn_read(argv):
+    """ pgnread benchmark command """
+    pgn_file = None
+    copies = 200
+    repeat = 3
+    opts, args = getopt.getopt(argv, '', ['pgn=', 'copies=', 'repeat='])
+    for opt, arg in opts:
+        if opt == '--pgn':
+            pgn_file = arg
+        elif opt == '--copies':
+            copies = int(arg)
+        elif opt == '--repeat':
+            repeat = int(arg)
+
+    if pgn_file is not None:
+        with main.open_pgn(pgn_file) as ifo:
+            text = ifo.read()
+    else:
+        text = annotated_corpus(BENCH_PGN, copies)
+    res = bench_pgn_read(text, repeat)
+    print('Games: %d, %0.1f MB' %(res['games'], res['megabytes']))
+    print('read_game: %0.1f games/s, peak %0.1f MB'
+          %(res['read_game_games_per_sec'], res['read_game_peak_mb']))
+    print('MainlineVisitor: %0.1f games/s, peak %0.1f MB'
+          %(res['mainline_games_per_sec'], res['mainline_peak_mb']))
+    print('Speedup: %0.2fx, mismatches: %d' %(res['speedup'], res['mismatches']))
+    return res
+
+
+def ingest_stream(pgn_file, gameFilter):
+    """ Returns the games of the pgn file read from the text stream """
+    with main.open_pgn(pgn_file) as ifo:
+        return list(main.numbered_games(ifo, gameFilter))
+
+
+def ingest_read_all(pgn_file, gameFilter):
+    """ Returns the games of the pgn file read into a StringIO """
+    with open(pgn_file, encoding='utf-8', errors='replace') as f:
+        ifo = io.StringIO(f.read())
+    return list(main.numbered_games(ifo, gameFilter))
+
+
+def ingest_mmap(pgn_file, gameFilter, index_fn):
+    """ Returns the games of the memory-mapped pgn file """
+    index = main.OffsetIndex(index_fn, pgn_file)
+    pgn_map = main.MmapPgn(pgn_file)
+    try:
+        return list(main.mmap_games(pgn_map, index, gameFilter))
+    finally:
+        pgn_map.close()
+        index.close()
+
+
+def bench_ingest(pgn_file, repeat=3):
+    """ Compare the MB/s of the ingestion paths on an uncompressed pgn file,
+        the mmap path uses an offset index that is built once
+    """
+    megabytes = os.path.getsize(pgn_file)/1e6
+    no_game = main.GameFilter(player='\x00')
+    res = {'megabytes': megabytes}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index_fn = os.path.join(tmp_dir, 'corpus.offsets')
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0 = time.perf_counter()
+            main.OffsetIndex(index_fn, pgn_file).close()
+            res['index_mb_per_sec'] = megabytes/(time.perf_counter() - t0)
+        runs = (('read', 'read_all', ingest_read_all, ()),
+                ('read', 'stream', ingest_stream, ()),
+                ('read', 'mmap', ingest_mmap, (index_fn,)),
+                ('filter', 'read_all', ingest_read_all, ()),
+                ('filter', 'stream', ingest_stream, ()),
+                ('filter', 'mmap', ingest_mmap, (index_fn,)))
+        for task, path, fn, args in runs:
+            gameFilter = no_game if task == 'filter' else None
+            best = None
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                results[(task, path)] = fn(pgn_file, gameFilter, *args)
+                pass_time = time.perf_counter() - t0
+                best = pass_time if best is None else min(best, pass_time)
+            res['%s_%s_mb_per_sec' %(task, path)] = megabytes/best
+
+    def key(games):
+        return [(n, game.moves, dict(game.headers)) for n, game in games]
+    res['games'] = len(results[('read', 'stream')])
+    res['mismatches'] = int(key(results[('read', 'stream')]) != key(results[('read', 'mmap')]))\
+        + int(key(results[('read', 'read_all')]) != key(results[('read', 'mmap')]))
+    return res
+
+
+def run_ingest(argv):
+    """ ingest benchmark command """
+    pgn_file = None
+    copies = 200
+    repeat = 3
+    opts, args = getopt.getopt(argv, '', ['pgn=', 'copies=', 'repeat='])
+    for opt, arg in opts:
+        if opt == '--pgn':
+            pgn_file = arg
+        elif opt == '--copies':
+            copies = int(arg)
+        elif opt == '--repeat':
+            repeat = int(arg)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if pgn_file is None:
+            pgn_file = os.path.join(tmp_dir, 'corpus.pgn')
+            with open(pgn_file, 'w', encoding='utf-8') as f:
+                f.write(annotated_corpus(BENCH_PGN, copies))
+        res = bench_ingest(pgn_file, repeat)
+    print('Games: %d, %0.1f MB' %(res['games'], res['megabytes']))
+    print('Offset index build: %0.1f MB/s' % res['index_mb_per_sec'])
+    print('%-8s %10s %10s %10s' %('MB/s', 'read_all', 'stream', 'mmap'))
+    for task in ('read', 'filter'):
+        print('%-8s %10.1f %10.1f %10.1f'
+              %(task, res['%s_read_all_mb_per_sec' % task],
+                res['%s_stream_mb_per_sec' % task], res['%s_mmap_mb_per_sec' % task]))
+    print('Mismatches: %d' % res['mismatches'])
+    return res
+
+
+def fixture_corpus(pgn_file, copies, f):
+    """ Write the games of pgn_file copies times to the file f,
+        returns (number of games, number of plies) written
+    """
+    num_games = 0
+    num_plies = 0
+    with main.open_pgn(pgn_file) as ifo:
+        text = ifo.read()
+    with main.open_pgn(pgn_file) as ifo:
+        for game in main.read_games(ifo):
+            num_games += 1
+            num_plies += len(list(game.mainline_moves()))
+    for _ in range(copies):
+        f.write(text.rstrip() + '\n\n')
+    return num_games*copies, num_plies*copies
+
+
+def measure_annotate(pgn_file, engineName, movetimev, copies=1, nJobs=1, nPlyJobs=1):
+    """ Run analyze_games() on a fixture and returns its throughput,
+        should be called in a new process for the rusage numbers
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        corpus_fn = os.path.join(tmp_dir, 'corpus.pgn')
+        with open(corpus_fn, 'w') as f:
+            num_games, num_plies = fixture_corpus(pgn_file, copies, f)
+        argv = ['--file', corpus_fn, '--engine', engineName,
+                '--movetime', str(movetimev), '--jobs', str(nJobs),
+                '--plyjobs', str(nPlyJobs),
+                '--outfile', os.path.join(tmp_dir, 'out.pgn')]
+
+        usage_start = resource.getrusage(resource.RUSAGE_SELF)
+        t0 = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            main.analyze_games(argv)
+        wall_time = time.perf_counter() - t0
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    stats = main.METRICS.summary()['run']
+    engine_time = stats['seconds'].get('search', 0.0) + stats['seconds'].get('info_parse', 0.0)
+    python_cpu = (usage.ru_utime - usage_start.ru_utime) + (usage.ru_stime - usage_start.ru_stime)
+    return {'fixture': pgn_file,
+            'copies': copies,
+            'games': num_games,
+            'positions': num_plies,
+            'movetime': movetimev,
+            'jobs': nJobs,
+            'plyjobs': nPlyJobs,
+            'wall_seconds': wall_time,
+            'positions_per_sec': num_plies/wall_time,
+            'engine_seconds': engine_time,
+            'python_overhead_seconds': max(0.0, wall_time - engine_time/(nJobs*nPlyJobs)),
+            'python_cpu_seconds': python_cpu,
+            'engine_cpu_seconds': children.ru_utime + children.ru_stime,
+            'engine_searches': stats['counts'].get('search', 0),
+            'engine_spawns': stats['counts'].get('spawn', 0),
+            'stage_seconds': stats['seconds'],
+            'peak_rss_kb': usage.ru_maxrss,
+            'engine_peak_rss_kb': children.ru_maxrss}
+
+
+def run_annotate_worker(argv):
+    """ Measure one fixture and print the result as json, used by
+        the annotate benchmark
+    """
+    args = json.loads(argv[0])
+    res = measure_annotate(**args)
+    print(json.dumps(res))
+
+
+def compare_results(old_res, new_res):
+    """ Print the throughput change of the fixtures in both results """
+    old_runs = dict(((n['fixture'], n['copies']), n) for n in old_res['runs'])
+    for n in new_res['runs']:
+        o = old_runs.get((n['fixture'], n['copies']))
+        if o is None:
+            continue
+        print('%s x%d: %0.2f -> %0.2f positions/s (%+0.1f%%)'
+              %(n['fixture'], n['copies'], o['positions_per_sec'], n['positions_per_sec'],
+                100.0*(n['positions_per_sec']/o['positions_per_sec'] - 1)))
+
+
+def run_annotate(argv):
+    """ annotate benchmark command """
+    pgn_files = []
+    copies = 1
+    engineName = BENCH_ENGINE
+    movetimev = 100
+    nJobs = 1
+    nPlyJobs = 1
+    json_fn = None
+    compare_fn = None
+    opts, args = getopt.getopt(argv, '', ['pgn=', 'copies=', 'engine=', 'movetime=',
+                                          'jobs=', 'plyjobs=', 'json=', 'compare='])
+    for opt, arg in opts:
+        if opt == '--pgn':
+            pgn_files.append(arg)
+        elif opt == '--copies':
+            copies = int(arg)
+        elif opt == '--engine':
+            engineName = arg
+        elif opt == '--movetime':
+            movetimev = int(arg)
+        elif opt == '--jobs':
+            nJobs = int(arg)
+        elif opt == '--plyjobs':
+            nPlyJobs = int(arg)
+        elif opt == '--json':
+            json_fn = arg
+        elif opt == '--compare':
+            compare_fn = arg
+    if not pgn_files:
+        pgn_files = [BENCH_PGN]
+
+    res = {'python': platform.python_version(),
+           'chess': chess.__version__,
+           'engine': engineName,
+           'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+           'runs': []}
+    for pgn_file in pgn_files:
+        args = {'pgn_file': pgn_file, 'engineName': engineName, 'movetimev': movetimev,
+                'copies': copies, 'nJobs': nJobs, 'nPlyJobs': nPlyJobs}
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                       'annotate-worker', json.dumps(args)],
+                                      universal_newlines=True)
+        run = json.loads(out.strip().splitlines()[-1])
+        res['runs'].append(run)
+        print('%s x%d: %d games, %d positions in %0.1fs, %0.2f positions/s'
+              %(pgn_file, copies, run['games'], run['positions'], run['wall_seconds'],
+                run['positions_per_sec']))
+        print('  engine %0.1fs, python overhead %0.1fs (python cpu %0.1fs), '
+              '%d searches, %d spawns, peak rss %d kB, engine peak rss %d kB'
+              %(run['engine_seconds'], run['python_overhead_seconds'],
+                run['python_cpu_seconds'], run['engine_searches'], run['engine_spawns'],
+                run['peak_rss_kb'], run['engine_peak_rss_kb']))
+
+    if json_fn is not None:
+        with open(json_fn, 'w') as f:
+            json.dump(res, f, indent=2)
+    if compare_fn is not None:
+        with open(compare_fn) as f:
+            compare_results(json.load(f), res)
+    return res
+
+
+BENCHMARKS = {'infoparser': run_info_parser,
+              'book': run_book,
+              'sanpv': run_sanpv,
+              'positions': run_positions,
+              'pgnread': run_pgn_read,
+              'ingest': run_ingest,
+              'annotate': run_annotate,
+              'annotate-worker': run_annotate_worker}
+
+
+def bench_main(argv):
+    """ start """
+    if not argv or argv[0] not in BENCHMARKS:
+        usage()
+        sys.exit(2)
+    BENCHMARKS[argv[0]](argv[1:])
+
+
+if __name__ == "__main__":
+    bench_main(sys.argv[1:])
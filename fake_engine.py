@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""
+A deterministic stand-in uci engine for the Chess Game Analyzer (main.py)
+
+It replays recorded engine output of a transcript, the info lines and the
+bestmove of every searched position are keyed by fen and multipv.
+Positions that are not in the transcript get a deterministic made up
+search, so every run of the annotator gives the same output.
+
+Usage:
+python fake_engine.py [options]
+python fake_engine.py --record <transcript> <uci engine command>
+
+Options:
+--transcript <jsonl transcript of recorded searches>
+--speed <replay speed, 1 is the recorded time, 10 is 10x faster,
+         default: 0, no waiting>
+--depth <depth of the made up searches, default: 12>
+--record <transcript> <engine>  Run the engine and record its searches to
+                                the transcript, the annotator can use it
+                                as its engine to make a transcript
+
+Example:
+python main.py -f game.pgn --engine "python fake_engine.py --record t.jsonl app/stockfish_10_x64"
+python main.py -f game.pgn --engine "python fake_engine.py --transcript t.jsonl"
+
+A transcript line is,
+{"fen": "<fen>", "multipv": 2, "lines": ["info depth 1 ...", ...],
+ "bestmove": "bestmove e2e4 ponder e7e5"}
+
+The search ends with the bestmove after the info lines even when the search
+is go infinite, a search can be stopped early with stop.
+"""
+
+
+from __future__ import print_function
+import sys
+import os
+import json
+import time
+import zlib
+import shlex
+import getopt
+import threading
+import subprocess
+import chess
+
+
+ENGINE_NAME = 'FakeEngine'
+FALLBACK_DEPTH = 12
+OUTPUT_LOCK = threading.Lock()
+PIECE_VALUES = {chess.PAWN: 100, chess.KNIGHT: 300, chess.BISHOP: 300,
+                chess.ROOK: 500, chess.QUEEN: 900, chess.KING: 0}
+
+
+def usage():
+    """ Print the module docstring """
+    print(__doc__)
+
+
+def fen_key(fen):
+    """ Returns the fen without the move counters """
+    return ' '.join(fen.split()[:4])
+
+
+def stable_hash(text):
+    """ Returns a hash of text that is the same in every run """
+    return zlib.crc32(text.encode('utf-8'))
+
+
+class Transcript(object):
+    """ Recorded searches keyed by fen and multipv """
+
+    def __init__(self, filename=None):
+        self.searches = {}
+        if filename is not None:
+            with open(filename) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        self.add(json.loads(line))
+
+    def add(self, record):
+        """ Add a recorded search, a later search of a position replaces
+            the earlier one
+        """
+        key = (fen_key(record['fen']), record.get('multipv', 1))
+        self.searches[key] = (record['lines'], record['bestmove'])
+
+    def lookup(self, fen, multipvv):
+        """ Returns (info lines, bestmove line) of a position or None """
+        return self.searches.get((fen_key(fen), multipvv))
+
+    def __len__(self):
+        return len(self.searches)
+
+
+def material(board, color):
+    """ Returns the material of color minus the material of the opponent """
+    value = 0
+    for piece_type, piece_value in PIECE_VALUES.items():
+        value += piece_value * len(board.pieces(piece_type, color))
+        value -= piece_value * len(board.pieces(piece_type, not color))
+    return value
+
+
+def made_up_search(fen, multipvv, depthv=FALLBACK_DEPTH):
+    """ Returns (info lines, bestmove line) of a deterministic search of
+        the position. The moves are scored by material after the move
+        and a hash of the position and move.
+    """
+    board = chess.Board(fen)
+    side = board.turn
+    base = material(board, side)
+    scored = []
+    for move in board.legal_moves:
+        gain = 0
+        if board.is_en_passant(move):
+            gain = PIECE_VALUES[chess.PAWN]
+        elif board.piece_type_at(move.to_square) is not None:
+            gain = PIECE_VALUES[board.piece_type_at(move.to_square)]
+        if move.promotion is not None:
+            gain += PIECE_VALUES[move.promotion] - PIECE_VALUES[chess.PAWN]
+        scored.append((base + gain + stable_hash(fen + move.uci()) % 41 - 20, move))
+
+    if not scored:
+        return ['info depth 0 score %s' %('mate 0' if board.is_check() else 'cp 0')],\
+            'bestmove (none)'
+
+    # Mate in 1 first, then the best score
+    mates = set(move for score, move in scored
+                if board.gives_check(move) and is_mate_move(board, move))
+    scored.sort(key=lambda n: (n[1] not in mates, -n[0], n[1].uci()))
+    top = scored[:multipvv]
+    pvs = [made_up_pv(board, fen, move, move in mates) for score, move in top]
+    lines = []
+    for depth in range(1, depthv+1):
+        for i, (score, move) in enumerate(top):
+            if move in mates:
+                score_str = 'mate 1'
+            else:
+                score_str = 'cp %d' %(score + (depth % 3) - 1)
+            lines.append('info depth %d seldepth %d multipv %d score %s nodes %d nps 1000000 '
+                         'time %d pv %s' %(depth, depth + 2, i + 1, score_str, 1000*depth,
+                                           depth, pvs[i]))
+    bestmove = 'bestmove %s' % top[0][1].uci()
+    pv_moves = pvs[0].split()
+    if len(pv_moves) > 1:
+        bestmove += ' ponder %s' % pv_moves[1]
+    return lines, bestmove
+
+
+def is_mate_move(board, move):
+    """ Returns True if move checkmates """
+    board.push(move)
+    mate = board.is_checkmate()
+    board.pop()
+    return mate
+
+
+def made_up_pv(board, fen, move, is_mate):
+    """ Returns the uci pv of move, the replies are picked by hash """
+    pv = [move.uci()]
+    if is_mate:
+        return pv[0]
+    board = board.copy(stack=False)
+    board.push(move)
+    for _ in range(3):
+        reply = min(board.legal_moves, key=lambda m: stable_hash(fen + m.uci()), default=None)
+        if reply is None:
+            break
+        board.push(reply)
+        pv.append(reply.uci())
+    return ' '.join(pv)
+
+
+def position_fen(tokens):
+    """ Returns the fen of a uci position command split in tokens """
+    if 'moves' in tokens:
+        i = tokens.index('moves')
+        moves = tokens[i+1:]
+        tokens = tokens[:i]
+    else:
+        moves = []
+    if len(tokens) > 1 and tokens[1] == 'fen':
+        board = chess.Board(' '.join(tokens[2:]))
+    else:
+        board = chess.Board()
+    for move in moves:
+        board.push_uci(move)
+    return board.fen()
+
+
+class FakeEngine(object):
+    """ The uci engine, handle() is called with every command line and
+        the engine output is passed to write()
+    """
+
+    def __init__(self, transcript, write, speed=0.0, depthv=FALLBACK_DEPTH):
+        self.transcript = transcript
+        self.write = write
+        self.speed = speed
+        self.depth = depthv
+        self.multipv = 1
+        self.fen = chess.STARTING_FEN
+        self.search_thread = None
+        self.stop_event = threading.Event()
+
+    def search_lines(self, fen, multipvv):
+        """ Returns (info lines, bestmove line) of the position """
+        recorded = self.transcript.lookup(fen, multipvv)
+        if recorded is not None:
+            return recorded
+        return made_up_search(fen, multipvv, self.depth)
+
+    def replay(self, lines, bestmove):
+        """ Write the lines of a search, waiting the recorded time divided
+            by the speed if the speed is not 0
+        """
+        start = time.perf_counter()
+        for line in lines:
+            if self.stop_event.is_set():
+                break
+            if self.speed > 0:
+                tokens = line.split()
+                if 'time' in tokens:
+                    wait = float(tokens[tokens.index('time') + 1])/1000.0/self.speed
+                    remaining = start + wait - time.perf_counter()
+                    if remaining > 0 and self.stop_event.wait(remaining):
+                        break
+            self.write(line)
+        self.write(bestmove)
+
+    def wait_search(self):
+        """ Wait for the running search to end """
+        if self.search_thread is not None:
+            self.search_thread.join()
+            self.search_thread = None
+
+    def handle(self, line):
+        """ Handle a uci command, returns False on quit """
+        tokens = line.split()
+        if not tokens:
+            return True
+        command = tokens[0]
+        if command == 'uci':
+            self.write('id name %s' % ENGINE_NAME)
+            self.write('id author Chess Game Analyzer')
+            self.write('option name Hash type spin default 16 min 1 max 33554432')
+            self.write('option name Threads type spin default 1 min 1 max 512')
+            self.write('option name MultiPV type spin default 1 min 1 max 500')
+            self.write('uciok')
+        elif command == 'isready':
+            self.wait_search()
+            self.write('readyok')
+        elif command == 'setoption':
+            if len(tokens) >= 5 and tokens[2].lower() == 'multipv':
+                self.multipv = int(tokens[4])
+        elif command == 'ucinewgame':
+            self.wait_search()
+        elif command == 'position':
+            self.wait_search()
+            self.fen = position_fen(tokens)
+        elif command == 'go':
+            self.wait_search()
+            self.stop_event.clear()
+            lines, bestmove = self.search_lines(self.fen, self.multipv)
+            if self.speed > 0:
+                self.search_thread = threading.Thread(target=self.replay,
+                                                      args=(lines, bestmove))
+                self.search_thread.start()
+            else:
+                self.replay(lines, bestmove)
+        elif command == 'stop':
+            self.stop_event.set()
+            self.wait_search()
+        elif command == 'quit':
+            self.stop_event.set()
+            self.wait_search()
+            return False
+        return True
+
+
+def write_line(line):
+    """ Write a line of engine output """
+    with OUTPUT_LOCK:
+        sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+
+
+def run_engine(transcript, speed=0.0, depthv=FALLBACK_DEPTH):
+    """ Run the fake engine on stdin and stdout """
+    engine = FakeEngine(transcript, write_line, speed, depthv)
+    for line in sys.stdin:
+        if not engine.handle(line.strip()):
+            break
+
+
+def record_engine(transcript_fn, engine_command):
+    """ Run the engine on stdin and stdout and append every search
+        to the transcript
+    """
+    p = subprocess.Popen(engine_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         universal_newlines=True, bufsize=1)
+    state = {'fen': chess.STARTING_FEN, 'multipv': 1, 'search': None}
+    lock = threading.Lock()
+
+    def read_engine():
+        for line in p.stdout:
+            line = line.strip()
+            with lock:
+                search = state['search']
+                if search is not None:
+                    if line.startswith('bestmove'):
+                        record = {'fen': search[0], 'multipv': search[1],
+                                  'lines': search[2], 'bestmove': line}
+                        # One write per record, the file can be shared
+                        # by the engines of parallel jobs
+                        with open(transcript_fn, 'a') as f:
+                            f.write(json.dumps(record) + '\n')
+                        state['search'] = None
+                    elif line.startswith('info'):
+                        search[2].append(line)
+            write_line(line)
+
+    reader = threading.Thread(target=read_engine, daemon=True)
+    reader.start()
+    for line in sys.stdin:
+        line = line.strip()
+        tokens = line.split()
+        with lock:
+            if tokens and tokens[0] == 'position':
+                state['fen'] = position_fen(tokens)
+            elif tokens and tokens[0] == 'setoption' and len(tokens) >= 5\
+                    and tokens[2].lower() == 'multipv':
+                state['multipv'] = int(tokens[4])
+            elif tokens and tokens[0] == 'go':
+                state['search'] = (state['fen'], state['multipv'], [])
+        p.stdin.write(line + '\n')
+        p.stdin.flush()
+        if tokens and tokens[0] == 'quit':
+            break
+    p.wait()
+    reader.join()
+
+
+def fake_engine_main(argv):
+    """ start """
+    transcript_fn = None
+    record_fn = None
+    speed = 0.0
+    depthv = FALLBACK_DEPTH
+    try:
+        opts, args = getopt.getopt(argv, '', ['transcript=', 'speed=', 'depth=', 'record='])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '--transcript':
+            transcript_fn = arg
+        elif opt == '--speed':
+            speed = float(arg)
+        elif opt == '--depth':
+            depthv = int(arg)
+        elif opt == '--record':
+            record_fn = arg
+
+    if record_fn is not None:
+        if not args:
+            usage()
+            sys.exit(1)
+        engine_command = args if len(args) > 1 or os.path.isfile(args[0]) else shlex.split(args[0])
+        record_engine(record_fn, engine_command)
+        return
+    run_engine(Transcript(transcript_fn), speed, depthv)
+
+
+if __name__ == "__main__":
+    fake_engine_main(sys.argv[1:])
@@ -159,16 +159,38 @@ v36
 
 from __future__ import print_function
 import chess
-import codecs
 import sys
-from chess import pgn
+import chess.pgn
 import os
-import subprocess
 import random
-from chess import polyglot
+import chess.polyglot
 import getopt
+import time
+import shlex
 from io import StringIO
-import chess.engine 
+import chess.engine
+import asyncio
+import threading
+import queue
+import contextlib
+import atexit
+import collections
+import concurrent.futures
+import sqlite3
+import json
+import io
+import gzip
+import bz2
+import lzma
+import cProfile
+import pstats
+import hashlib
+import functools
+import mmap
+import array
+import struct
+import shutil
+import re
 
 
 # Constants
@@ -184,6 +206,28 @@ GOOD_SCORE = 1.5
 WHITE = 1
 BLACK = 0
 MODEL_GAME_MARGIN = 0.5
+ALTERNATIVE_MARK = '\x00'  # Place of an alternative comment in a ply text
+CACHE_SIZE = 1000000  # Max number of analyzed positions in the cache file
+CACHE_COMMIT_INTERVAL = 100  # Cache writes between commits
+BOOK_CACHE_SIZE = 100000  # Max number of positions in the book lookup cache
+SEARCHES_PER_PLY = 1  # The game move search of a ply is the best move search of the next
+MIN_SEARCH_TIME = 50  # Min ms of a search in the game budget mode
+MAX_TIME_FACTOR = 3.0  # A critical position gets up to 3x the search time
+EVAL_SWING_CP = 50  # Score change between depths of an unstable search
+CLOSE_GAP_CP = 20  # Score gap of pv 1 and 2 when the best move is unclear
+CLEAR_GAP_CP = 150  # Score gap of pv 1 and 2 when the best move is clear
+STABLE_DEPTHS = 4  # Depths with the same best move of a stable search
+MATE_PV_LEN = 200  # Pv length when the position has a mate score
+HEADER_INDEX_BATCH = 10000  # Games inserted at a time while building the header index
+OFFSET_INDEX_MAGIC = b'PGNOFS01'  # First bytes of an offset index file
+OFFSET_INDEX_HEADER = struct.Struct('=8sQqQ')  # magic, pgn size, pgn mtime, games
+TABLEBASE_PIECES = 5  # Positions with this many pieces or less are decided by material
+TABLEBASE_TIME_FACTOR = 0.25  # and get a quarter of the search time
+SINGLE_MOVE = 'single_move'  # Classes of the positions that are not searched
+MATE_MOVE = 'mate_move'
+DEAD_DRAW = 'dead_draw'
+METRICS_STAGES = ('pgn_read', 'spawn', 'handshake', 'engine_wait', 'search', 'info_parse',
+                  'sanpv', 'book', 'cache', 'write', 'game', 'run')  # Order of the metrics report
 
 
 WHITE_MATE_THREAT_COMMENT = {'ENG': 'White is threatening mate in',
@@ -351,11 +395,12 @@ def usage():
     print('Usage:')
     print('appname -f g.pgn --engine Sf7.exe --eoption "Hash value 128, Threads value 1"')
     print('\nOptions:')
-    print('-f or --file <input pgn filename>')
+    print('-f or --file <input pgn filename, - for stdin, can be gz, bz2 or xz compressed>')
     print('--engine <uci engine filename>')
     print('--movetime <time in ms per move, default: 1000 ms>')
     print('--eoption "<opt_name1> value <opt_value1>, <opt_name2> value <opt_value2>"')
-    print('--outfile <filename>')
+    print('--outfile <filename, <outfile>.end marks the last whole game while it is written,')
+    print('           the next run cuts a half-written game of a killed run>')
     print('--startmove <move number>')
     print('--endmove <move number>')
     print('--bookfile <polyglot book filename>')
@@ -364,6 +409,44 @@ def usage():
     print('--cerebellum <0 or 1>')
     print('--bookannotationonly <0 or 1>')
     print('--player <player name in the game found in either White or Black pgn tag>')
+    print('--jobs <number of games analyzed in parallel, default: 1>')
+    print('--threadsperengine <Threads option sent to every engine of the jobs>')
+    print('--plyjobs <number of positions of a game analyzed in parallel, default: 1>')
+    print('--cachefile <position cache filename, analyzed positions are saved and reused>')
+    print('--cachesize <max number of positions in the cache file, default: %d>' % CACHE_SIZE)
+    print('--gamebudget <total engine time per game in seconds, replaces --movetime,')
+    print('              critical positions get more time and easy positions less>')
+    print('--metrics <json filename, stage times and counters of every game and of the run,')
+    print('           they are also printed>')
+    print('--profile <cprofile or pyinstrument, profile the run, only the main thread is')
+    print('           profiled so use it with --jobs 1 --plyjobs 1>')
+    print('--profilefile <profile filename, default: the outfile name with .prof or .html>')
+    print('--resume <0 or 1, 1 keeps a journal of the finished games and a run that was')
+    print('          stopped continues from the first unfinished game, use it on the')
+    print('          first run too. A complete run is not done again unless the input')
+    print('          file or the settings changed, then a new journal is started>')
+    print('--journal <journal filename, default: the outfile name with .journal>')
+    print('--incremental <0 or 1, 1 analyzes only the games that are new or changed')
+    print('               since the last incremental run, or all games if the settings')
+    print('               changed, the outfile is rewritten with all games of the input>')
+    print('--indexfile <index filename, default: the outfile name with .index>')
+    print('--eco <ECO code or its first letters, only these openings are analyzed>')
+    print('--minelo <min rating of both players of the analyzed games>')
+    print('--datefrom <yyyy.mm.dd or yyyy.mm or yyyy, games played on or after the date>')
+    print('--dateto <yyyy.mm.dd or yyyy.mm or yyyy, games played on or before the date>')
+    print('--headerindex <header index filename, the offsets and headers of the games of')
+    print('               an uncompressed input file are indexed once and the games of')
+    print('               --player, --eco, --minelo, --datefrom and --dateto are read')
+    print('               directly from their offsets>')
+    print('--game-range <first-last, first- or -last, only these games are analyzed>')
+    print('--shard <i/N, the games or the --game-range are cut in N consecutive slices')
+    print('         and slice i is analyzed, the output is the outfile name with .shardiofN>')
+    print('--offsetindex <offset index filename of --game-range, --shard and --mmap, the offsets')
+    print('               of the games of an uncompressed input file are indexed once,')
+    print('               default: the outfile name with .offsets>')
+    print('--mergeshards <N, merge the outputs of the N shards of the outfile in order>')
+    print('--mmap <0 or 1, 1 reads an uncompressed input file memory-mapped, the games')
+    print('        are found with the offset index, default: 0>')
    
 
 def random_reason(_lang):
@@ -482,16 +565,6 @@ def mate_indicator(d2m):
     return 'None'
 
 
-def GetMaxMoveNumber(game):
-    """ Take a game object and returns max number of moves """
-    fmvn = 0
-    while len(game.variations):
-        fmvn = game.board().fullmove_number
-        next_node = game.variation(0)
-        game = next_node
-    return int(fmvn)
-    
-
 def get_engine_detailed_data(data, side):
     """ Will extract score, depth, move and pv from input data """
     
@@ -549,21 +622,19 @@ def get_score_and_depth(data, side_to_move):
     return (val, depth)
     
 
-def save_headers(game, outputFN, engine_name, num_threads, nMoveTime):
-    """ Print to file the headers of a game including
+def save_headers(game, f, engine_name, num_threads, nMoveTime):
+    """ Print to the game output f the headers of a game including
         annotator name or the engine that analyzes the game
     """
 
     # # Save headers
     # for key, value in game.headers.iteritems():
-    #     with open(outputFN, 'a+') as f:
-    #         if key != 'Annotator':
-    #             f.write('[%s \"%s\"]\n' %(key, value))
+    #     if key != 'Annotator':
+    #         f.write('[%s \"%s\"]\n' %(key, value))
 
     # # Write the Annotator last
-    # with open(outputFN, 'a+') as f:
-    #     f.write('[Annotator "%s (%0.1fs/pos, thread=%d)"]\n\n' %(engine_name,
-    #                     float(nMoveTime)/1000, num_threads))
+    # f.write('[Annotator "%s (%0.1fs/pos, thread=%d)"]\n\n' %(engine_name,
+    #                 float(nMoveTime)/1000, num_threads))
     
 
 def is_number(s):
@@ -627,60 +698,29 @@ def one_value_move_nags(s, v):
 
 
 # Converts the uci pv to san pv
-def ucipv_to_sanpv(fen, pv):
-    """ Converts uci pv to SAN pv format """    
-    board = chess.Board(fen)
-    side = board.turn    
-    # Store uci pv in a list and update the board
-    # then we pop and save the move in san    
-    a = pv.split(' ')
-    for m in a:
+def ucipv_to_sanpv(board, pv, maxPlies=None):
+    """ Converts uci pv to SAN pv format with move numbers,
+        "32.Nc6 Nh5 33.Qf2" or "32...Nh5 33.Qf2" if black is to move.
+        The moves are pushed on the board and popped again, the board
+        is not changed. The pv is cut at an illegal move and after
+        maxPlies moves.
+    """
+    numPv = []
+    for m in pv.split()[:maxPlies]:
         try:
-            board.push_uci(m)            
+            move = board.parse_uci(m)
         except ValueError:
-            print('Illegal move')            
-    # Pop the moves, and save it in SAN
-    pvSan = []
-    for i in range(len(a)):
-        san = board.san(board.pop())
-        pvSan.append(san)
-    # Reverse it
-    pvSan = list(reversed(pvSan))
-    newPv = ' '.join(pvSan[0:])
-    # We put number to our pv 1. e4 e5 2. Nf3 ...
-    fmvn = fen.split(' ')
-    fmvn = fmvn[-1]
-    fmvn = int(fmvn)
-
-    numPv = []
-    newPvList = newPv.split(' ')
-    if side == WHITE:
-        for i, m in enumerate(newPvList):
-            if i == 0 or i%2 == 0:  # Even
-                c = fmvn + i/2
-                b = str(c) + '.' + m
-                numPv.append(b)
-            else:
-                b = m
-                numPv.append(b)
-    # else if side is black
-    else:
-        for i, m in enumerate(newPvList):
-            if i == 0:
-                c = fmvn
-                b = str(c) + '...' + m
-                numPv.append(b)
-            else:
-                if i%2 != 0:  # Even
-                    c = fmvn + i/2 + 1
-                    b = str(c) + '.' + m
-                    numPv.append(b)
-                else:
-                    b = m
-                    numPv.append(b)
-
-    numPv = ' '.join(numPv[0:])
-    return numPv      
+            print('Illegal move %s in pv %s' %(m, pv))
+            break
+        if board.turn:
+            numPv.append('%d.%s' %(board.fullmove_number, board.san_and_push(move)))
+        elif not numPv:
+            numPv.append('%d...%s' %(board.fullmove_number, board.san_and_push(move)))
+        else:
+            numPv.append(board.san_and_push(move))
+    for _ in numPv:
+        board.pop()
+    return ' '.join(numPv)
 
       
 def mate_distance_to_value(d):
@@ -693,6 +733,42 @@ def mate_distance_to_value(d):
     return value
 
 
+class UciInfo(object):
+    """ Search info of one uci info line, fields that are not in the
+        line are None, pv is a string of uci moves separated by space
+    """
+    __slots__ = ('depth', 'seldepth', 'multipv', 'score_cp', 'score_mate',
+                 'bound', 'nodes', 'nps', 'time', 'pv')
+
+    def __init__(self):
+        self.depth = None
+        self.seldepth = None
+        self.multipv = None
+        self.score_cp = None
+        self.score_mate = None
+        self.bound = None
+        self.nodes = None
+        self.nps = None
+        self.time = None
+        self.pv = None
+
+    def has_score(self):
+        """ Returns True if the line has a cp or mate score """
+        return self.score_cp is not None or self.score_mate is not None
+
+    def value(self):
+        """ Returns the score in cp, mate scores are translated by
+            mate_distance_to_value()
+        """
+        if self.score_mate is not None:
+            return mate_distance_to_value(self.score_mate)
+        return self.score_cp
+
+    def first_move(self):
+        """ Returns the first move of the pv """
+        return self.pv.split(' ', 1)[0]
+
+
 def value_to_mate(value):
     """ return number of move to mate """
     d = 0
@@ -707,401 +783,904 @@ def value_to_mate(value):
     return d
 
 
-def get_time_key(item):
-    """ Sort time """
-    return item[2]
+def uci_info_from_dict(info):
+    """ Returns a UciInfo of a python-chess engine InfoDict,
+        the score is from the side to move point of view
+    """
+    uinfo = UciInfo()
+    uinfo.depth = info.get('depth')
+    uinfo.seldepth = info.get('seldepth')
+    uinfo.multipv = info.get('multipv')
+    uinfo.nodes = info.get('nodes')
+    uinfo.nps = info.get('nps')
+    if 'time' in info:
+        uinfo.time = int(round(info['time'] * 1000))
+    if 'score' in info:
+        score = info['score'].relative
+        if score.is_mate():
+            uinfo.score_mate = score.mate()
+        else:
+            uinfo.score_cp = score.score()
+    if info.get('lowerbound'):
+        uinfo.bound = 'lowerbound'
+    elif info.get('upperbound'):
+        uinfo.bound = 'upperbound'
+    if 'pv' in info:
+        uinfo.pv = ' '.join([m.uci() for m in info['pv']])
+    return uinfo
+
+
+class StageStats(object):
+    """ Seconds and calls of the stages of the analysis, and counts of
+        events like cache hits
+    """
 
+    def __init__(self):
+        self.seconds = collections.Counter()
+        self.counts = collections.Counter()
 
-def get_depth_key(item):
-    """ Sort depth """
-    return item[0]
+    def add_time(self, stage, seconds, calls=1):
+        """ Add the time of calls of a stage """
+        self.seconds[stage] += seconds
+        self.counts[stage] += calls
 
+    def count(self, name, n=1):
+        """ Count an event """
+        self.counts[name] += n
 
-def analyze_complexity(engineName, fen, _eng_option, movetimev, multipvv, nshortPv):
-    """ Position is complex when the engine pv move, changes more than once """
-    assert multipvv == 1
-    multipv_num = multipvv
-    record = []
-    moveChanges = 0
-    bestScore = -INF-1
-    engineIsUsingBook = True
-    scorev = BAD_SCORE
-    
-    p = subprocess.Popen(engineName, stdin=subprocess.PIPE,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT)
-    p.stdin.write("uci\n")
-    for eline in iter(p.stdout.readline, ''):
-        eline = eline.strip()
-        if "uciok" in eline:
-            break
-
-    # Send the engine options except multipv
-    for n in _eng_option:
-        if "multipv" in n.lower():
-            pass
-        else:
-            p.stdin.write("setoption name %s\n" %(n))
-    p.stdin.write("setoption name MultiPV value %d\n" %(multipvv))
-    
-    p.stdin.write("isready\n")
-    for rline in iter(p.stdout.readline, ''):
-        rline = rline.strip()
-        if "readyok" in rline:
-            break
-    p.stdin.write("ucinewgame\n")
-    p.stdin.write("position fen " + fen + "\n")        
-    p.stdin.write("go movetime " + str(movetimev) + "\n")  # mt = movetime in ms
+    def merge(self, other):
+        """ Add the times and counts of other """
+        self.seconds.update(other.seconds)
+        self.counts.update(other.counts)
 
-    # Parse engine output
-    for eline in iter(p.stdout.readline, ''):
-        
-        a = eline.strip()
+    def as_dict(self):
+        return {'seconds': dict(self.seconds), 'counts': dict(self.counts)}
 
-        # Process analysis output if there is depth, score and pv
-        if "depth" in a and "score" in a and "pv" in a:
-            engineIsUsingBook = False
 
-            b = a.split(' ')
+class Metrics(object):
+    """ Stage times and counters of a run and of every game. The game of
+        a thread is set with game(), what happens outside of a game is
+        counted only for the run. The engine loop thread does not update
+        the metrics, the engines keep their StageStats until the thread
+        that uses the engine merges them.
+    """
 
-            i = b.index("depth")
-            depthv = int(b[i+1])
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        """ Forget all times and counts """
+        with self.lock:
+            self.run_stats = StageStats()
+            self.game_stats = collections.OrderedDict()
+
+    def current_game(self):
+        """ Returns the game number of this thread or None """
+        return getattr(self.local, 'game', None)
+
+    @contextlib.contextmanager
+    def game(self, gameCnt):
+        """ with METRICS.game(gameCnt): the stages of this thread
+            are counted for the game too
+        """
+        previous = self.current_game()
+        self.local.game = gameCnt
+        try:
+            yield
+        finally:
+            self.local.game = previous
+
+    def scopes(self):
+        """ Returns the StageStats to update, must hold the lock """
+        gameCnt = self.current_game()
+        if gameCnt is None:
+            return (self.run_stats,)
+        game_stats = self.game_stats.get(gameCnt)
+        if game_stats is None:
+            game_stats = self.game_stats[gameCnt] = StageStats()
+        return (self.run_stats, game_stats)
+
+    def add_time(self, stage, seconds, calls=1):
+        """ Add the time of calls of a stage """
+        with self.lock:
+            for stats in self.scopes():
+                stats.add_time(stage, seconds, calls)
+
+    def count(self, name, n=1):
+        """ Count an event """
+        with self.lock:
+            for stats in self.scopes():
+                stats.count(name, n)
+
+    def merge(self, other):
+        """ Add the times and counts of a StageStats """
+        with self.lock:
+            for stats in self.scopes():
+                stats.merge(other)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ with METRICS.stage('book'): ... is timed as a call of the stage """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - t0)
 
-            # Translate mate to value
-            if "mate" in a:
-                i = b.index("score")
-                d2m = int(b[i+2])
-                scorev = mate_distance_to_value(d2m)
-            elif "score cp" in a:
-                i = b.index("score")
-                scorev = int(b[i+2])
+    def game_summary(self, gameCnt):
+        """ Returns the times and counts of a game as a dict """
+        with self.lock:
+            return self.game_stats.get(gameCnt, StageStats()).as_dict()
 
-            # Split at pv
-            i = b.index("pv")
-            c = b[i+1:]
-            
-            pvv = "None"
+    def summary(self):
+        """ Returns the times and counts of the run and of every game """
+        with self.lock:
+            return {'run': self.run_stats.as_dict(),
+                    'games': collections.OrderedDict((str(gameCnt), stats.as_dict())
+                                                     for gameCnt, stats in self.game_stats.items())}
 
-            # Shorten pv
-            lenPv = len(c)
 
-            if lenPv >= nshortPv:
-                cc = b[i+1 : i+1+nshortPv]
-                d = ' '.join(cc)
-                pvv = d.strip()
-            else:
-                cc = b[i+1:]
-                d = ' '.join(cc)
-                pvv = d.strip()
+METRICS = Metrics()
 
-            # Save only a single move from the pv
-            singleMove = pvv.split(' ')
-            singleMove = singleMove[0]
 
-            # Record everything then sort later
-            record.append([depthv, scorev, singleMove])
-            
-        if "bestmove" in a:
-            bestScore = scorev
-            break
-    # Quit the engine
-    p.communicate('quit\n')
-    p.poll()
-    if p.returncode is None:
-        print('Warning!! the process has not terminated yet in analyze_complexity()')
-
-    if engineIsUsingBook:
-        assert moveChanges == 0
-        return moveChanges, False
-    
-    # Check the move and score
-    for i, item in enumerate(record):
-
-        # Move changes, starts comparison at iteration depth equal to 9
-        if item[0] >= 10:
-            if record[i][2] != record[i-1][2]:
-                moveChanges += 1
-
-    mate = False
-    if bestScore != -INF-1 and (bestScore >= INF - MAX_PLY) or (bestScore <= -INF + MAX_PLY):
-        mate = True
-    return (moveChanges, mate)
-
-
-def max_depth_in_analysis(analysis_data):
-    """ Find maximum depth in the list"""    
-    max_depth = 0
-    for item in analysis_data:
-        if item[0] > max_depth:
-            max_depth = item[0]            
-    return max_depth
-
-
-def alter_pv(pv):
-    """ remove top depth pv """
-    new_pv = []
-    for n in pv:
-        if pv[0][0] == n[0]:
-            pass
-        else:
-            new_pv.append(n)
-    return new_pv
+def metrics_text(summary, title):
+    """ Returns the stage times and counts of a summary dict as text,
+        the stages are in METRICS_STAGES order
+    """
+    seconds = summary['seconds']
+    counts = summary['counts']
+    lines = [title]
+    stages = [n for n in METRICS_STAGES if n in seconds]
+    stages += sorted(n for n in seconds if n not in METRICS_STAGES)
+    for stage in stages:
+        lines.append('  %-12s %9.3fs %8d calls %9.3f ms/call'
+                     %(stage, seconds[stage], counts[stage],
+                       1000.0*seconds[stage]/max(1, counts[stage])))
+    events = ['%s: %d' %(name, counts[name]) for name in sorted(counts) if name not in seconds]
+    if events:
+        lines.append('  ' + ', '.join(events))
+    return '\n'.join(lines)
+
+
+def engine_command(engineName):
+    """ Returns the command to start an engine, engineName is an engine
+        filename or a command line with arguments
+    """
+    if os.path.isfile(engineName):
+        return engineName
+    return shlex.split(engineName)
 
 
-def good_pv_depth(pv, mpv):
-    """ returns true if depth of top pvs is the same """
-    # For 2 pv only
-    if mpv == 2:
-        if pv[0][0] == pv[1][0]:
-            return True
-        else:
-            return False
-    return False
+class EngineLoop(object):
+    """ One asyncio event loop in a background thread, the uci protocols
+        of all engines run in it. Other threads submit coroutines with
+        run() and wait for the result.
+    """
 
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """ Start the loop thread if it is not running """
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever,
+                                               name='engine-loop', daemon=True)
+                self.thread.start()
+            return self.loop
+
+    def run(self, coro):
+        """ Run a coroutine in the loop and returns its result """
+        loop = self.start()
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    def stop(self):
+        """ Stop the loop thread """
+        with self.lock:
+            loop, thread = self.loop, self.thread
+            self.loop = None
+            self.thread = None
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+
+
+ENGINE_LOOP = EngineLoop()
+
+
+class UciEngine(object):
+    """ A warm uci engine process that is reused for many searches.
+        It is driven by the python-chess asyncio UciProtocol in ENGINE_LOOP,
+        the handshake and engine options are sent only once when the
+        process is started, ucinewgame is sent only when the game changes.
+    """
 
-def good_pv_moves(pv):
-    """ returns true if top pvs moves is not the same, applies only to 2 pv """
-    pvmove1 = pv[0][4]
-    pvmove1 = pvmove1.split(' ')
-    pvmove1 = pvmove1[0]
+    def __init__(self, engineName, eng_option):
+        self.engineName = engineName
+        self.eng_option = eng_option
+        self.transport = None
+        self.protocol = None
+        self.id_name = 'Engine'
+        self.spawn_count = 0
+        self.stats = StageStats()
+
+    def engine_options(self):
+        """ Returns the engine options as a dict for configure(),
+            options managed by python-chess like MultiPV are not included
+        """
+        options = {}
+        for n in self.eng_option:
+            name, _, value = n.partition(' value ')
+            name = name.strip()
+            option = self.protocol.options.get(name)
+            if option is None:
+                print('Warning!! engine %s has no option %s' % (self.engineName, name))
+            elif not option.is_managed():
+                options[name] = value.strip() if value else None
+        return options
+
+    async def start(self):
+        """ Start the process and do the uci handshake, the process
+            start and the handshake are timed apart
+        """
+        t0 = time.perf_counter()
+        self.transport, self.protocol = await chess.engine.UciProtocol.popen(
+            engine_command(self.engineName))
+        t1 = time.perf_counter()
+        self.spawn_count += 1
+        try:
+            await self.protocol.initialize()
+        except:
+            self.transport.close()
+            raise
+        self.id_name = self.protocol.id.get('name', 'Engine')
+        await self.protocol.configure(self.engine_options())
+        await self.protocol.ping()
+        self.stats.add_time('spawn', t1 - t0)
+        self.stats.add_time('handshake', time.perf_counter() - t1)
+
+    def take_stats(self):
+        """ Returns the StageStats since the last call """
+        stats = self.stats
+        self.stats = StageStats()
+        return stats
+
+    def is_alive(self):
+        """ Returns True if the engine process is running """
+        return self.protocol is not None and not self.protocol.returncode.done()
+
+    async def restart(self):
+        """ Kill a crashed or stuck engine and start a new one """
+        print('Warning!! restarting engine %s' % self.engineName)
+        self.stats.count('restarts')
+        await self.stop_process()
+        await self.start()
+
+    async def stop_process(self):
+        """ Quit the engine, kill it if it does not terminate """
+        if self.protocol is None:
+            return
+        try:
+            await asyncio.wait_for(self.protocol.quit(), 2)
+        except (chess.engine.EngineError, asyncio.TimeoutError):
+            pass
+        if self.transport.get_returncode() is None:
+            self.transport.kill()
+        self.transport.close()
+        self.transport = None
+        self.protocol = None
+
+    async def search(self, board, movetimev, multipvv, game_id=None, on_info=None, deadline=None):
+        """ Search the board for movetimev ms and returns (bestmove, ms
+            from go to bestmove of the search that completed), the UciInfo of every info line is passed to on_info as it
+            arrives. If deadline is given the search is not limited by
+            movetimev, it is stopped when deadline() ms have passed,
+            deadline() is asked again after every info line.
+            A crashed engine is restarted and the search is tried once more.
+            The search and the on_info calls are timed in self.stats.
+        """
+        # A new game for every search without a game id
+        game = game_id if game_id is not None else object()
+        limit = None
+        if deadline is None:
+            limit = chess.engine.Limit(time=movetimev/1000.0)
+        for trial in range(2):
+            try:
+                if not self.is_alive():
+                    await self.restart()
+                go = time.perf_counter()
+                analysis = await self.protocol.analysis(board, limit, multipv=multipvv, game=game)
+                start = time.perf_counter()
+                stopped = deadline is None
+                info_seconds = 0.0
+                info_lines = 0
+                with analysis:
+                    while True:
+                        timeout = None
+                        if not stopped:
+                            timeout = max(0.0, start + deadline()/1000.0 - time.perf_counter())
+                        try:
+                            info = await asyncio.wait_for(analysis.get(), timeout)
+                        except asyncio.TimeoutError:
+                            analysis.stop()
+                            stopped = True
+                            continue
+                        except chess.engine.AnalysisComplete:
+                            break
+                        info_lines += 1
+                        if on_info is not None:
+                            t0 = time.perf_counter()
+                            on_info(uci_info_from_dict(info))
+                            info_seconds += time.perf_counter() - t0
+                    best = await analysis.wait()
+                self.stats.add_time('search', time.perf_counter() - start - info_seconds)
+                self.stats.add_time('info_parse', info_seconds, info_lines)
+                return best.move, int(1000*(time.perf_counter() - go))
+            except chess.engine.EngineTerminatedError:
+                if trial:
+                    raise
+                await self.restart()
+
+
+class EnginePool(object):
+    """ Keeps warm engines of the same engine file and options,
+        engines are started on demand up to size
+    """
 
-    pvmove2 = pv[1][4]
-    pvmove2 = pvmove2.split(' ')
-    pvmove2 = pvmove2[0]
+    def __init__(self, engineName, eng_option, size=1):
+        self.engineName = engineName
+        self.eng_option = list(eng_option)
+        self.size = size
+        self.engines = []
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.id_name = None
+
+    def acquire(self):
+        """ Returns an idle engine, starts one if the pool is not full """
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if len(self.engines) < self.size:
+                eng = UciEngine(self.engineName, self.eng_option)
+                self.engines.append(eng)
+                new_engine = True
+            else:
+                new_engine = False
+        if new_engine:
+            try:
+                ENGINE_LOOP.run(eng.start())
+            except Exception:
+                with self.lock:
+                    self.engines.remove(eng)
+                raise
+            finally:
+                METRICS.merge(eng.take_stats())
+            self.id_name = eng.id_name
+            return eng
+        with METRICS.stage('engine_wait'):
+            return self.idle.get()
+
+    def release(self, eng):
+        """ Give back an engine to the pool """
+        self.idle.put(eng)
+
+    @contextlib.contextmanager
+    def engine(self):
+        """ with pool.engine() as eng: ... """
+        eng = self.acquire()
+        try:
+            yield eng
+        finally:
+            self.release(eng)
+
+    def search(self, fen, movetimev, multipvv, game_id=None, on_info=None, deadline=None):
+        """ Search the fen with an idle engine, returns (bestmove or None
+            if the engine has no move, ms of the search). The wait for an
+            idle engine and a restart of a crashed engine are not counted.
+        """
+        board = chess.Board(fen)
+        with self.engine() as eng:
+            try:
+                return ENGINE_LOOP.run(eng.search(board, movetimev, multipvv, game_id,
+                                                  on_info, deadline))
+            finally:
+                METRICS.merge(eng.take_stats())
+
+    def spawn_count(self):
+        """ Returns number of processes started by this pool """
+        return sum(eng.spawn_count for eng in self.engines)
+
+    def close(self):
+        """ Quit all engines """
+        with self.lock:
+            engines = self.engines
+            self.engines = []
+        for eng in engines:
+            ENGINE_LOOP.run(eng.stop_process())
+        self.idle = queue.LifoQueue()
+
+
+ENGINE_POOLS = {}
+ENGINE_POOLS_LOCK = threading.Lock()
+
+
+def get_engine_pool(engineName, _eng_option, size=1):
+    """ Returns the engine pool for this engine and options,
+        the pool is created on first use
+    """
+    key = (engineName, tuple(_eng_option))
+    with ENGINE_POOLS_LOCK:
+        pool = ENGINE_POOLS.get(key)
+        if pool is None:
+            pool = EnginePool(engineName, _eng_option, size)
+            ENGINE_POOLS[key] = pool
+        elif size > pool.size:
+            pool.size = size
+    return pool
+
+
+def close_engine_pools():
+    """ Quit all engines of all pools and stop the engine loop """
+    with ENGINE_POOLS_LOCK:
+        pools = list(ENGINE_POOLS.values())
+        ENGINE_POOLS.clear()
+    for pool in pools:
+        pool.close()
+    ENGINE_LOOP.stop()
+
+
+atexit.register(close_engine_pools)
+
+
+def signed_zobrist(key):
+    """ Returns the 64 bit zobrist hash as a signed sqlite integer """
+    if key >= 1 << 63:
+        key -= 1 << 64
+    return key
+
+
+class PositionCache(object):
+    """ On-disk cache of the summarized engine analysis of positions,
+        keyed by the zobrist hash of the position, the engine id with a
+        hash of the engine options and the number of pvs. The least
+        recently used positions are deleted when the cache holds more
+        than size positions.
+    """
 
-    if pvmove1 != pvmove2:
-        return True
-    return False
+    def __init__(self, filename, size=CACHE_SIZE):
+        self.filename = filename
+        self.size = size
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS analysis ('
+                          'zobrist INTEGER NOT NULL, engine TEXT NOT NULL, '
+                          'multipv INTEGER NOT NULL, depth INTEGER NOT NULL, '
+                          'movetime INTEGER NOT NULL, lines TEXT NOT NULL, '
+                          'used INTEGER NOT NULL, move_changes INTEGER, '
+                          'PRIMARY KEY (zobrist, engine, multipv))')
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(analysis)')]
+        if 'move_changes' not in columns:
+            self.conn.execute('ALTER TABLE analysis ADD COLUMN move_changes INTEGER')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS analysis_used ON analysis (used)')
+        self.clock = self.conn.execute('SELECT MAX(used) FROM analysis').fetchone()[0] or 0
+
+    def lookup(self, zobrist, engine_id, multipvv, movetimev, depthv=None, with_changes=False):
+        """ Returns (summarized pv list, best move changes) of the position
+            if it was searched at least movetimev ms or at least to depthv,
+            otherwise None. Best move changes is None if they were not
+            counted, with_changes=True requires them.
+        """
+        key = signed_zobrist(zobrist)
+        with self.lock:
+            row = self.conn.execute('SELECT depth, movetime, lines, move_changes FROM analysis '
+                                    'WHERE zobrist = ? AND engine = ? AND multipv = ?',
+                                    (key, engine_id, multipvv)).fetchone()
+            if row is None or (row[1] < movetimev and (depthv is None or row[0] < depthv))\
+                    or (with_changes and row[3] is None):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.clock += 1
+            self.conn.execute('UPDATE analysis SET used = ? '
+                              'WHERE zobrist = ? AND engine = ? AND multipv = ?',
+                              (self.clock, key, engine_id, multipvv))
+            self.count_write()
+        return json.loads(row[2]), row[3]
+
+    def store(self, zobrist, engine_id, multipvv, movetimev, final_list, moveChanges=None):
+        """ Save the summarized pv list of a position, final_list[0] is
+            the deepest pv
+        """
+        key = signed_zobrist(zobrist)
+        with self.lock:
+            self.clock += 1
+            self.conn.execute('INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                              (key, engine_id, multipvv, final_list[0][0], movetimev,
+                               json.dumps(final_list), self.clock, moveChanges))
+            self.count_write()
+
+    def count_write(self):
+        """ Commit and evict old positions every CACHE_COMMIT_INTERVAL writes """
+        self.writes += 1
+        if self.writes % CACHE_COMMIT_INTERVAL == 0:
+            self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        """ Delete least recently used positions above the cache size """
+        num_pos = self.conn.execute('SELECT COUNT(*) FROM analysis').fetchone()[0]
+        if num_pos > self.size:
+            self.conn.execute('DELETE FROM analysis WHERE rowid IN '
+                              '(SELECT rowid FROM analysis ORDER BY used LIMIT ?)',
+                              (num_pos - self.size,))
+
+    def close(self):
+        """ Save and close the cache file """
+        with self.lock:
+            self.evict()
+            self.conn.commit()
+            self.conn.close()
+
+
+POSITION_CACHE = None
+
+
+def open_position_cache(filename, size=CACHE_SIZE):
+    """ Use the cache file for all analyze_fen() calls """
+    global POSITION_CACHE
+    close_position_cache()
+    POSITION_CACHE = PositionCache(filename, size)
+    return POSITION_CACHE
+
+
+def close_position_cache():
+    """ Stop using the position cache """
+    global POSITION_CACHE
+    if POSITION_CACHE is not None:
+        POSITION_CACHE.close()
+        POSITION_CACHE = None
+
+
+class PvAggregator(object):
+    """ Keeps the latest exact line of each (depth, multipv) while the
+        info lines of a search arrive, and the depths that have a complete
+        set of multipv lines with different first moves.
+        A line is [depth, multipv, time, score, pv]
+    """
 
+    def __init__(self, multipvv):
+        self.multipv = multipvv
+        self.depths = {}  # depth -> {multipv: line}
+        self.good_depths = set()
+        self.deepest_good = None  # max(good_depths)
+        self.deepest_pv1 = None
+
+    def is_empty(self):
+        """ Returns True if no line was added """
+        return not self.depths
+
+    def add(self, depthv, multipvv, timev, scorev, pvv):
+        """ Add an exact (not bound) pv line """
+        if multipvv > self.multipv:
+            return
+        line = [depthv, multipvv, timev, scorev, pvv]
+        if multipvv == 1 and (self.deepest_pv1 is None or depthv >= self.deepest_pv1[0]):
+            self.deepest_pv1 = line
+
+        # Only the depth of this line needs to be checked again, engines
+        # may send a line of a lower depth after the next depth has started
+        depth_lines = self.depths.setdefault(depthv, {})
+        depth_lines[multipvv] = line
+        if len(depth_lines) == self.multipv and\
+                len(set(n[4].split(' ', 1)[0] for n in depth_lines.values())) == self.multipv:
+            self.good_depths.add(depthv)
+            if self.deepest_good is None or depthv > self.deepest_good:
+                self.deepest_good = depthv
+        elif depthv in self.good_depths:
+            self.good_depths.discard(depthv)
+            # Rare, a later line of a complete depth repeats a first move
+            if depthv == self.deepest_good:
+                self.deepest_good = max(self.good_depths) if self.good_depths else None
+
+    def summary(self):
+        """ Returns the pv lines of the deepest complete depth, pv 1 first.
+            If no depth is complete, only the deepest pv 1 line
+            is returned
+        """
+        if self.deepest_good is not None:
+            depth_lines = self.depths[self.deepest_good]
+            return [depth_lines[i+1] for i in range(self.multipv)]
+        if self.deepest_pv1 is not None:
+            return [self.deepest_pv1]
+        return []
+
+
+class SearchTimer(object):
+    """ Time control of one search that also counts the best move changes
+        of pv 1 from depth 10, the complexity of the position. The search
+        gets base ms and is extended to 3x when the best move changes
+        3 times or more. In the game budget mode (adaptive) it is also
+        extended when the score swings between depths or pv 1 and 2 are
+        close, and a stable search with a clear best move or a forced
+        recapture is stopped early. A --movetime search is never cut
+        short, it gets the time that was asked for.
+    """
 
-def get_summarized_pv(analysis_data, multipvv):
-    """ Save the best pv lines return pv list in depth descending order """
-    final_pv_list = []
-    max_depth = max_depth_in_analysis(analysis_data)    
-    for i in range(max_depth):
-        record_depth = []
-
-        # Parse the data and save to new list based on depth
-        for item in analysis_data:
-            if i+1 == item[0]:
-                record_depth.append(item)
-
-        # Sort time
-        time_sorted_list = sorted(record_depth, key=get_time_key, reverse=True)
-
-        # In temp list only save the pv with high time for multipv 1 and 2
-        temp_list = []
-        for j in range(multipvv):            
-            ind = j + 1
-            # Find the pv with this ind and high time and save it
-            for n in time_sorted_list:
-                if ind == n[1]:  # multipv 1 or 2
-                    temp_list.append(n)
-                    break        
-        
-        for n in temp_list:
-            final_pv_list.append(n)
-    
-    final_pv_list = sorted(final_pv_list, key=get_depth_key, reverse=True)  
-    
-    # [18, 1, 2356, 3, 'e1g1 c8a6 d3a6 a8a6 f3d2 e4d2 c2d2']
-    # [17, 1, 1920, 12, 'd1e2 g7g5 f4g3 f8f7 e1g1 e4g3 h2g3']
-    # [17, 2, 1920, 3, 'e1g1 c8a6 d3a6 a8a6 f3d2 e4d2 c2d2']
-    # [16, 1, 1654, 5, 'e1g1 c8a6 d3a6 a8a6 f3d2 e4d2 d1d2']
-    # [16, 2, 1654, 0, 'd1e2 g7g5 f4g3 f8f7 e1g1 e4g3 f2g3']
-
-    # Filter out same pv move if multipv > 1 at given depth
-    if multipvv > 1:
-        # Make sure that multipv is the same as num pvs at same depth
-        # and pv moves among multipv are not the same
-        trials = 0
-        while True and len(final_pv_list) > 1:
-            if trials >= 3:
-                pass
-            trials += 1
-            if good_pv_depth(final_pv_list, multipvv):
-                if good_pv_moves(final_pv_list):
-                    break
-                else:
-                    new_pv = alter_pv(final_pv_list)
-                    final_pv_list = []
-                    final_pv_list = new_pv
-            else:
-                new_pv = alter_pv(final_pv_list)
-                final_pv_list = []
-                final_pv_list = new_pv
-    
-    return final_pv_list
+    def __init__(self, base_ms, max_ms, multipvv, recapture_square=None, adaptive=True):
+        self.adaptive = adaptive
+        self.base_ms = base_ms
+        self.max_ms = max(base_ms, max_ms)
+        self.min_ms = min(base_ms, max(MIN_SEARCH_TIME, base_ms // 4))
+        self.multipv = multipvv
+        self.recapture_square = recapture_square
+        self.deadline_ms = base_ms
+        self.elapsed_ms = 0
+        self.moveChanges = 0
+        self.matePos = False
+        self.lastMove = None
+        self.lastScore = None
+        self.lastDepth = 0
+        self.stableDepths = 0
+        self.swing = False
+        self.gap = None
+        self.pv1_scores = {}
+        self.mate_pv_len = None  # Pv length if a mate score is seen
+
+    def deadline(self):
+        """ Returns the current time limit of the search in ms """
+        return self.deadline_ms
+
+    def extend(self, factor):
+        """ Give the search up to factor times the base time """
+        self.deadline_ms = max(self.deadline_ms, min(self.max_ms, int(factor*self.base_ms)))
+
+    def is_extended(self):
+        """ Returns True if the search got more than the base time """
+        return self.deadline_ms > self.base_ms
+
+    def stop_at(self, timev):
+        """ Stop the search at timev ms but not before min_ms """
+        if not self.is_extended():
+            self.deadline_ms = max(self.min_ms, timev)
+
+    def on_info(self, info):
+        """ Update the search stability of an info line """
+        if info.depth is None or not info.has_score() or not info.pv:
+            return
+        multipvv = info.multipv if info.multipv is not None else 1
+        if multipvv == 1:
+            self.matePos = info.score_mate is not None
+        if info.bound is not None:
+            return
+        scorev = info.value()
+        if multipvv == 1:
+            singleMove = info.first_move()
+            if self.lastMove is not None and singleMove != self.lastMove:
+                if info.depth >= 10:
+                    self.moveChanges += 1
+                self.stableDepths = 0
+            elif info.depth > self.lastDepth:
+                self.stableDepths += 1
+            if self.lastScore is not None and info.depth > self.lastDepth\
+                    and info.depth >= 8 and abs(scorev - self.lastScore) >= EVAL_SWING_CP:
+                self.swing = True
+            self.lastMove = singleMove
+            self.lastScore = scorev
+            self.lastDepth = info.depth
+            self.pv1_scores[info.depth] = scorev
+        elif multipvv == 2 and info.depth in self.pv1_scores:
+            self.gap = abs(self.pv1_scores[info.depth] - scorev)
+
+        # Complex position, the search is continued
+        if self.moveChanges >= 3:
+            self.extend(MAX_TIME_FACTOR)
+        if not self.adaptive:
+            return
+
+        # Critical position
+        if self.swing:
+            self.extend(2.0)
+        if self.multipv > 1 and self.gap is not None and self.gap < CLOSE_GAP_CP\
+                and info.depth >= 10:
+            self.extend(1.5)
+
+        # Forced recapture
+        if self.recapture_square is not None and self.stableDepths >= 3\
+                and info.depth >= 8 and chess.Move.from_uci(self.lastMove).to_square == self.recapture_square\
+                and (self.multipv == 1 or (self.gap is not None and self.gap >= 100)):
+            self.stop_at(info.time or 0)
+
+        # Clear best move
+        elif self.multipv > 1 and self.gap is not None and self.gap >= CLEAR_GAP_CP\
+                and self.stableDepths >= STABLE_DEPTHS and info.depth >= 10:
+            self.stop_at(max(self.base_ms // 2, info.time or 0))
+
+
+class GameBudget(object):
+    """ Total engine time of a game in the game budget mode, the time
+        left is shared by the searches of the plies left
+    """
 
+    def __init__(self, total_ms, num_plies):
+        self.total_ms = total_ms
+        self.remaining_ms = total_ms
+        self.plies_left = max(1, num_plies)
+        self.lock = threading.Lock()
+
+    def search_time(self, factor=1.0):
+        """ Returns (base ms, max ms) of the next search """
+        with self.lock:
+            base = self.remaining_ms / (SEARCHES_PER_PLY*max(1, self.plies_left))
+            base = max(MIN_SEARCH_TIME, int(factor*base))
+            max_ms = max(base, min(int(MAX_TIME_FACTOR*base), self.remaining_ms))
+        return base, max_ms
+
+    def timer(self, multipvv, factor=1.0, recapture_square=None):
+        """ Returns the SearchTimer of the next search """
+        base, max_ms = self.search_time(factor)
+        return SearchTimer(base, max_ms, multipvv, recapture_square)
+
+    def charge(self, timer):
+        """ Take the time of a finished search from the budget """
+        with self.lock:
+            self.remaining_ms = max(0, self.remaining_ms - timer.elapsed_ms)
+
+    def ply_done(self):
+        """ One ply less to analyze """
+        with self.lock:
+            self.plies_left = max(0, self.plies_left - 1)
+
+    def used_ms(self):
+        """ Returns the engine time used """
+        return self.total_ms - self.remaining_ms
+
+
+class SearchMemo(object):
+    """ Results of the searches of a game by fen, a search that is asked
+        for while it is running is waited for
+    """
 
-def get_cerebellum_book_move(engineName, fen, _eng_option, movetimev, multipvv, nshortPv):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = {}
+
+    def search(self, fen, search_fn):
+        """ Returns the result of search_fn() for fen, it is called
+            only once
+        """
+        with self.lock:
+            future = self.results.get(fen)
+            is_owner = future is None
+            if is_owner:
+                future = concurrent.futures.Future()
+                self.results[fen] = future
+        if not is_owner:
+            METRICS.count('memo_hits')
+        if is_owner:
+            try:
+                future.set_result(search_fn())
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+        return future.result()
+
+
+def get_cerebellum_book_move(engineName, fen, _eng_option, movetimev, multipvv, nshortPv, game_id=None):
     """ Returns a uci move and True/False from stockfish that uses cerebellum book.
         If True the bestmove is from cerebellum book """    
     depth_cnt = 0
 
-    # Execute the engine
-    p = subprocess.Popen(engineName, stdin=subprocess.PIPE,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT)
-    p.stdin.write("uci\n")
-    for eline in iter(p.stdout.readline, ''):
-        eline = eline.strip()
-        if "uciok" in eline:
-            break
-
-    # Send the engine options except multipv
-    for n in _eng_option:
-        if "multipv" in n.lower():
-            pass
-        else:
-            p.stdin.write("setoption name %s\n" %(n))
-    p.stdin.write("setoption name MultiPV value %d\n" %(multipvv))
-    
-    p.stdin.write("isready\n")
-    for rline in iter(p.stdout.readline, ''):
-        rline = rline.strip()
-        if "readyok" in rline:
-            break
-    p.stdin.write("ucinewgame\n")
-    p.stdin.write("position fen " + fen + "\n")
-    p.stdin.write("go movetime " + str(movetimev) + "\n")
-
     # Parse engine output
-    for eline in iter(p.stdout.readline, ''):        
-        engine_output = eline.strip()
-        if "depth" in engine_output:
+    def parse_info(info):
+        nonlocal depth_cnt
+        if info.depth is not None:
             depth_cnt += 1
-        if "bestmove" in engine_output:
-            bestmove = engine_output.split()[1]
-            break
-    # Quit the engine
-    p.communicate('quit\n')
-    p.poll()
-    if p.returncode is None:
-        print('Warning!! the process has not terminated yet in analyze_fen()')
+
+    move = get_engine_pool(engineName, _eng_option).search(fen, movetimev, multipvv, game_id, parse_info)[0]
+    bestmove = move.uci() if move is not None else None
     return bestmove, True if depth_cnt == 0 else False
 
 
-def analyze_fen(engineName, fen, _eng_option, movetimev, multipvv, nshortPv):
+def analyze_fen(engineName, fen, _eng_option, movetimev, multipvv, nshortPv, game_id=None,
+                timer=None):
     """ This will output engine analysis in a list
         and the score returned is side POV.
-        Returns None if engine does not search
+        Returns None if engine does not search.
+        If a SearchTimer is given, it controls the search time instead
+        of movetimev
     """    
     multipv_num = multipvv
-    record = []
-    engineIsUsingBook = True
-
-    # Execute the engine
-    p = subprocess.Popen(engineName, stdin=subprocess.PIPE,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT)
-    p.stdin.write(str.encode("uci\n"))
-    for eline in iter(p.stdout.readline, ''):
-        eline = eline.strip()
-        if "uciok" in eline:
-            break
-
-    # Send the engine options except multipv
-    for n in _eng_option:
-        if "multipv" in n.lower():
-            pass
-        else:
-            p.stdin.write("setoption name %s\n" %(n))
-            # print('setoption name %s\n' %(n))
-    p.stdin.write("setoption name MultiPV value %d\n" %(multipvv))
-    
-    p.stdin.write("isready\n")
-    for rline in iter(p.stdout.readline, ''):
-        rline = rline.strip()
-        if "readyok" in rline:
-            break
-    p.stdin.write("ucinewgame\n")
-    p.stdin.write("position fen " + fen + "\n")
-
-    # New command so that only 1 depth will be reported
-    p.stdin.write("go movetime " + str(movetimev) + "\n")
-
-    # Parse engine output
-    for eline in iter(p.stdout.readline, ''):        
-        engine_output = eline.strip()
-
-        # Process engine analysis output
-        if "depth" in engine_output\
-                    and ("score cp" in engine_output)\
-                    or ("score mate" in engine_output)\
-                    and "time" in engine_output\
-                    and "pv" in engine_output\
-                    and not "upperbound" in engine_output\
-                    and not "lowerbound" in engine_output:
-            engineIsUsingBook = False
-
-            b = engine_output.split(' ')
-
-            i = b.index("depth")
-            depthv = int(b[i+1])
-               
-            if "multipv" in engine_output:
-                i = b.index("multipv")
-                multipvv = int(b[i+1])
-            else:
-                multipvv = 1
-               
-            i = b.index("time")
-            timev = int(b[i+1])
-
-            # Translate mate to value
-            if "mate" in engine_output:
-                i = b.index("score")
-                d2m = int(b[i+2])
-                scorev = mate_distance_to_value(d2m)
-            else:
-                i = b.index("score")
-                scorev = int(b[i+2])
-
-            # Split at pv
-            i = b.index("pv")
-            c = b[i+1:]
-            
-            pvv = "None"
-
-            # Shorten pv
-            lenPv = len(c)
 
-            # If score is mate save all pv otherwise use nshortPv
-            if lenPv >= nshortPv and abs(scorev) < INF-MAX_PLY:
-                cc = b[i+1 : i+1+nshortPv]
-                d = ' '.join(cc)
-                pvv = d.strip()
-            else:
-                cc = b[i+1:]
-                d = ' '.join(cc)
-                pvv = d.strip()
+    if timer is not None:
+        movetimev = timer.base_ms
 
-            # Record everything then sort later
-            record.append([depthv, multipvv, timev, scorev, pvv])
-            
-        if "bestmove" in engine_output:
-            break
-    # Quit the engine
-    p.communicate('quit\n')
-    p.poll()
-    if p.returncode is None:
-        print('Warning!! the process has not terminated yet in analyze_fen()')
-
-    if engineIsUsingBook:
+    # Answer from the position cache if it has a long enough search
+    board = chess.Board(fen)
+    cache = POSITION_CACHE
+    if cache is not None:
+        zobrist = chess.polyglot.zobrist_hash(board)
+        engine_id = get_cache_engine_id(engineName, _eng_option)
+        with METRICS.stage('cache'):
+            cached = cache.lookup(zobrist, engine_id, multipv_num, movetimev,
+                                  with_changes=timer is not None)
+        METRICS.count('cache_misses' if cached is None else 'cache_hits')
+        if cached is not None:
+            final_list, moveChanges = cached
+            if timer is not None:
+                timer.moveChanges = moveChanges
+                timer.matePos = abs(final_list[0][3]) >= INF - MAX_PLY
+                if timer.matePos and timer.mate_pv_len is not None:
+                    nshortPv = timer.mate_pv_len
+            return analysis_lines(board, final_list, multipv_num, nshortPv)
+
+    pvs = PvAggregator(multipv_num)
+
+    # Parse engine output as it arrives
+    def parse_info(info):
+
+        # Process engine analysis output, lines with a bound score are not exact
+        if info.depth is not None and info.has_score()\
+                    and info.time is not None and info.pv and info.bound is None:
+            multipvv = info.multipv if info.multipv is not None else 1
+
+            # The pv is shortened when it is written
+            pvs.add(info.depth, multipvv, info.time, info.value(), info.pv)
+        if timer is not None:
+            timer.on_info(info)
+
+    if timer is None:
+        get_engine_pool(engineName, _eng_option).search(fen, movetimev, multipvv, game_id, parse_info)
+    else:
+        # The time of the search only, without the wait for an engine
+        timer.elapsed_ms = get_engine_pool(engineName, _eng_option).search(
+            fen, movetimev, multipvv, game_id, parse_info, timer.deadline)[1]
+        movetimev = timer.elapsed_ms
+        if timer.matePos and timer.mate_pv_len is not None:
+            nshortPv = timer.mate_pv_len
+
+    # Engine does not search if it uses its own book
+    if pvs.is_empty():
         return None
 
     # Save the engine analysis
-    final_list = get_summarized_pv(record, multipvv)
+    final_list = pvs.summary()
+    if cache is not None and len(final_list):
+        with METRICS.stage('cache'):
+            cache.store(zobrist, engine_id, multipv_num, movetimev, final_list,
+                        timer.moveChanges if timer is not None else None)
+
+    return analysis_lines(board, final_list, multipv_num, nshortPv)
+
 
+def analysis_lines(board, final_list, multipvv, nshortPv):
+    """ Returns the analysis lines from the summarized pv list,
+        "+0.89/11 32.Nc6 Nh5 33.Qf2 Qd1 34.Nb4", for nshortPv = 5,
+        board is the searched position
+    """
     old_depth = 0
     return_list = []
     save_cnt = 0
     for n in final_list:        
         scorev = n[3]
 
+        # If score is mate save all pv otherwise use nshortPv
+        maxPlies = nshortPv if abs(scorev) < INF-MAX_PLY else None
+
         # Convert LAN pv to SAN
-        san_pv = ucipv_to_sanpv(fen, n[4])
+        with METRICS.stage('sanpv'):
+            san_pv = ucipv_to_sanpv(board, n[4], maxPlies)
         analysis_line = ("%+0.2f/%d %s" %(float(n[3])/100, n[0], san_pv))
 
         # Before saving the second pv make sure that the depth of the first pv
@@ -1128,30 +1707,106 @@ def analyze_fen(engineName, fen, _eng_option, movetimev, multipvv, nshortPv):
     return return_list
 
 
-def get_engine_id(enginefn):
+def get_engine_id(enginefn, _eng_option=()):
     """ Returns id name of an engine """
-    engine_idname = 'Engine'
-    # print(engine_idname + enginefn)
-    p = subprocess.Popen(enginefn, stdin=subprocess.PIPE,
-                         stdout=subprocess.PIPE,
-                         stderr=subprocess.STDOUT)
-    p.stdin.write(str.encode('uci\n'))
-    for eline in iter(p.stdout.readline, ''):
-        eline = eline.strip()
-        if str.encode('id name') in eline:
-            a = eline.split()
-            engine_idname = ' '.join(a[2:])
-        elif str.encode('uciok') in eline:
-            break
+    pool = get_engine_pool(enginefn, _eng_option)
+    if pool.id_name is None:
+        with pool.engine() as eng:
+            pool.id_name = eng.id_name
+    return pool.id_name
+
+
+def get_cache_engine_id(enginefn, _eng_option=()):
+    """ Returns the engine id of the position cache, the id name of the
+        engine and a hash of its options, a search with other Hash,
+        Threads or --eoption values is another entry
+    """
+    options = json.dumps([n.strip() for n in _eng_option])
+    return '%s %s' %(get_engine_id(enginefn, _eng_option),
+                     hashlib.sha1(options.encode('utf-8')).hexdigest()[:16])
+
+
+def analyze_position(fen, parent_board, move, gameCnt, opts, budget=None, memo=None):
+    """ Returns (analysis list, SearchTimer) of the multipv 2 search of
+        the position fen reached by move from parent_board. The search
+        gives the score of the game move of a ply and the engine analysis
+        of the next ply, the first ply that asks for it does the search
+        and the memo keeps it for the other one. The search is continued
+        to 3x the time when the best move changes 3 times or more.
+    """
+    def search():
+        nMultiPv = 2
+        timeFactor = search_time_factor(chess.Board(fen))
+        if budget is not None:
+            budgetFactor = timeFactor
+            if opts.option_use_book and parent_board is not None\
+                    and opts.book.book_moves(parent_board):
+                budgetFactor *= 0.5
+            recaptureSquare = None
+            if parent_board is not None:
+                recaptureSquare = recapture_square(parent_board, move)
+            timer = budget.timer(nMultiPv, budgetFactor, recaptureSquare)
         else:
-            break
-    engine_idname = str(eline)
-    # Quit the engine
-    p.communicate(str.encode('quit\n'))
-    p.poll()
-    if p.returncode is None:
-        print('Warning!! the process has not terminated yet in get_engine_id()')
-    return engine_idname
+            baseTime = int(timeFactor*opts.nMoveTime)
+            timer = SearchTimer(baseTime, int(MAX_TIME_FACTOR*baseTime), nMultiPv,
+                                adaptive=False)
+
+        # If position has mate score then we extend the pv length
+        timer.mate_pv_len = MATE_PV_LEN
+        analysisList = analyze_fen(opts.sEngine, fen, opts.eng_option, opts.nMoveTime,
+                                   nMultiPv, opts.nshortPv, gameCnt, timer)
+        if budget is not None:
+            budget.charge(timer)
+        return analysisList, timer
+
+    if memo is None:
+        return search()
+    return memo.search(fen, search)
+
+
+def classify_position(board, move):
+    """ Returns the class of a position whose game move can be annotated
+        without the engine or None. SINGLE_MOVE if the game move is the
+        only legal move, MATE_MOVE if it mates and DEAD_DRAW if no side
+        has the material to mate. A forced recapture is not classified,
+        its score needs a search, only the game budget mode stops that
+        search early.
+    """
+    if board.is_insufficient_material():
+        return DEAD_DRAW
+    legal_moves = board.legal_moves
+    if legal_moves.count() == 1:
+        return SINGLE_MOVE
+    # gives_check() pushes and pops, the board may be shared
+    board = board.copy(stack=False)
+    if board.gives_check(move):
+        board.push(move)
+        if board.is_checkmate():
+            return MATE_MOVE
+    return None
+
+
+def search_time_factor(board):
+    """ Returns the factor of the search time of a position, positions
+        with tablebase material are decided quickly
+    """
+    if chess.popcount(board.occupied) <= TABLEBASE_PIECES:
+        return TABLEBASE_TIME_FACTOR
+    return 1.0
+
+
+def recapture_square(board, move):
+    """ Returns the square of a capture move if the opponent can
+        recapture on it, otherwise None
+    """
+    if not board.is_capture(move):
+        return None
+    board = board.copy(stack=False)
+    board.push(move)
+    for m in board.generate_legal_captures():
+        if m.to_square == move.to_square:
+            return move.to_square
+    return None
 
 
 def OnlyMove(s, anaMove, gameMove, anaValue1, anaValue2):
@@ -1172,6 +1827,1704 @@ def OnlyMove(s, anaMove, gameMove, anaValue1, anaValue2):
     return False
            
 
+class PolyglotBook(object):
+    """ A polyglot book that is opened once for the run, the file is
+        memory mapped by python-chess. The legal book moves of a position
+        are looked up once and kept by zobrist hash.
+    """
+
+    def __init__(self, filename, size=BOOK_CACHE_SIZE):
+        self.filename = filename
+        self.size = size
+        self.reader = chess.polyglot.open_reader(filename)
+        self.moves = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def book_moves(self, board):
+        """ Returns the uci book moves of the board in book order,
+            the first move is the best book move
+        """
+        with METRICS.stage('book'):
+            key = chess.polyglot.zobrist_hash(board)
+            with self.lock:
+                moves = self.moves.get(key)
+                if moves is not None:
+                    self.moves.move_to_end(key)
+                    METRICS.count('book_cache_hits')
+                    return moves
+                moves = tuple([str(entry.move) for entry in self.reader.find_all(board)])
+                self.moves[key] = moves
+                if len(self.moves) > self.size:
+                    self.moves.popitem(last=False)
+            return moves
+
+    def best_move(self, board):
+        """ Returns the best uci book move or None if not in book """
+        moves = self.book_moves(board)
+        return moves[0] if moves else None
+
+    def is_book_move(self, board, uci_move):
+        """ Returns True if uci_move is a book move of the board """
+        return uci_move in self.book_moves(board)
+
+    def close(self):
+        """ Close the book file """
+        self.reader.close()
+
+
+class AnnotatorOptions(object):
+    """ Settings of an annotation run, shared by all games """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class PgnWriter(object):
+    """ Writes the annotated games to the output file through one
+        buffered handle. A game is written as a whole, flushed and synced
+        before it counts as written, if the write fails the file is
+        truncated. The end of the last whole game is kept in the file
+        <outfile>.end while the writer is open, a run that is killed in
+        the middle of a game leaves it behind and the next writer of the
+        output cuts the half-written game.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.end_fn = filename + '.end'
+        self.fo = open(filename, 'ab')
+        self.size = self.fo.seek(0, os.SEEK_END)
+        end = self.read_end()
+        if end is not None and end < self.size:
+            print('Removing the half-written game at the end of %s' % filename)
+            self.truncate(end)
+        else:
+            self.save_end()
+
+    def read_end(self):
+        """ Returns the end of the last whole game of a killed run or None """
+        try:
+            with open(self.end_fn) as f:
+                return int(f.read())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save_end(self):
+        """ Save the end of the last whole game """
+        tmp_fn = self.end_fn + '.tmp'
+        with open(tmp_fn, 'w') as f:
+            f.write('%d' % self.size)
+        os.replace(tmp_fn, self.end_fn)
+
+    def write_game(self, annotated_game):
+        """ Append a game and returns its offset in the file """
+        data = annotated_game.encode('utf-8')
+        offset = self.size
+        try:
+            with METRICS.stage('write'):
+                self.fo.write(data)
+                self.fo.flush()
+                os.fsync(self.fo.fileno())
+        except (IOError, OSError):
+            self.truncate(offset)
+            raise
+        self.size += len(data)
+        self.save_end()
+        return offset
+
+    def truncate(self, offset):
+        """ Cut the file at offset and reopen it """
+        try:
+            self.fo.close()
+        except (IOError, OSError):
+            pass
+        with open(self.filename, 'r+b') as fo:
+            fo.truncate(offset)
+        self.fo = open(self.filename, 'ab')
+        self.size = offset
+        self.save_end()
+
+    def sync(self):
+        """ Make the written games durable """
+        os.fsync(self.fo.fileno())
+
+    def close(self):
+        """ Close the file, a game whose write was interrupted is cut """
+        try:
+            self.fo.close()
+        except (IOError, OSError):
+            pass
+        if os.path.getsize(self.filename) > self.size:
+            with open(self.filename, 'r+b') as fo:
+                fo.truncate(self.size)
+        try:
+            os.remove(self.end_fn)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RunJournal(object):
+    """ Journal of a resumable run, a json line is appended for every
+        finished game with the end of its annotated text in the output
+        file. A resumed run skips the finished games of the input and
+        cuts the output file after the last finished game. A complete
+        run is done again in a new journal if the input file or the
+        settings changed, the key of the run.
+        The lines are {"file": <input pgn>, "output": <output size at start>,
+        "key": <key of the run>}, then {"game": <game number>, "end": <output size>} for every game
+        and {"done": true} when the run is complete.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.pgn_file = None
+        self.run_key = None
+        self.output_start = None
+        self.games_done = 0
+        self.output_end = None
+        self.done = False
+        self.fo = None
+        size = 0
+        if os.path.isfile(filename):
+            size = self.load()
+        self.fo = open(filename, 'ab')
+        # Remove a line that was cut by a crash
+        if self.fo.seek(0, os.SEEK_END) > size:
+            self.fo.truncate(size)
+
+    def load(self):
+        """ Read the journal, returns the size of its complete lines """
+        size = 0
+        with open(self.filename, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                if 'file' in record:
+                    self.pgn_file = record['file']
+                    self.run_key = record.get('key')
+                    self.output_start = self.output_end = record['output']
+                elif 'game' in record:
+                    self.games_done = record['game']
+                    self.output_end = record['end']
+                elif record.get('done'):
+                    self.done = True
+                size += len(line)
+        return size
+
+    def is_started(self):
+        """ Returns True if the journal has the start of a run """
+        return self.pgn_file is not None
+
+    def append(self, record):
+        """ Save a record of the journal to disk """
+        self.fo.write((json.dumps(record) + '\n').encode('utf-8'))
+        self.fo.flush()
+        os.fsync(self.fo.fileno())
+
+    def start(self, pgn_file, output_size, run_key=None):
+        """ Save the start of a new run """
+        self.pgn_file = pgn_file
+        self.run_key = run_key
+        self.output_start = self.output_end = output_size
+        self.append({'file': pgn_file, 'output': output_size, 'key': run_key})
+
+    def reset(self):
+        """ Remove the records of the last run """
+        self.fo.truncate(0)
+        self.pgn_file = self.run_key = None
+        self.output_start = self.output_end = None
+        self.games_done = 0
+        self.done = False
+
+    def game_done(self, gameCnt, output_size):
+        """ Save that the games up to gameCnt are in the output file """
+        self.games_done = gameCnt
+        self.output_end = output_size
+        self.append({'game': gameCnt, 'end': output_size})
+
+    def finish(self):
+        """ Save that all games are done """
+        self.done = True
+        self.append({'done': True})
+
+    def close(self):
+        self.fo.close()
+
+
+def run_key(pgn_file, opts, gameFilter, first_game, last_game):
+    """ Returns the hash of the input file as it is now, the settings
+        and the games of a resumable run
+    """
+    st = os.stat(pgn_file)
+    data = json.dumps([os.path.abspath(pgn_file), st.st_size, st.st_mtime_ns,
+                       settings_key(opts), gameFilter.player, gameFilter.eco,
+                       gameFilter.minElo, gameFilter.dateFrom, gameFilter.dateTo,
+                       first_game, last_game])
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def settings_key(opts):
+    """ Returns a text of the settings that change the annotation of a game """
+    return json.dumps([APP_VERSION, opts.engine_id, opts.eng_option, opts.nMoveTime,
+                       opts.gameBudget, opts.nshortPv, opts.startFmvn, opts.lastFmvn,
+                       opts.book_fn if opts.option_use_book else None,
+                       opts.option_add_variation_margin, opts.option_player, opts.lang,
+                       opts.option_use_cerebellum_book, opts.option_book_anno_only])
+
+
+def game_key(game, settingsKey):
+    """ Returns the hash of the headers and main line moves of a game
+        and the settings key
+    """
+    data = '\n'.join([settingsKey, json.dumps(list(game.headers.items())),
+                      ' '.join([move.uci() for move in game.mainline_moves()])])
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class GameIndex(object):
+    """ Index of the annotated games in an output file for incremental
+        runs, the offset and length of every annotated game by game_key().
+        The index is only used if the output file has the size and
+        modification time that were saved with it.
+        The new output is written to a temporary file, commit() renames
+        it to the output file and saves the new index.
+    """
+
+    def __init__(self, filename, output_fn):
+        self.filename = filename
+        self.output_fn = output_fn
+        self.games = {}
+        self.new_games = {}
+        self.output = None
+        self.lock = threading.Lock()
+        if os.path.isfile(filename) and os.path.isfile(output_fn):
+            with open(filename) as f:
+                index = json.load(f)
+            st = os.stat(output_fn)
+            if index['output_size'] == st.st_size and index['output_mtime'] == st.st_mtime_ns:
+                self.games = index['games']
+                self.output = open(output_fn, 'rb')
+            else:
+                print('Warning!! index %s does not match output file %s, all games are analyzed'
+                      %(filename, output_fn))
+
+    def annotated_game(self, key):
+        """ Returns the annotated game of key from the output file or None,
+            it is called by the parallel jobs
+        """
+        entry = self.games.get(key)
+        if entry is None:
+            return None
+        offset, length = entry
+        with self.lock:
+            self.output.seek(offset)
+            data = self.output.read(length)
+        return data.decode('utf-8')
+
+    def add(self, key, offset, length):
+        """ Save where an annotated game is in the new output file """
+        self.new_games[key] = (offset, length)
+
+    def commit(self, tmp_fn):
+        """ Replace the output file with the new output file tmp_fn
+            and save its index
+        """
+        self.close()
+        os.replace(tmp_fn, self.output_fn)
+        st = os.stat(self.output_fn)
+        index = {'output_size': st.st_size, 'output_mtime': st.st_mtime_ns,
+                 'games': self.new_games}
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def close(self):
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+
+
+def open_pgn(pgn_file):
+    """ Returns a text file object that reads the pgn file as a stream.
+        pgn_file '-' is stdin. gzip, bz2 and xz compressed input is
+        recognized from its first bytes and decompressed while reading.
+    """
+    if pgn_file == '-':
+        raw = sys.stdin.buffer
+    else:
+        raw = open(pgn_file, 'rb')
+    compression = pgn_compression(raw.peek(6)[:6])
+    if compression == 'gzip':
+        raw = gzip.GzipFile(fileobj=raw)
+    elif compression == 'bz2':
+        raw = bz2.BZ2File(raw)
+    elif compression == 'xz':
+        raw = lzma.LZMAFile(raw)
+    return io.TextIOWrapper(raw, encoding='utf-8', errors='replace')
+
+
+def pgn_compression(magic):
+    """ Returns gzip, bz2 or xz if the first bytes of a file are of
+        compressed data, otherwise None
+    """
+    if magic.startswith(b'\x1f\x8b'):
+        return 'gzip'
+    if magic.startswith(b'BZh'):
+        return 'bz2'
+    if magic.startswith(b'\xfd7zXZ\x00'):
+        return 'xz'
+    return None
+
+
+class MainlineGame(object):
+    """ The headers and the main line moves of a pgn game, it has the
+        parts of chess.pgn.Game that the annotator uses
+    """
+
+    def __init__(self):
+        self.headers = chess.pgn.Headers()
+        self.moves = []
+        self.errors = []
+        self.skipped = False
+
+    def board(self):
+        """ Returns the starting position """
+        return self.headers.board()
+
+    def mainline_moves(self):
+        """ Returns the main line moves """
+        return self.moves
+
+
+class MainlineVisitor(chess.pgn.BaseVisitor):
+    """ Reads a game into a MainlineGame with chess.pgn.read_game(),
+        variations are skipped while parsing and comments and NAGs
+        are dropped. The moves of a game that does not match gameFilter
+        are not parsed, the game is returned with skipped set.
+    """
+
+    def __init__(self, gameFilter=None):
+        self.gameFilter = gameFilter
+
+    def begin_game(self):
+        self.game = MainlineGame()
+
+    def begin_headers(self):
+        return self.game.headers
+
+    def visit_header(self, tagname, tagvalue):
+        self.game.headers[tagname] = tagvalue
+
+    def end_headers(self):
+        if self.gameFilter is not None and not self.gameFilter.matches(self.game.headers):
+            self.game.skipped = True
+            return chess.pgn.SKIP
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def visit_move(self, board, move):
+        self.game.moves.append(move)
+
+    def visit_result(self, result):
+        # The movetext result is used if the Result header is missing
+        if self.game.headers.get('Result', '*') == '*':
+            self.game.headers['Result'] = result
+
+    def handle_error(self, error):
+        print('Warning!! %s while reading the game %s - %s'
+              %(error, self.game.headers.get('White'), self.game.headers.get('Black')))
+        self.game.errors.append(error)
+
+    def result(self):
+        return self.game
+
+
+def read_games(ifo):
+    """ Yields the games of a pgn file object one by one as MainlineGames """
+    for gameCnt, game in numbered_games(ifo):
+        yield game
+
+
+def numbered_games(ifo, gameFilter=None, first_game=1, last_game=None):
+    """ Yields (game number, game) of the games of a pgn file object that
+        match gameFilter, the game number is the position of the game in
+        the file counted from first_game. Reading stops after last_game.
+    """
+    visitor = functools.partial(MainlineVisitor, gameFilter)
+    gameCnt = first_game
+    while last_game is None or gameCnt <= last_game:
+        with METRICS.stage('pgn_read'):
+            game = chess.pgn.read_game(ifo, Visitor=visitor)
+        if game is None:
+            break
+        if not game.skipped:
+            yield gameCnt, game
+        gameCnt += 1
+
+
+def skip_games(ifo, num_games):
+    """ Skip num_games games of a pgn file object without parsing
+        their moves, returns the number of games skipped
+    """
+    skipped = 0
+    with METRICS.stage('pgn_read'):
+        while skipped < num_games and chess.pgn.skip_game(ifo):
+            skipped += 1
+    return skipped
+
+
+def normalized_date(date, unknown='0'):
+    """ Returns a pgn date as yyyy.mm.dd that can be compared as text,
+        the unknown ? digits and the missing parts are replaced by unknown
+    """
+    date = (date or '????').replace('?', unknown)
+    return (date + '.%s%s.%s%s' %((unknown,)*4))[:10]
+
+
+def header_elo(value):
+    """ Returns the rating of an Elo header, 0 if it is not a number """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+class GameFilter(object):
+    """ Header conditions of the games to analyze, a condition that is
+        None is not checked. The games are matched by their headers with
+        matches(), or in the header index with the sql of where().
+    """
+
+    def __init__(self, player=None, eco=None, minElo=None, dateFrom=None, dateTo=None):
+        self.player = player
+        self.eco = eco
+        self.minElo = minElo
+        self.dateFrom = None if dateFrom is None else normalized_date(dateFrom, '0')
+        self.dateTo = None if dateTo is None else normalized_date(dateTo, '9')
+        self.playerPattern = None
+        if player not in (None, '?') and '"' not in player and '\\' not in player:
+            self.playerPattern = re.compile(re.escape(player.encode('utf-8')))
+
+    def is_empty(self):
+        return self.player is None and self.eco is None and self.minElo is None\
+            and self.dateFrom is None and self.dateTo is None
+
+    def matches(self, headers):
+        """ Returns True if the game of the headers is analyzed """
+        if self.player is not None and self.player != headers.get('White')\
+                and self.player != headers.get('Black'):
+            return False
+        if self.eco is not None and not headers.get('ECO', '').startswith(self.eco):
+            return False
+        if self.minElo is not None and min(header_elo(headers.get('WhiteElo')),
+                                           header_elo(headers.get('BlackElo'))) < self.minElo:
+            return False
+        date = normalized_date(headers.get('Date', ''))
+        if self.dateFrom is not None and date < self.dateFrom:
+            return False
+        if self.dateTo is not None and date > self.dateTo:
+            return False
+        return True
+
+    def may_match(self, data, start, end):
+        """ Returns False if the game of the raw bytes start to end of data
+            can not match, without decoding them. A player name is in the
+            bytes as it is unless it has a quote or a backslash that pgn
+            escapes, or it is the ? of a missing header.
+        """
+        if self.playerPattern is not None:
+            return self.playerPattern.search(data, start, end) is not None
+        return True
+
+    def where(self):
+        """ Returns (sql condition, parameters) of the games table of the
+            header index
+        """
+        conditions = []
+        params = []
+        if self.player is not None:
+            conditions.append('(white = ? OR black = ?)')
+            params += [self.player, self.player]
+        if self.eco is not None:
+            conditions.append('substr(eco, 1, ?) = ?')
+            params += [len(self.eco), self.eco]
+        if self.minElo is not None:
+            conditions.append('min(white_elo, black_elo) >= ?')
+            params.append(self.minElo)
+        if self.dateFrom is not None:
+            conditions.append('date >= ?')
+            params.append(self.dateFrom)
+        if self.dateTo is not None:
+            conditions.append('date <= ?')
+            params.append(self.dateTo)
+        return ' AND '.join(conditions) or '1', params
+
+
+class PgnLineReader(object):
+    """ Reads the lines of a binary pgn file for chess.pgn, offset is the
+        byte offset of the next line
+    """
+
+    def __init__(self, raw, offset=0):
+        self.raw = raw
+        self.offset = offset
+
+    def readline(self):
+        line = self.raw.readline()
+        self.offset += len(line)
+        return line.decode('utf-8', 'replace')
+
+
+class HeaderIndex(object):
+    """ On-disk index of the games of an uncompressed pgn file, the byte
+        offset and the players, date, ECO, ratings and result of every
+        game. It is built by reading only the headers and rebuilt when
+        the size or the modification time of the pgn file changes.
+    """
+
+    def __init__(self, filename, pgn_file):
+        self.filename = filename
+        self.pgn_file = pgn_file
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS source ('
+                          'pgn_file TEXT NOT NULL, size INTEGER NOT NULL, '
+                          'mtime INTEGER NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS games ('
+                          'number INTEGER PRIMARY KEY, offset INTEGER NOT NULL, '
+                          'white TEXT, black TEXT, date TEXT, eco TEXT, '
+                          'white_elo INTEGER, black_elo INTEGER, result TEXT)')
+        if not self.is_current():
+            self.build()
+
+    def is_current(self):
+        """ Returns True if the index is of the pgn file as it is now """
+        st = os.stat(self.pgn_file)
+        row = self.conn.execute('SELECT pgn_file, size, mtime FROM source').fetchone()
+        return row is not None and tuple(row) == (os.path.abspath(self.pgn_file),
+                                                  st.st_size, st.st_mtime_ns)
+
+    def build(self):
+        """ Index every game of the pgn file """
+        print('Building header index %s of %s' %(self.filename, self.pgn_file))
+        st = os.stat(self.pgn_file)
+        self.conn.execute('DELETE FROM source')
+        self.conn.execute('DELETE FROM games')
+        rows = []
+        with open(self.pgn_file, 'rb') as raw:
+            reader = PgnLineReader(raw)
+            number = 0
+            while True:
+                offset = reader.offset
+                with METRICS.stage('pgn_read'):
+                    headers = chess.pgn.read_headers(reader)
+                if headers is None:
+                    break
+                number += 1
+                rows.append((number, offset, headers.get('White'), headers.get('Black'),
+                             normalized_date(headers.get('Date', '')), headers.get('ECO', ''),
+                             header_elo(headers.get('WhiteElo')),
+                             header_elo(headers.get('BlackElo')), headers.get('Result')))
+                if len(rows) >= HEADER_INDEX_BATCH:
+                    self.conn.executemany('INSERT INTO games VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                    rows = []
+        self.conn.executemany('INSERT INTO games VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        self.conn.execute('INSERT INTO source VALUES (?, ?, ?)',
+                          (os.path.abspath(self.pgn_file), st.st_size, st.st_mtime_ns))
+        self.conn.commit()
+        print('Indexed %d games' % number)
+
+    def find(self, gameFilter, first_game=1, last_game=None):
+        """ Returns [(game number, byte offset)] of the games first_game to
+            last_game that match gameFilter
+        """
+        condition, params = gameFilter.where()
+        if last_game is None:
+            last_game = len(self)
+        return self.conn.execute('SELECT number, offset FROM games WHERE number BETWEEN ? AND ? '
+                                 'AND %s ORDER BY number' % condition,
+                                 [first_game, last_game] + params).fetchall()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM games').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+def indexed_games(pgn_file, index, gameFilter, first_game=1, last_game=None):
+    """ Yields (game number, game) of the games of the header index that
+        match gameFilter, every game is read from its offset so the other
+        games are not read at all
+    """
+    with open(pgn_file, 'rb') as raw:
+        for number, offset in index.find(gameFilter, first_game, last_game):
+            raw.seek(offset)
+            with METRICS.stage('pgn_read'):
+                game = chess.pgn.read_game(PgnLineReader(raw, offset), Visitor=MainlineVisitor)
+            if game is not None:
+                yield number, game
+
+
+class OffsetIndex(object):
+    """ Byte offsets of the games of an uncompressed pgn file. The index
+        file is OFFSET_INDEX_HEADER and an unsigned 64 bit offset per game
+        in the native byte order, then the size of the pgn file as the end
+        of the last game. It is built in one pass that skips the games
+        without parsing them, and it is memory-mapped, the offset of a
+        game is read without loading the index. It is rebuilt when the
+        size or the modification time of the pgn file changes.
+    """
+
+    def __init__(self, filename, pgn_file):
+        self.filename = filename
+        self.pgn_file = pgn_file
+        self.map = None
+        self.offsets = None
+        if not self.is_current():
+            self.build()
+        self.open()
+
+    def read_header(self):
+        """ Returns (pgn size, pgn mtime, games) of the index file or None """
+        try:
+            with open(self.filename, 'rb') as f:
+                data = f.read(OFFSET_INDEX_HEADER.size)
+        except (IOError, OSError):
+            return None
+        if len(data) < OFFSET_INDEX_HEADER.size:
+            return None
+        magic, size, mtime, games = OFFSET_INDEX_HEADER.unpack(data)
+        if magic != OFFSET_INDEX_MAGIC:
+            return None
+        return size, mtime, games
+
+    def is_current(self):
+        """ Returns True if the index is of the pgn file as it is now """
+        st = os.stat(self.pgn_file)
+        header = self.read_header()
+        return header is not None and header[:2] == (st.st_size, st.st_mtime_ns)\
+            and os.path.getsize(self.filename) == OFFSET_INDEX_HEADER.size + 8*(header[2] + 1)
+
+    def build(self):
+        """ Index every game of the pgn file """
+        print('Building offset index %s of %s' %(self.filename, self.pgn_file))
+        st = os.stat(self.pgn_file)
+        # Runs that share the index do not write the same tmp file
+        tmp_fn = '%s.%d.tmp' %(self.filename, os.getpid())
+        games = 0
+        with open(self.pgn_file, 'rb') as raw, open(tmp_fn, 'wb') as f:
+            f.write(OFFSET_INDEX_HEADER.pack(OFFSET_INDEX_MAGIC, st.st_size, st.st_mtime_ns, 0))
+            reader = PgnLineReader(raw)
+            offsets = array.array('Q')
+            while True:
+                offset = reader.offset
+                with METRICS.stage('pgn_read'):
+                    if not chess.pgn.skip_game(reader):
+                        break
+                offsets.append(offset)
+                games += 1
+                if len(offsets) >= HEADER_INDEX_BATCH:
+                    offsets.tofile(f)
+                    offsets = array.array('Q')
+            offsets.append(st.st_size)
+            offsets.tofile(f)
+            f.seek(0)
+            f.write(OFFSET_INDEX_HEADER.pack(OFFSET_INDEX_MAGIC, st.st_size, st.st_mtime_ns, games))
+        os.replace(tmp_fn, self.filename)
+        print('Indexed %d games' % games)
+
+    def open(self):
+        with open(self.filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.games = self.read_header()[2]
+        self.offsets = memoryview(self.map)[OFFSET_INDEX_HEADER.size:].cast('Q')
+
+    def offset(self, gameCnt):
+        """ Returns the byte offset of game number gameCnt, the offset of
+            game number len(self) + 1 is the end of the pgn file
+        """
+        return self.offsets[gameCnt - 1]
+
+    def __len__(self):
+        return self.games
+
+    def close(self):
+        if self.map is not None:
+            self.offsets.release()
+            self.map.close()
+            self.offsets = None
+            self.map = None
+
+
+def offset_games(pgn_file, index, gameFilter, first_game=1, last_game=None):
+    """ Yields (game number, game) of the games first_game to last_game
+        that match gameFilter, reading starts at the offset of first_game
+    """
+    if last_game is None:
+        last_game = len(index)
+    if first_game > last_game:
+        return
+    with open(pgn_file, 'rb') as raw:
+        raw.seek(index.offset(first_game))
+        reader = PgnLineReader(raw, index.offset(first_game))
+        for gameCnt, game in numbered_games(reader, gameFilter, first_game, last_game):
+            yield gameCnt, game
+
+
+class MmapPgn(object):
+    """ An uncompressed pgn file mapped in memory. The bytes of a game are
+        a memoryview of the map, chess.pgn reads its lines from the map
+        with MmapLineReader so the file is not read into a string or a
+        StringIO, the decoded line that chess.pgn parses is the only copy.
+    """
+
+    def __init__(self, pgn_file):
+        self.f = open(pgn_file, 'rb')
+        self.map = None
+        if os.fstat(self.f.fileno()).st_size:
+            self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map if self.map is not None else b'')
+
+    def close(self):
+        self.view.release()
+        if self.map is not None:
+            self.map.close()
+        self.f.close()
+
+
+class MmapLineReader(object):
+    """ Reads the lines of the bytes start to end of a MmapPgn for
+        chess.pgn, offset is the byte offset of the next line
+    """
+
+    def __init__(self, pgn_map, start, end):
+        self.pgn_map = pgn_map
+        self.offset = start
+        self.end = end
+
+    def readline(self):
+        if self.offset >= self.end:
+            return ''
+        newline = self.pgn_map.map.find(b'\n', self.offset, self.end)
+        stop = self.end if newline < 0 else newline + 1
+        line = str(self.pgn_map.view[self.offset:stop], 'utf-8', 'replace')
+        self.offset = stop
+        return line
+
+
+def mmap_games(pgn_map, index, gameFilter=None, first_game=1, last_game=None):
+    """ Yields (game number, game) of the games first_game to last_game of
+        a MmapPgn that match gameFilter. The games are the slices between
+        the offsets of the offset index, so they are split by chess.pgn
+        like the other readers. A game that can not match the filter is
+        skipped on its raw bytes without decoding it.
+    """
+    if last_game is None:
+        last_game = len(index)
+    if gameFilter is not None and gameFilter.is_empty():
+        gameFilter = None
+    visitor = functools.partial(MainlineVisitor, gameFilter)
+    for gameCnt in range(first_game, last_game + 1):
+        start, end = index.offset(gameCnt), index.offset(gameCnt + 1)
+        if gameFilter is not None and not gameFilter.may_match(pgn_map.view, start, end):
+            continue
+        with METRICS.stage('pgn_read'):
+            game = chess.pgn.read_game(MmapLineReader(pgn_map, start, end), Visitor=visitor)
+        if game is not None and not game.skipped:
+            yield gameCnt, game
+
+
+def parse_game_range(text):
+    """ Returns (first game, last game) of a --game-range value, first-last,
+        first-, -last or one game number. last is None if it is open.
+    """
+    first, sep, last = text.partition('-')
+    first = int(first) if first.strip() else 1
+    if not sep:
+        last = first
+    else:
+        last = int(last) if last.strip() else None
+    if first < 1 or (last is not None and last < first):
+        raise ValueError('bad game range %s' % text)
+    return first, last
+
+
+def parse_shard(text):
+    """ Returns (shard number, number of shards) of a --shard value i/N """
+    shard, sep, shards = text.partition('/')
+    shard, shards = int(shard), int(shards)
+    if not 1 <= shard <= shards:
+        raise ValueError('bad shard %s' % text)
+    return shard, shards
+
+
+def shard_range(first_game, last_game, shard, shards):
+    """ Returns (first game, last game) of a shard of the games first_game
+        to last_game, the shards are consecutive slices of the same size
+        so their outputs merge back in the order of the games
+    """
+    count = last_game - first_game + 1
+    return (first_game + count*(shard - 1)//shards,
+            first_game + count*shard//shards - 1)
+
+
+def shard_output_name(outputFN, shard, shards):
+    """ Returns the output filename of a shard """
+    base, ext = os.path.splitext(outputFN)
+    return '%s.shard%dof%d%s' %(base, shard, shards, ext)
+
+
+def merge_shard_outputs(outputFN, shards):
+    """ Write the outputs of shards 1 to shards to outputFN in order,
+        returns False if a shard output is missing
+    """
+    shard_fns = [shard_output_name(outputFN, n, shards) for n in range(1, shards + 1)]
+    missing = [fn for fn in shard_fns if not os.path.isfile(fn)]
+    if missing:
+        print('Error!! missing shard output %s' % ', '.join(missing))
+        return False
+    with open(outputFN + '.tmp', 'wb') as f:
+        for fn in shard_fns:
+            with open(fn, 'rb') as shard_f:
+                shutil.copyfileobj(shard_f, f)
+    os.replace(outputFN + '.tmp', outputFN)
+    print('Merged %d shard outputs to %s' %(shards, outputFN))
+    return True
+
+
+def annotate_games_parallel(games, opts, nJobs, write_game, annotate_fn=None):
+    """ Analyze games on nJobs threads, each job borrows its own engine
+        from the pool. games are (game number, game) pairs. write_game is
+        called with the game number and the annotated game, None if the
+        game is skipped, in the same order as the input games.
+        annotate_fn is called instead of annotate_game() if it is given.
+    """
+    if annotate_fn is None:
+        annotate_fn = annotate_game
+    pending = collections.deque()
+
+    def write_first():
+        gameCnt, future = pending.popleft()
+        write_game(gameCnt, future.result())
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nJobs) as executor:
+        for gameCnt, game in games:
+            pending.append((gameCnt, executor.submit(annotate_fn, game, gameCnt, opts)))
+            # Limit the games held in memory, and write the finished ones
+            while len(pending) >= 2*nJobs or (pending and pending[0][1].done()):
+                write_first()
+        while pending:
+            write_first()
+
+
+class PlyPosition(object):
+    """ A position of the main line of a game and its game move, with the
+        san and fen that annotate_ply() needs. board is a copy without
+        the move stack, it is shared by the ply jobs of the game and only
+        read, annotate_ply() works on its own copies of it.
+    """
+
+    def __init__(self, board, move, parent=None):
+        self.board = board.copy(stack=False)
+        self.move = move
+        self.parent = parent
+        self.turn = board.turn
+        self.fullmove_number = board.fullmove_number
+        self.san = board.san(move)
+        self.fen = board.fen()
+
+
+def game_positions(game):
+    """ Returns the PlyPositions of the main line of a game, the moves
+        are pushed on one board instead of replaying the game for every
+        position
+    """
+    positions = []
+    board = game.board()
+    parent = None
+    for move in game.mainline_moves():
+        parent = PlyPosition(board, move, parent)
+        positions.append(parent)
+        board.push(move)
+    return positions
+
+
+class PlyAnnotation(object):
+    """ The annotated text of one game move and what it adds
+        to the game summary
+    """
+
+    def __init__(self, side):
+        self.side = side
+        self.f = StringIO()
+        self.move_nag = None
+        self.model_white = True
+        self.model_black = True
+
+
+def annotate_ply(position, gameCnt, maxMoveNum, wplayer, bplayer, opts, budget=None,
+                 memo=None):
+    """ Analyze the game move played from the PlyPosition and returns
+        its PlyAnnotation. The engine time is taken from the GameBudget
+        if one is given, otherwise every search gets nMoveTime.
+        memo is the SearchMemo of the game
+    """
+    sEngine = opts.sEngine
+    eng_option = opts.eng_option
+    nMoveTime = opts.nMoveTime
+    nshortPv = opts.nshortPv
+    startFmvn = opts.startFmvn
+    lastFmvn = opts.lastFmvn
+    option_use_book = opts.option_use_book
+    book_fn = opts.book_fn
+    book = opts.book
+    option_add_variation_margin = opts.option_add_variation_margin
+    option_player = opts.option_player
+    lang = opts.lang
+    option_use_cerebellum_book = opts.option_use_cerebellum_book
+    option_book_anno_only = opts.option_book_anno_only
+    nMultiPv = 1
+
+    side = position.turn
+    ply = PlyAnnotation(side)
+    f = ply.f
+
+    fmvn = position.fullmove_number
+    
+    move = position.move
+    uci_game_move = str(move)
+    
+    sanMove = position.san
+
+    strFEN = position.fen
+
+    # The boards of the positions are shared by the ply jobs, this job
+    # works on its own copies so they are only read
+    board = position.board.copy(stack=False)
+    parentBoard, parentMove = None, None
+    if position.parent is not None:
+        parentBoard = position.parent.board.copy(stack=False)
+        parentMove = position.parent.move
+
+    # Show game num and fen in console
+    print('Game: %d, maxMoveNum: %d' %(gameCnt, maxMoveNum))
+    print('FEN: %s' %(strFEN))
+    print('Player move: %s' %(sanMove))
+
+    # Init
+    threat_depth = 0
+    threatValue = BAD_SCORE
+    anaValue = BAD_SCORE
+    anaValue2 = BAD_SCORE
+    gameMoveValue = BAD_SCORE
+    anaPvMove = "None"
+    isOnlyMove = False
+    moveChanges = 0
+    writeAnalyzerBestLine = False
+    moveIsInPolyglotBook = False
+    moveIsInCereBook = False
+    anaPv2Len = 0
+    
+    if option_player != None and ((option_player == wplayer and not side)\
+                                  or (option_player == bplayer and side)):
+        if side == WHITE:
+            f.write('%d. %s ' %(fmvn, sanMove))
+        else:
+            f.write('%s ' %(sanMove))
+        return ply
+
+    # Probe polyglot book, don't analyze if a game move is in the book
+    if option_use_book:
+        book_moves = book.book_moves(board)
+        bestPolyBookMove = book_moves[0] if book_moves else None
+        moveIsInPolyglotBook = uci_game_move in book_moves
+
+        if moveIsInPolyglotBook:
+            if side == WHITE:
+                f.write('%d. %s {%s %s} ' %(fmvn, sanMove,
+                                            MOVE_FROM_COMMENT[lang], book_fn))
+            else:
+                f.write('%d...%s {%s %s} ' %(fmvn, sanMove,
+                                             MOVE_FROM_COMMENT[lang], book_fn))
+            return ply
+        
+        elif bestPolyBookMove is not None:
+            san_move = board.san(board.parse_uci(bestPolyBookMove))
+            book_comment = '%s %s %s' %(book_fn, BOOK_RECOMMENDS_COMMENT[lang], san_move)
+            if side == WHITE:
+                f.write('%d. %s {%s} ' %(fmvn, sanMove, book_comment))
+            else:
+                f.write('%d...%s {%s} ' %(fmvn, sanMove, book_comment))
+            return ply
+        
+    # Use cerebellum book
+    elif option_use_cerebellum_book:
+        moveTimeMs = 100
+        multiPVNum = 1
+        pvLenNum = 1
+        bestmove, validCereBook = get_cerebellum_book_move(sEngine,
+                strFEN, eng_option, moveTimeMs, multiPVNum, pvLenNum, gameCnt)
+        if bestmove == uci_game_move and validCereBook:
+            moveIsInCereBook = True
+
+        if moveIsInCereBook:
+            if side == WHITE:
+                f.write('%d. %s {%s cerebellum} ' %(fmvn, sanMove, MOVE_FROM_COMMENT[lang]))
+            else:
+                f.write('%d...%s {%s cerebellum} ' %(fmvn, sanMove, MOVE_FROM_COMMENT[lang]))
+            return ply
+        elif validCereBook:
+            san_move = board.san(board.parse_uci(bestmove))
+            book_comment = 'Cerebellum %s %s' %(BOOK_RECOMMENDS_COMMENT[lang], san_move)
+            if side == WHITE:
+                f.write('%d. %s {%s} ' %(fmvn, sanMove, book_comment))
+            else:
+                f.write('%d...%s {%s} ' %(fmvn, sanMove, book_comment))
+            return ply
+
+    # If book annotation only
+    if option_book_anno_only:
+        if side == WHITE:
+            f.write('%d. %s ' %(fmvn, sanMove))
+        else:
+            f.write('%s ' %(sanMove))
+        return ply
+
+    # Analyze pos if fmvn is within startFmvn and lastFmvn input from user
+    if fmvn >= startFmvn and fmvn <= lastFmvn:
+
+        # (0) Get the score of the game move by running the engine.
+        # Invert the score after the analysis since we are analyzing fen + move,
+        # and invert the score if current side is black too
+        # because we use white POV (point of view) and engine is analyzing at side POV
+
+        # Use temp so we will not mess with the current board
+        tempBoard = board.copy(stack=False)
+        tempBoard.push(move)  # make the move on the temp board
+
+        # Forced and trivial positions are annotated without the engine
+        positionClass = classify_position(board, move)
+        if positionClass is not None:
+            METRICS.count(positionClass)
+            if positionClass == MATE_MOVE:
+                # The game move mates, only the decisive NAG of the mate
+                moveComment = '%s ' % ('$18' if side == WHITE else '$19')
+            elif positionClass == DEAD_DRAW:
+                # No search was run, the score has no depth
+                moveComment = '%s {%+0.2f} ' %(position_nags(0.0), 0.0)
+            else:
+                # $7 = Singular move comment, the only legal move
+                moveComment = '$7 '
+            if side == WHITE:
+                f.write('%d. %s %s' %(fmvn, sanMove, moveComment))
+            else:
+                f.write('%s %s' %(sanMove, moveComment))
+            return ply
+
+        # In the game budget mode, positions next to the book get half
+        # the time
+        budgetFactor = 1.0
+        if budget is not None and option_use_book and parentBoard is not None\
+                and book.book_moves(parentBoard):
+            budgetFactor = 0.5
+
+        # Don't send position to analyze without a legal move
+        if not board.is_checkmate()\
+               and not board.is_stalemate()\
+               and not tempBoard.is_checkmate()\
+               and not tempBoard.is_stalemate():
+            tFEN = str(tempBoard.fen())  
+
+            # Get the score/depth pv <moves> in a list, list[0] = 1st pv,
+            # The expected return value is,
+            # "+0.89/11 32. Nc6 Nh5 33. Qf2 Qd1 34. Nb4", for nshortPv = 5.
+            # This is the same search as (2) of the next ply
+            gameMoveAnalysisList = analyze_position(tFEN, board, move,
+                                                    gameCnt, opts, budget, memo)[0]
+
+            # If engine does not return a search info then just write the move
+            # This happens when the engine used is using its own book
+            if gameMoveAnalysisList is None:
+                if side == WHITE:
+                    f.write('%d. %s {No search output from Annotator} ' %(fmvn, sanMove))
+                else:
+                    f.write('%d...%s {No search output from Annotator} ' %(fmvn, sanMove))
+                return ply
+
+            gameMoveAnalysis = gameMoveAnalysisList[0]
+            
+            # The return value is from the point of view of the opponent,
+            # so we must negate it before comparing with engine analysis score
+            # gameMoveValue is in pawn unit and is of type float, it is also WPOV
+            gameMoveValue, gameMoveDepth = get_score_and_depth(gameMoveAnalysis, side)
+
+            # Write to console as update
+            print('Engine analysis of player move: %+0.2f/%d\n'\
+                      %(gameMoveValue, gameMoveDepth))
+            
+        # Analyze position to get engine recommendation
+
+        # (1) Get complexity of the position, the number of best move
+        # changes is counted in the search of (2)
+        complexityCheck = False
+        if gameMoveValue != BAD_SCORE and (gameMoveValue > -0.15 and side == WHITE)\
+                   or (gameMoveValue < 0.15 and side == BLACK):
+            complexityCheck = True
+
+        # (2) Get the engine analysis when engine is to move in this position,
+        # it was already searched in (0) of the previous ply
+        if not board.is_checkmate()\
+                   and not board.is_stalemate():
+            analysisList, anaTimer = analyze_position(strFEN, parentBoard, parentMove,
+                                                      gameCnt, opts, budget, memo)
+            if complexityCheck:
+                moveChanges = anaTimer.moveChanges
+
+            # If engine does not return a search info then just write the move
+            # This happens when the engine used is using its own book
+            if analysisList is None:
+                if side == WHITE:
+                    f.write('%d. %s {No search output from Annotator} ' %(fmvn, sanMove))
+                else:
+                    f.write('%d...%s {No search output from Annotator} ' %(fmvn, sanMove))
+                return ply
+
+            # Get score, depth, and pv of the 1st pv line from multipv
+            # anaValue is white POV
+            analysisData = analysisList[0]
+            anaValue, anaDepth, anaPvMove, anaPv = get_engine_detailed_data(analysisData, side)
+
+            # Add model comment if there is no blunder
+            if (anaValue - gameMoveValue > MODEL_GAME_MARGIN) and side==WHITE:
+                ply.model_white = False
+            elif (anaValue - gameMoveValue < -MODEL_GAME_MARGIN) and side==BLACK:
+                ply.model_black = False
+            
+            # Get score, depth and pv of the 2nd pv if there is
+            # There is a possibility that a multi pv will not return 2nd pv
+            if len(analysisList) > 1:
+                analysisData2 = analysisList[1]
+                anaValue2, anaDepth2, anaPvMove2,\
+                           anaPv2 = get_engine_detailed_data(analysisData2, side)
+                
+                anaPv2List = anaPv2.split(' ')
+                anaPv2Len = len(anaPv2List)
+                # print('pv: %s, len %d' %(anaPv2, anaPv2Len))
+
+        # If move is singular
+        isOnlyMove = OnlyMove(side, anaPvMove, sanMove, anaValue, anaValue2)
+
+        # (3) Check if analyzer best line is to be appended to the game
+        # ANALYSIS_MARGIN = 10.0 pawns
+        if anaPvMove == sanMove or gameMoveValue == BAD_SCORE or anaValue == BAD_SCORE\
+                or (abs(gameMoveValue) >= ANALYSIS_MARGIN and abs(anaValue) >= ANALYSIS_MARGIN)\
+                or ((anaValue - gameMoveValue < option_add_variation_margin and side == WHITE) or\
+                (anaValue - gameMoveValue > -option_add_variation_margin and side == BLACK)):
+            writeAnalyzerBestLine = False
+        else:
+            writeAnalyzerBestLine = True
+
+            # Find the threat of the last move of opp by doing a null move
+            # from this current position. If this value is positive then
+            # the current side to move is in trouble because by doing
+            # nothing the opponent gains score. This will also detect initiative
+            if not board.is_check() and not board.is_stalemate():
+                tempBoardt = board.copy(stack=False)
+                tempBoardt.push(move.null())  # Send null move
+                tFENt = str(tempBoardt.fen())  
+                nMultiPv = 1
+                threatTimer = None
+                if budget is not None:
+                    threatTimer = budget.timer(nMultiPv, 0.5*budgetFactor)
+                gameMoveThreatList = analyze_fen(sEngine, tFENt, eng_option,\
+                                                 nMoveTime, nMultiPv, nshortPv, gameCnt,
+                                                 threatTimer)
+                if threatTimer is not None:
+                    budget.charge(threatTimer)
+                if gameMoveThreatList is not None:
+                    gameMoveThreat = gameMoveThreatList[0]
+                    # gameMoveThreat = +0.00/20 27.Rc4 b6 28.Rc3 Rh1 29.a4 Rh2+ 30.Kf3
+                    threatPvStr = gameMoveThreat.split(' ')
+                    tpvlen = len(threatPvStr)
+                    # Display odd number of moves in the pv, the first item in threatPvStr is score/depth
+                    if tpvlen >= 3:
+                        if tpvlen%2 == 0:
+                            threatPv = ' '.join(threatPvStr[1:])
+                        else:
+                            threatPv = ' '.join(threatPvStr[1:-1])
+                    else:
+                        threatPv = ' '.join(threatPvStr[1:])
+                    threatEval = threatPvStr[0]
+                    threatEvalSplit = threatEval.split('/')
+                    threatValue = float(threatEvalSplit[0])
+                    threat_depth = int(threatEvalSplit[1])                            
+
+    # (4) (a) Write singular move symbol or (b) alternative bad lines
+    # or (c) good or very good move symbols to a game move
+    if not writeAnalyzerBestLine:
+        # If position is complex
+        if anaPvMove == sanMove and abs(anaValue) < +6.0\
+                and abs(anaValue2) < +6.0:
+            # If moveChanges is high add !! to the gameMoveNag, if low just add !
+            gameMoveNag = None
+            if moveChanges >= 5 and abs(gameMoveValue) >= +1.0:
+                gameMoveNag = '$3'
+            elif moveChanges >= 3 and abs(gameMoveValue) >= +1.0:
+                gameMoveNag = '$1'
+            writeInferiorLine = False
+            # Write inferior line if pv2 score is not too close and not too far from pv1 score
+            if (side == WHITE and anaValue - anaValue2 >= +option_add_variation_margin\
+                    and anaValue - anaValue2 < (+3.0 + option_add_variation_margin)) or\
+                    (side == BLACK and anaValue - anaValue2 <= -option_add_variation_margin\
+                     and anaValue - anaValue2 > (-3.0 - option_add_variation_margin)):
+                writeInferiorLine = True
+                posNag = position_nags(anaValue2)
+                gamePosNag = position_nags(gameMoveValue)
+                pv2MoveNag = one_value_move_nags(side, anaValue2)
+                if pv2MoveNag is not None:
+                    # Get the move in pv2 and add a NAG
+                    anaPv2Rev = anaPv2.split(' ')
+                    # There must be more than 1 move in pv
+                    if len(anaPv2Rev) >= 2:
+                        pv2_move = anaPv2Rev[0]
+                        pv2_move = pv2_move + ' ' + pv2MoveNag  + ' { ' + random_reason(lang) + ' } '
+                        mvRem = ' '.join(anaPv2Rev[1:-1])
+                        newAnaPv2 = pv2_move + ' ' + mvRem
+                        # Get random bad comment and append it before the pv2
+                        badComment = random_bad(lang)
+                        # Write the bad variation depends on white and black
+                        if gameMoveNag is None:
+                            if side == WHITE:
+                                f.write('%d. %s %s {%+0.2f/%d} ({%s} %s %s {%+0.2f/%d}) '\
+                                        %(fmvn, sanMove,
+                                        gamePosNag, gameMoveValue, gameMoveDepth,
+                                        badComment,
+                                        newAnaPv2, posNag, anaValue2, anaDepth2))
+                            else:
+                                f.write('%s %s {%+0.2f/%d} ({%s} %s %s {%+0.2f/%d}) '\
+                                        %(sanMove,
+                                        gamePosNag, gameMoveValue, gameMoveDepth,
+                                        badComment,
+                                        newAnaPv2, posNag, anaValue2, anaDepth2))
+                        else:
+                            if side == WHITE:
+                                f.write('%d. %s %s %s {%+0.2f/%d} ({%s} %s %s {%+0.2f/%d}) '\
+                                        %(fmvn, sanMove,
+                                        gameMoveNag, gamePosNag, gameMoveValue, gameMoveDepth,
+                                        badComment,
+                                        newAnaPv2, posNag, anaValue2, anaDepth2))
+                            else:
+                                f.write('%s %s %s {%+0.2f/%d} ({%s} %s %s {%+0.2f/%d}) '\
+                                        %(sanMove,
+                                        gameMoveNag, gamePosNag, gameMoveValue, gameMoveDepth,
+                                        badComment,
+                                        newAnaPv2, posNag, anaValue2, anaDepth2))                                
+            # if writing inferior line is not possible
+            if not writeInferiorLine or pv2MoveNag is None or len(anaPv2Rev) < 2:
+                if gameMoveNag is None:
+                    if side == WHITE:
+                        f.write('%d. %s ' %(fmvn, sanMove))
+                    else:
+                        f.write('%s ' %(sanMove))
+                else:
+                    if side == WHITE:
+                        f.write('%d. %s %s ' %(fmvn, sanMove, gameMoveNag))
+                    else:
+                        f.write('%s %s ' %(sanMove, gameMoveNag))
+        # else if easy move
+        else:
+            if isOnlyMove:
+                assert anaPvMove == sanMove
+                # $7 = Singular move comment
+                if side == WHITE:
+                    f.write('%d. %s %s ' %(fmvn, sanMove, "$7"))
+                else:
+                    f.write('%s %s ' %(sanMove, "$7"))
+            else:  # Write the game move only
+                if side == WHITE:
+                    f.write('%d. %s ' %(fmvn, sanMove))
+                else:
+                    f.write('%s ' %(sanMove))
+
+    # Else write the pv as suggested by the engine      
+    else:
+        assert writeAnalyzerBestLine
+        # Get position NAG for pv. The pv is a line based from engine
+        PvPosNag = position_nags(anaValue)                
+        # Get move NAG for game move
+        assert sanMove != anaPvMove
+        gameMoveNag = move_nags(side, anaValue, gameMoveValue)                
+        # Get position NAG for position after this game move
+        gamePosNag = position_nags(gameMoveValue)
+        # Select a comment based on difference between engine score and game move score
+        goodComment = get_good_comment(anaValue, gameMoveValue, side, lang)
+        # If game move pos assessment is a mate due to perhaps of
+        # a blunder then show +/-M, instead of score/depth
+        move_score_val = "%+0.2f" % gameMoveValue
+        posGameMoveComment = str(move_score_val) + '/' + str(gameMoveDepth)                  
+        if (int(100*gameMoveValue) >= INF-MAX_PLY) or (int(100*gameMoveValue) <= -INF+MAX_PLY):
+            assert gameMoveValue != BAD_SCORE
+            num_mate = value_to_mate(100*gameMoveValue)
+            assert num_mate != 0
+            smate = mate_indicator(num_mate)
+            posGameMoveComment = smate
+        # If pv1 score is a mate then show +/-M, instead of score/depth
+        pv1_score_val = "%+0.2f" % anaValue
+        posPv1Comment = str(pv1_score_val) + '/' + str(anaDepth)
+        pv1MateScore = False
+        if (int(100*anaValue) >= INF-MAX_PLY and side == WHITE) or\
+                   (int(100*anaValue) <= -INF+MAX_PLY and side == BLACK):
+            assert anaValue != BAD_SCORE
+            num_mate = value_to_mate(100*anaValue)
+            assert num_mate != 0
+            smate = mate_indicator(num_mate)                        
+            posPv1Comment = smate
+            pv1MateScore = True                      
+        # Break down the pv to get the first move
+        pv1_split = anaPv.split(' ')
+        # Get the first move in the pv including the move number
+        pv1_move = pv1_split[0]
+        # Insert the pv1_move_nag after the first move
+        if pv1MateScore:
+            new_mv = pv1_move + ' ' + '{with mate attack} '
+        else:
+            new_mv = pv1_move + ' '
+        # Reconstruct the pv line
+        new_anaPv = new_mv + ' '.join(pv1_split[1:])
+        # Write the game move and pv variation
+        if side == WHITE:
+            if pv1MateScore:
+                if gameMoveNag is None:
+                    f.write('\n%d. %s %s {%s} ({%s} %s %s) '\
+                            %(fmvn, sanMove,
+                            gamePosNag, posGameMoveComment,
+                            goodComment, new_anaPv, PvPosNag))
+                else:
+                    f.write('\n%d. %s %s %s {%s} ({%s} %s %s) '\
+                        %(fmvn, sanMove, gameMoveNag,
+                        gamePosNag, posGameMoveComment,
+                        goodComment, new_anaPv, PvPosNag))
+            else:
+                if gameMoveNag is None:
+                    f.write('\n%d. %s %s {%s} ({%s} %s %s {%s}) '\
+                        %(fmvn, sanMove,
+                        gamePosNag, posGameMoveComment,
+                        goodComment, new_anaPv, PvPosNag, posPv1Comment))
+                else: 
+                    f.write('\n%d. %s %s %s {%s} ({%s} %s %s {%s}) '\
+                            %(fmvn, sanMove, gameMoveNag,
+                            gamePosNag, posGameMoveComment,
+                            goodComment, new_anaPv, PvPosNag, posPv1Comment))
+        else:  # side is black
+            if pv1MateScore:
+                if gameMoveNag is None:
+                    f.write('\n%d... %s %s {%s} ({%s} %s %s) '\
+                            %(fmvn, sanMove,
+                            gamePosNag, posGameMoveComment,
+                            goodComment, new_anaPv, PvPosNag))
+                else:
+                    f.write('\n%d... %s %s %s {%s} ({%s} %s %s) '\
+                            %(fmvn, sanMove, gameMoveNag,
+                            gamePosNag, posGameMoveComment,
+                            goodComment, new_anaPv, PvPosNag))
+            else:
+                if gameMoveNag is None:                                    
+                    f.write('\n%d... %s %s {%s} ({%s} %s %s {%s}) '\
+                            %(fmvn, sanMove,
+                            gamePosNag, posGameMoveComment,
+                            goodComment, new_anaPv, PvPosNag, posPv1Comment))
+                else:
+                    f.write('\n%d... %s %s %s {%s} ({%s} %s %s {%s}) '\
+                        %(fmvn, sanMove, gameMoveNag,
+                        gamePosNag, posGameMoveComment,
+                        goodComment, new_anaPv, PvPosNag, posPv1Comment))
+
+        # If the game move is not the same to that of pv2 move then write it as variation,
+        # depending on the pv2 score and game move score
+        if anaPvMove2 != sanMove and anaValue2 != BAD_SCORE and anaPv2Len >= 2:                        
+            # Get pos nag of pv2
+            pv2PosNag = position_nags(anaValue2)
+                
+            # If pv2 score is equal or better than the game move score then write
+            # it as a playable alternative line
+            if (side == WHITE and anaValue2 >= gameMoveValue) or\
+                       (side == BLACK and anaValue2 <= gameMoveValue):
+                if (side == WHITE and anaValue2 >= -ONLY_MOVE_SCORE) or\
+                           (side == BLACK and anaValue2 <= +ONLY_MOVE_SCORE):
+                        
+                    # If pv1 showed that this has a mate score then check
+                    # if pv2 is also showing mate score, otherwise cut the pv2 length
+                    # to nshortPv = 7 plies, as we know we extend the pv length
+                    # when there is a mate score from pv1
+                    if (int(100*anaValue2) >= INF-MAX_PLY and side == WHITE) or\
+                           (int(100*anaValue2) <= -INF+MAX_PLY and side == BLACK):
+
+                        # Convert score to mate number
+                        num_mate = value_to_mate(100*anaValue2)
+                        assert num_mate != 0
+                        smate = mate_indicator(num_mate)
+                        posPv2Comment = smate
+                        com_val = ALTERNATIVE_MARK
+                        f.write('\n({ %s } %s %s {%s}) '\
+                                %(com_val, anaPv2, pv2PosNag, posPv2Comment))
+                    else:
+                            
+                        # Else if not mate score Reduce the pv length to nshortPv = 7 plies (default)
+                        new_ana_pv2 = anaPv2.split(' ')
+                        new_ana_pv2 = ' '.join(new_ana_pv2[:nshortPv])
+                        com_val = ALTERNATIVE_MARK
+                        f.write('\n({ %s } %s %s {%+0.2f/%d}) '\
+                            %(com_val, new_ana_pv2, pv2PosNag, anaValue2, anaDepth2))
+            # else if pv2MoveScore < gameMoveScore
+            else:
+                # Add move nag to the first move of pv2
+                anaPv2MoveNag = one_value_move_nags(side, anaValue2)
+                if anaPv2MoveNag is not None:                                
+                    # new_ana_pv2 = anaPv2.split(' ')
+                    anaPv2List = anaPv2.split(' ')
+                    anaPv2WithReason = anaPvMove2 + ' %s { %s } ' % (anaPv2MoveNag, random_reason(lang))
+                    # Cut 1 ply at end of pv, to emphasize that the other side is the last mover
+                    newAnaPv2 = anaPv2WithReason + ' '.join(anaPv2List[1:-1])
+                    badComment = random_bad(lang)
+                    f.write('\n({ %s } %s %s {%+0.2f/%d}) '\
+                            %(badComment,
+                              newAnaPv2, pv2PosNag, anaValue2, anaDepth2))
+        # Print the threat pv if score of opponent or last move is good
+        if threatValue > 0.0 and threatValue != BAD_SCORE:                        
+            # Translate threatValue to white pov
+            # Use side == WHITE because we do a null move
+            wpov_threatValue = threatValue
+            if side == WHITE:
+                wpov_threatValue = -1*threatValue
+            if int(100*threatValue) >= +INF-MAX_PLY:
+                num_mate = value_to_mate(100*threatValue)
+                if side == WHITE:
+                    f.write('\n({%s %d} %d. %s %s) '\
+                            %(BLACK_MATE_THREAT_COMMENT[lang], abs(num_mate), fmvn, '--', threatPv))
+                else:
+                    f.write('\n({%s %d} %d... %s %s) '\
+                            %(WHITE_MATE_THREAT_COMMENT[lang], abs(num_mate), fmvn, '--', threatPv))
+            else:
+                posNag = position_nags(wpov_threatValue)
+                if side == WHITE:
+                    f.write('\n({%s} %d. %s %s %s {%+0.2f/%d}) '\
+                            %(BLACK_THREAT_COMMENT[lang], fmvn, '--',
+                              threatPv, posNag, wpov_threatValue, threat_depth))
+                else:
+                    f.write('\n({%s} %d... %s %s %s {%+0.2f/%d}) '\
+                            %(WHITE_THREAT_COMMENT[lang], fmvn, '--',
+                              threatPv, posNag, wpov_threatValue, threat_depth))
+
+    # Record blunders and mistakes for summary
+    if anaPvMove != sanMove and writeAnalyzerBestLine:
+        ply.move_nag = move_nags(side, anaValue, gameMoveValue)
+
+    return ply
+
+
+def annotate_game(game, gameCnt, opts):
+    """ Analyze a single game and returns the annotated game as a string.
+        Returns None if the game is skipped.
+        opts is the AnnotatorOptions of the run
+    """
+    engine_id = opts.engine_id
+    nThreads = opts.nThreads
+    nMoveTime = opts.nMoveTime
+    lastFmvn = opts.lastFmvn
+    option_player = opts.option_player
+    lang = opts.lang
+    option_book_anno_only = opts.option_book_anno_only
+    alt_index = 0
+    f = StringIO()
+    t0 = time.perf_counter()
+
+    Blunder = {}
+    Mistake = {}
+    Dubious = {}        
+    Blunder['white'] = 0
+    Blunder['black'] = 0
+    Mistake['white'] = 0
+    Mistake['black'] = 0
+    Dubious['white'] = 0
+    Dubious['black'] = 0
+
+    if option_book_anno_only:
+        modelGameWhite = False
+        modelGameBlack = False
+    else:
+        modelGameWhite = True
+        modelGameBlack = True            
+
+    # Randomize alternate comment
+    ALTER_COM = random_alternative(lang)
+
+    # Save result header for writing at end of a game
+    try:
+        hre = game.headers['Result']
+    except:
+        hre = '*'
+
+    wplayer = game.headers['White']
+    bplayer = game.headers['Black']
+
+    # Skip this game if player is not in the game
+    if option_player != None and option_player != wplayer\
+           and option_player != bplayer:
+        return None
+
+    # A model game comment can only be added for analyzed side
+    if option_player != None and option_player == wplayer:
+        modelGameBlack = False
+    elif option_player != None and option_player == bplayer:
+        modelGameWhite = False
+
+    # Save headers to output file
+    save_headers(game, f, engine_id, nThreads,
+                 nMoveTime)  
+
+    # The positions of the main line, made on one board
+    positions = game_positions(game)
+    maxMoveNum = positions[-1].fullmove_number if positions else 0
+    
+    # Engine time of this game in the game budget mode,
+    # shared by the positions that will be analyzed
+    budget = None
+    if opts.gameBudget is not None:
+        numPlies = sum(1 for position in positions
+                       if opts.startFmvn <= position.fullmove_number <= lastFmvn)
+        budget = GameBudget(opts.gameBudget, numPlies)
+
+    # The position after a game move is searched once for two plies
+    memo = SearchMemo()
+
+    def annotate_node(position):
+        with METRICS.game(gameCnt):
+            ply = annotate_ply(position, gameCnt, maxMoveNum, wplayer, bplayer, opts, budget,
+                               memo)
+            METRICS.count('plies')
+        if budget is not None:
+            budget.ply_done()
+        return ply
+
+    # Analyze the positions of this game concurrently
+    if opts.nPlyJobs > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=opts.nPlyJobs) as executor:
+            plies = list(executor.map(annotate_node, positions))
+    else:
+        plies = [annotate_node(position) for position in positions]
+
+    if budget is not None:
+        print('Game: %d, engine time used: %0.1fs of %0.1fs'
+              %(gameCnt, budget.used_ms()/1000.0, budget.total_ms/1000.0))
+
+    # Loop thru the main moves and comments on this game
+    for ply in plies:
+        # Alternative comments are taken in move order
+        ply_parts = ply.f.getvalue().split(ALTERNATIVE_MARK)
+        f.write(ply_parts[0])
+        for part in ply_parts[1:]:
+            com_val, alt_index = get_alternative_comment(ALTER_COM, alt_index, lang)
+            f.write(com_val + part)
+
+        if not ply.model_white:
+            modelGameWhite = False
+        if not ply.model_black:
+            modelGameBlack = False
+
+        # Record blunders and mistakes for summary
+        side = ply.side
+        mnag = ply.move_nag
+        # $4=??, $2=?, $6=?!
+        if side and mnag == '$4':
+            Blunder['white'] += 1
+        elif side and mnag == '$2':
+            Mistake['white'] += 1
+        elif side and mnag == '$6':
+            Dubious['white'] += 1
+
+        elif not side and mnag == '$4':
+            Blunder['black'] += 1
+        elif not side and mnag == '$2':
+            Mistake['black'] += 1
+        elif not side and mnag == '$6':
+            Dubious['black'] += 1
+
+    # Print result at the end of notation
+    # Add mode game comment only when all moves are analyzed
+    if lastFmvn >= maxMoveNum:
+        if modelGameWhite and modelGameBlack:
+            f.write('{%s}\n' %(WHITE_BLACK_MODEL_COMMENT[lang]))
+        elif modelGameWhite:
+            f.write('{%s}\n' %(WHITE_MODEL_COMMENT[lang]))
+        elif modelGameBlack:
+            f.write('{%s}\n' %(BLACK_MODEL_COMMENT[lang]))
+    # f.write('{WhiteBlunder: %d, BlackBlunder: %d}\n' %(Blunder['white'], Blunder['black']))
+    f.write('{WBlunder: %d, WMistake: %d, WDubious: %d, BBlunder: %d, BMistake: %d, BDubious: %d} %s\n\n'\
+                    %(Blunder['white'], Mistake['white'], Dubious['white'],
+                      Blunder['black'], Mistake['black'], Dubious['black'], hre))
+
+    with METRICS.game(gameCnt):
+        METRICS.add_time('game', time.perf_counter() - t0)
+    if opts.metrics_fn is not None:
+        print(metrics_text(METRICS.game_summary(gameCnt), 'Game: %d, stage times' % gameCnt))
+
+    return f.getvalue()
+
+
+def run_profiled(profiler, filename, fn):
+    """ Returns fn() called under the profiler, cprofile or pyinstrument.
+        The profile is saved to filename and a short report is printed.
+    """
+    if profiler == 'cprofile':
+        prof = cProfile.Profile()
+        try:
+            return prof.runcall(fn)
+        finally:
+            prof.dump_stats(filename)
+            pstats.Stats(prof).sort_stats('cumulative').print_stats(25)
+            print('Profile saved to %s' % filename)
+
+    # pyinstrument is optional
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        print('Warning!! pyinstrument is not installed, the run is not profiled')
+        return fn()
+    prof = Profiler()
+    prof.start()
+    try:
+        return fn()
+    finally:
+        prof.stop()
+        with open(filename, 'w') as f:
+            f.write(prof.output_html())
+        print(prof.output_text())
+        print('Profile saved to %s' % filename)
+
+
+def save_metrics(filename, wall_seconds):
+    """ Print the run metrics and save the metrics of the run and
+        of every game to a json file
+    """
+    summary = METRICS.summary()
+    print(metrics_text(summary['run'], 'Run: %0.1fs, stage times' % wall_seconds))
+    summary['app'] = '%s v%s' %(APP_NAME, APP_VERSION)
+    summary['wall_seconds'] = wall_seconds
+    with open(filename, 'w') as f:
+        json.dump(summary, f, indent=1, sort_keys=True)
+
+
 def analyze_games(argv):
     """ argv is a list of option and values
         ['--file', 'bilbaomast16win.pgn', ...]
@@ -1179,17 +3532,12 @@ def analyze_games(argv):
     # Init
     sEngine = None
     pgn_file = None
-    nHash = 32  # Default memory in mb
     nThreads = 1
     nMoveTime = 1000
-    nMultiPv = 1
     nshortPv = 7
     startFmvn = 2
     lastFmvn = 200
     outputFN = "analyzedGame.pgn"
-    gameCnt = 0
-    complexityTime = 1000
-    flag = 1
     option_use_book = 0
     book_fn = None
     option_add_variation_margin = 0.15  # in cp
@@ -1199,13 +3547,44 @@ def analyze_games(argv):
     lang = 'ENG' # 'GER', 'FRA'
     option_use_cerebellum_book = 0
     option_book_anno_only = 0
+    nJobs = 1
+    nPlyJobs = 1
+    nThreadsPerEngine = None
+    cache_fn = None
+    cache_size = CACHE_SIZE
+    gameBudget = None
+    metrics_fn = None
+    profiler = None
+    profile_fn = None
+    option_resume = 0
+    journal_fn = None
+    option_incremental = 0
+    index_fn = None
+    option_eco = None
+    option_min_elo = None
+    option_date_from = None
+    option_date_to = None
+    header_index_fn = None
+    game_range = None
+    shard = None
+    offset_index_fn = None
+    merge_shards = None
+    option_mmap = 0
 
     try:
-        opts, args = getopt.getopt(argv, "-f", ["file=", "engine=", "movetime=",
+        opts, args = getopt.getopt(argv, "f:", ["file=", "engine=", "movetime=",
                                                "eoption=", "startmove=",
                                                "endmove=", "bookfile=", "addvariationmargincp=",
                                                "outfile=", "player=", "lang=", 'cerebellum=',
-                                               'bookannotationonly='])
+                                               'bookannotationonly=', 'jobs=',
+                                               'threadsperengine=', 'plyjobs=',
+                                               'cachefile=', 'cachesize=', 'gamebudget=',
+                                               'metrics=', 'profile=', 'profilefile=',
+                                               'resume=', 'journal=', 'incremental=',
+                                               'indexfile=', 'eco=', 'minelo=', 'datefrom=',
+                                               'dateto=', 'headerindex=', 'game-range=',
+                                               'shard=', 'offsetindex=', 'mergeshards=',
+                                               'mmap='])
 
         print(opts)
     except getopt.GetoptError as err:
@@ -1241,6 +3620,52 @@ def analyze_games(argv):
             option_use_cerebellum_book = int(arg)
         elif opt in ("--bookannotationonly"):
             option_book_anno_only = int(arg)
+        elif opt in ("--jobs"):
+            nJobs = max(1, int(arg))
+        elif opt in ("--threadsperengine"):
+            nThreadsPerEngine = int(arg)
+        elif opt in ("--plyjobs"):
+            nPlyJobs = max(1, int(arg))
+        elif opt in ("--cachefile"):
+            cache_fn = arg
+        elif opt in ("--cachesize"):
+            cache_size = int(arg)
+        elif opt in ("--gamebudget"):
+            gameBudget = int(float(arg)*1000)
+        elif opt in ("--metrics"):
+            metrics_fn = arg
+        elif opt in ("--profile"):
+            profiler = arg.lower()
+        elif opt in ("--profilefile"):
+            profile_fn = arg
+        elif opt in ("--resume"):
+            option_resume = int(arg)
+        elif opt in ("--journal"):
+            journal_fn = arg
+        elif opt in ("--incremental"):
+            option_incremental = int(arg)
+        elif opt in ("--indexfile"):
+            index_fn = arg
+        elif opt in ("--eco"):
+            option_eco = arg
+        elif opt in ("--minelo"):
+            option_min_elo = int(arg)
+        elif opt in ("--datefrom"):
+            option_date_from = arg
+        elif opt in ("--dateto"):
+            option_date_to = arg
+        elif opt in ("--headerindex"):
+            header_index_fn = arg
+        elif opt in ("--game-range"):
+            game_range = arg
+        elif opt in ("--shard"):
+            shard = arg
+        elif opt in ("--offsetindex"):
+            offset_index_fn = arg
+        elif opt in ("--mergeshards"):
+            merge_shards = int(arg)
+        elif opt in ("--mmap"):
+            option_mmap = int(arg)
 
     # Clear the engine option of whitespace chars at beginning and ending
     for n in e_option:
@@ -1250,6 +3675,18 @@ def analyze_games(argv):
             nThreads = int(nThreads[2])
         eng_option.append(n)
 
+    # Every engine of the parallel jobs gets the same threads budget
+    if nThreadsPerEngine is not None:
+        eng_option = [n for n in eng_option if 'Threads' not in n]
+        eng_option.append('Threads value %d' % nThreadsPerEngine)
+        nThreads = nThreadsPerEngine
+
+    # Only the outputs of the shards are merged
+    if merge_shards is not None:
+        if not merge_shard_outputs(outputFN, merge_shards):
+            sys.exit(1)
+        return
+
     # Exit if engine and input pgn file is missing
     if sEngine is None:
         print('Error!! engine filename was not defined')
@@ -1259,655 +3696,235 @@ def analyze_games(argv):
         print('input pgn filename was not defined')
         usage()
         sys.exit(1)
+    if profiler not in (None, 'cprofile', 'pyinstrument'):
+        print('Error!! unknown profiler %s' % profiler)
+        usage()
+        sys.exit(1)
+    if profiler is not None and profile_fn is None:
+        profile_fn = os.path.splitext(outputFN)[0] + ('.prof' if profiler == 'cprofile' else '.html')
+
+    if option_resume and option_incremental:
+        print('Error!! --resume and --incremental can not be used together')
+        usage()
+        sys.exit(1)
+    if header_index_fn is not None and (pgn_file == '-' or not os.path.isfile(pgn_file)):
+        print('Error!! --headerindex needs an input pgn file')
+        usage()
+        sys.exit(1)
+    seekable_input = pgn_file != '-' and os.path.isfile(pgn_file)
+    if seekable_input:
+        with open(pgn_file, 'rb') as f:
+            seekable_input = pgn_compression(f.read(6)) is None
+    if header_index_fn is not None and not seekable_input:
+        print('Error!! --headerindex can not be used with compressed input %s' % pgn_file)
+        usage()
+        sys.exit(1)
 
-    engine_id = get_engine_id(sEngine)
+    # The games of a slice of the input
+    first_game, last_game = 1, None
+    try:
+        if game_range is not None:
+            first_game, last_game = parse_game_range(game_range)
+        if shard is not None:
+            shard, shards = parse_shard(shard)
+    except ValueError as err:
+        print('Error!! %s' % err)
+        usage()
+        sys.exit(1)
+    if shard is not None:
+        if not seekable_input:
+            print('Error!! --shard needs an uncompressed input pgn file')
+            usage()
+            sys.exit(1)
+        outputFN = shard_output_name(outputFN, shard, shards)
+
+    # Continue a run that was stopped
+    journal = None
+    if option_resume:
+        if journal_fn is None:
+            journal_fn = os.path.splitext(outputFN)[0] + '.journal'
+        journal = RunJournal(journal_fn)
+        if journal.is_started() and not journal.done and journal.pgn_file != pgn_file:
+            print('Error!! journal %s is of input file %s' %(journal_fn, journal.pgn_file))
+            sys.exit(1)
+
+    METRICS.reset()
+    t0 = time.perf_counter()
+
+    get_engine_pool(sEngine, eng_option, nJobs*nPlyJobs)
+    if cache_fn is not None:
+        open_position_cache(cache_fn, cache_size)
+    engine_id = get_engine_id(sEngine, eng_option)
     option_add_variation_margin = float(option_add_variation_margin)/100.0
 
     # Send warning of book is missing
     if option_use_book and not os.path.isfile(book_fn):
         print('Warning!! the required book \"%s\" was not found' % book_fn)
         option_use_book = 0  # Set to 0
-        
-    complexityTime = nMoveTime
-
-    # Open pgn file for reading
-    # ifo = open(pgn_file, 'r')
-    with open("game.pgn", 'r+') as f:
-        ifo = f.read()
-    
-    game = chess.pgn.read_game(StringIO(ifo)) 
-    alt_index = 0
-
-    # Read the games in the pgn file one by one
-    while game != None:
-        gameCnt += 1
-        maxMoveNum = GetMaxMoveNumber(game)
-        Blunder = {}
-        Mistake = {}
-        Dubious = {}        
-        Blunder['white'] = 0
-        Blunder['black'] = 0
-        Mistake['white'] = 0
-        Mistake['black'] = 0
-        Dubious['white'] = 0
-        Dubious['black'] = 0
-
-        if option_book_anno_only:
-            modelGameWhite = False
-            modelGameBlack = False
+    book = PolyglotBook(book_fn) if option_use_book else None
+
+
+    # Games are read one at a time from the stream, or from their offsets
+    # in the header index or the offset index, or from the memory-mapped file
+    gameFilter = GameFilter(option_player, option_eco, option_min_elo,
+                            option_date_from, option_date_to)
+    ifo = None
+    pgn_map = None
+    header_index = None
+    offset_index = None
+    if header_index_fn is not None:
+        header_index = HeaderIndex(header_index_fn, pgn_file)
+    elif seekable_input and (game_range is not None or shard is not None or option_mmap):
+        # Next to the output, the input directory may be read-only and
+        # every shard has its own output
+        if offset_index_fn is None:
+            offset_index_fn = os.path.splitext(outputFN)[0] + '.offsets'
+        offset_index = OffsetIndex(offset_index_fn, pgn_file)
+        if option_mmap:
+            pgn_map = MmapPgn(pgn_file)
+    else:
+        if option_mmap:
+            print('Warning!! --mmap needs an uncompressed input pgn file, the games are streamed')
+        ifo = open_pgn(pgn_file)
+    for index in (header_index, offset_index):
+        if index is not None and (last_game is None or last_game > len(index)):
+            last_game = len(index)
+    if shard is not None:
+        first_game, last_game = shard_range(first_game, last_game, shard, shards)
+        print('Shard %d of %d: games %d to %d' %(shard, shards, first_game, last_game))
+
+    def input_games(next_game=1):
+        next_game = max(next_game, first_game)
+        if header_index is not None:
+            return indexed_games(pgn_file, header_index, gameFilter, next_game, last_game)
+        if pgn_map is not None:
+            return mmap_games(pgn_map, offset_index, gameFilter, next_game, last_game)
+        if offset_index is not None:
+            return offset_games(pgn_file, offset_index, gameFilter, next_game, last_game)
+        skipped = skip_games(ifo, next_game - 1)
+        return numbered_games(ifo, gameFilter, skipped + 1, last_game)
+
+    # Settings shared by all games
+    opts = AnnotatorOptions(sEngine=sEngine, eng_option=eng_option,
+                            engine_id=engine_id, nThreads=nThreads,
+                            nMoveTime=nMoveTime,
+                            nshortPv=nshortPv, startFmvn=startFmvn,
+                            lastFmvn=lastFmvn, option_use_book=option_use_book,
+                            book_fn=book_fn, book=book,
+                            option_add_variation_margin=option_add_variation_margin,
+                            option_player=option_player, lang=lang,
+                            option_use_cerebellum_book=option_use_cerebellum_book,
+                            option_book_anno_only=option_book_anno_only,
+                            nPlyJobs=nPlyJobs, gameBudget=gameBudget,
+                            metrics_fn=metrics_fn)
+
+    # Only new or changed games are analyzed, the others are copied
+    # from the output file to the new output file
+    def annotate_incremental():
+        if index_fn is None:
+            index = GameIndex(os.path.splitext(outputFN)[0] + '.index', outputFN)
         else:
-            modelGameWhite = True
-            modelGameBlack = True            
-
-        # Randomize alternate comment
-        ALTER_COM = random_alternative(lang)
-
-        # Save result header for writing at end of a game
-        try:
-            hre = game.headers['Result']
-        except:
-            hre = '*'
-
-        wplayer = game.headers['White']
-        bplayer = game.headers['Black']
-
-        # Skip this game if player is not in the game
-        if option_player != None and option_player != wplayer\
-               and option_player != bplayer:
-            game = chess.pgn.read_game(ifo)
-            continue
-
-        # A model game comment can only be added for analyzed side
-        if option_player != None and option_player == wplayer:
-            modelGameBlack = False
-        elif option_player != None and option_player == bplayer:
-            modelGameWhite = False
-
-        # Save headers to output file
-        save_headers(game, outputFN, engine_id, nThreads,
-                     nMoveTime)  
-        
-        game_node = game
-        # Loop thru the main moves and comments on this game
-        while len(game_node.variations):
-            side = game_node.board().turn
-
-            fmvn = game_node.board().fullmove_number
-            fmvn = int(fmvn)
-            
-            next_node = game_node.variation(0)
-            move = next_node.move
-            uci_game_move = str(move)
-            
-            sanMove = game_node.board().san(move)
-
-            strFEN = str(game_node.board().fen())
-            puzzleEpd = str(game_node.board().epd(bm=sanMove))
-
-            # Show game num and fen in console
-            print('Game: %d, maxMoveNum: %d' %(gameCnt, maxMoveNum))
-            print('FEN: %s' %(strFEN))
-            print('Player move: %s' %(sanMove))
-
-            # Init
-            threat_depth = 0
-            threatValue = BAD_SCORE
-            anaValue = BAD_SCORE
-            anaValue2 = BAD_SCORE
-            gameMoveValue = BAD_SCORE
-            anaPvMove = "None"
-            isOnlyMove = False
-            moveChanges = 0
-            writeAnalyzerBestLine = False
-            matePos = False
-            moveIsInPolyglotBook = False
-            moveIsInCereBook = False
-            anaPv2Len = 0
-            
-            if option_player != None and ((option_player == wplayer and not side)\
-                                          or (option_player == bplayer and side)):
-                with codecs.open(outputFN, 'a', 'utf8') as f:
-                    if side == WHITE:
-                        f.write('%d. %s ' %(fmvn, game_node.board().san(next_node.move)))
-                    else:
-                        f.write('%s ' %(game_node.board().san(next_node.move)))
-                game_node = next_node
-                continue  # Parse the next pos in this game
-
-            # Probe polyglot book, don't analyze if a game move is in the book
-            if option_use_book:
-                bestPolyBookMove = None
-                ployBookCnt = 0
-                with chess.polyglot.open_reader(book_fn) as reader:
-                    for entry in reader.find_all(game_node.board()):
-                        ployBookCnt += 1
-                        book_move = str(entry.move())
-                        if ployBookCnt == 1:
-                            bestPolyBookMove = book_move
-                        if book_move == uci_game_move:
-                            moveIsInPolyglotBook = True
-                            break
-
-                if moveIsInPolyglotBook:
-                    with codecs.open(outputFN, 'a', 'utf8') as f:
-                        if side == WHITE:
-                            f.write('%d. %s {%s %s} ' %(fmvn, game_node.board().san(next_node.move),
-                                                        MOVE_FROM_COMMENT[lang], book_fn))
-                        else:
-                            f.write('%d...%s {%s %s} ' %(fmvn, game_node.board().san(next_node.move),
-                                                         MOVE_FROM_COMMENT[lang], book_fn))
-                    game_node = next_node
-                    continue  # Parse the next pos in this game
-                
-                elif bestPolyBookMove is not None:
-                    with codecs.open(outputFN, 'a', 'utf8') as f:
-                        tempBoard = game_node.board()
-                        tempBoard.push_uci(bestPolyBookMove)
-                        move = tempBoard.pop()
-                        san_move = tempBoard.san(move)
-                        book_comment = '%s %s %s' %(book_fn, BOOK_RECOMMENDS_COMMENT[lang], san_move)
-                        if side == WHITE:
-                            f.write('%d. %s {%s} ' %(fmvn, game_node.board().san(next_node.move), book_comment))
-                        else:
-                            f.write('%d...%s {%s} ' %(fmvn, game_node.board().san(next_node.move), book_comment))
-                    game_node = next_node
-                    continue                    
-                
-            # Use cerebellum book
-            elif option_use_cerebellum_book:
-                moveTimeMs = 100
-                multiPVNum = 1
-                pvLenNum = 1
-                bestmove, validCereBook = get_cerebellum_book_move(sEngine,
-                        strFEN, eng_option, moveTimeMs, multiPVNum, pvLenNum)
-                if bestmove == uci_game_move and validCereBook:
-                    moveIsInCereBook = True
-
-                if moveIsInCereBook:
-                    with codecs.open(outputFN, 'a', 'utf8') as f:
-                        if side == WHITE:
-                            f.write('%d. %s {%s cerebellum} ' %(fmvn, game_node.board().san(next_node.move), MOVE_FROM_COMMENT[lang]))
-                        else:
-                            f.write('%d...%s {%s cerebellum} ' %(fmvn, game_node.board().san(next_node.move), MOVE_FROM_COMMENT[lang]))
-                    game_node = next_node
-                    continue
-                elif validCereBook:
-                    with codecs.open(outputFN, 'a', 'utf8') as f:
-                        tempBoard = game_node.board()
-                        tempBoard.push_uci(bestmove)
-                        move = tempBoard.pop()
-                        san_move = tempBoard.san(move)
-                        book_comment = 'Cerebellum %s %s' %(BOOK_RECOMMENDS_COMMENT[lang], san_move)
-                        if side == WHITE:
-                            f.write('%d. %s {%s} ' %(fmvn, game_node.board().san(next_node.move), book_comment))
-                        else:
-                            f.write('%d...%s {%s} ' %(fmvn, game_node.board().san(next_node.move), book_comment))
-                    game_node = next_node
-                    continue
-
-            # If book annotation only
-            if option_book_anno_only:
-                with codecs.open(outputFN, 'a', 'utf8') as f:
-                    if side == WHITE:
-                        f.write('%d. %s ' %(fmvn, game_node.board().san(next_node.move)))
-                    else:
-                        f.write('%s ' %(game_node.board().san(next_node.move)))
-                game_node = next_node
-                continue  # Parse the next pos in this game
-
-            # Analyze pos if fmvn is within startFmvn and lastFmvn input from user
-            if fmvn >= startFmvn and fmvn <= lastFmvn:
-
-                # (0) Get the score of the game move by running the engine.
-                # Invert the score after the analysis since we are analyzing fen + move,
-                # and invert the score if current side is black too
-                # because we use white POV (point of view) and engine is analyzing at side POV
-
-                # Use temp so we will not mess with the current board
-                tempBoard = game_node.board()
-                tempBoard.push(move)  # make the move on the temp board
-                # Don't send position to analyze without a legal move
-                if not game_node.board().is_checkmate()\
-                       and not game_node.board().is_stalemate()\
-                       and not tempBoard.is_checkmate()\
-                       and not tempBoard.is_stalemate():
-                    tFEN = str(tempBoard.fen())  
-                    mpv = 1
-
-                    # Get the score/depth pv <moves> in a list, list[0] = 1st pv,
-                    # The expected return value is,
-                    # "+0.89/11 32. Nc6 Nh5 33. Qf2 Qd1 34. Nb4", for nshortPv = 5
-                    gameMoveAnalysisList = analyze_fen(sEngine,
-                                                       tFEN,
-                                                       eng_option,
-                                                       nMoveTime,
-                                                       mpv,
-                                                       nshortPv)                    
-
-                    # If engine does not return a search info then just write the move
-                    # This happens when the engine used is using its own book
-                    if gameMoveAnalysisList is None:
-                        with codecs.open(outputFN, 'a', 'utf8') as f:
-                            if side == WHITE:
-                                f.write('%d. %s {No search output from Annotator} ' %(fmvn, game_node.board().san(next_node.move)))
-                            else:
-                                f.write('%d...%s {No search output from Annotator} ' %(fmvn, game_node.board().san(next_node.move)))
-                        game_node = next_node
-                        continue
-
-                    gameMoveAnalysis = gameMoveAnalysisList[0]
-                    
-                    # The return value is from the point of view of the opponent,
-                    # so we must negate it before comparing with engine analysis score
-                    # gameMoveValue is in pawn unit and is of type float, it is also WPOV
-                    gameMoveValue, gameMoveDepth = get_score_and_depth(gameMoveAnalysis, side)
-
-                    # Write to console as update
-                    print('Engine analysis of player move: %+0.2f/%d\n'\
-                              %(gameMoveValue, gameMoveDepth))
-                    
-                # Analyze position to get engine recommendation
-
-                # (1) Get complexity of the position using multipv 1,
-                # use 1s or nominal search time entered by user
-                if gameMoveValue != BAD_SCORE and (gameMoveValue > -0.15 and side == WHITE)\
-                           or (gameMoveValue < 0.15 and side == BLACK):
-                    complexityMultiPV = 1
-                    moveChanges, matePos = analyze_complexity(sEngine,
-                                    strFEN, eng_option,
-                                    complexityTime,
-                                    complexityMultiPV, nshortPv)                
-
-                # (2) Get the engine analysis when engine is to move in this position
-                if not game_node.board().is_checkmate()\
-                           and not game_node.board().is_stalemate():
-                    nMultiPv = 2
-                    
-                    # Increase engine time when move changes >= 3
-                    newAllocTime = nMoveTime
-                    if moveChanges >= 3:
-                        newAllocTime = 3*nMoveTime
-
-                    # If position has mate score then we extend the pv length,
-                    # this is only applicable for pv1
-                    pvLen = nshortPv
-                    if matePos:
-                        pvLen = 200  # nshortPv                
-                        
-                    analysisList = analyze_fen(sEngine, strFEN, eng_option,
-                                    newAllocTime, nMultiPv, pvLen)
-
-                    # If engine does not return a search info then just write the move
-                    # This happens when the engine used is using its own book
-                    if analysisList is None:
-                        with codecs.open(outputFN, 'a', 'utf8') as f:
-                            if side == WHITE:
-                                f.write('%d. %s {No search output from Annotator} ' %(fmvn, game_node.board().san(next_node.move)))
-                            else:
-                                f.write('%d...%s {No search output from Annotator} ' %(fmvn, game_node.board().san(next_node.move)))
-                        game_node = next_node
-                        continue
-
-                    # Get score, depth, and pv of the 1st pv line from multipv
-                    # anaValue is white POV
-                    analysisData = analysisList[0]
-                    anaValue, anaDepth, anaPvMove, anaPv = get_engine_detailed_data(analysisData, side)
-
-                    # Add model comment if there is no blunder
-                    if (anaValue - gameMoveValue > MODEL_GAME_MARGIN) and side==WHITE:
-                        modelGameWhite = False
-                    elif (anaValue - gameMoveValue < -MODEL_GAME_MARGIN) and side==BLACK:
-                        modelGameBlack = False
-                    
-                    # Get score, depth and pv of the 2nd pv if there is
-                    # There is a possibility that a multi pv will not return 2nd pv
-                    if len(analysisList) > 1:
-                        analysisData2 = analysisList[1]
-                        anaValue2, anaDepth2, anaPvMove2,\
-                                   anaPv2 = get_engine_detailed_data(analysisData2, side)
-                        
-                        anaPv2List = anaPv2.split(' ')
-                        anaPv2Len = len(anaPv2List)
-                        # print('pv: %s, len %d' %(anaPv2, anaPv2Len))
-
-                # If move is singular
-                isOnlyMove = OnlyMove(side, anaPvMove, sanMove, anaValue, anaValue2)
-
-                # (3) Check if analyzer best line is to be appended to the game
-                # ANALYSIS_MARGIN = 10.0 pawns
-                if anaPvMove == sanMove or gameMoveValue == BAD_SCORE or anaValue == BAD_SCORE\
-                        or (abs(gameMoveValue) >= ANALYSIS_MARGIN and abs(anaValue) >= ANALYSIS_MARGIN)\
-                        or ((anaValue - gameMoveValue < option_add_variation_margin and side == WHITE) or\
-                        (anaValue - gameMoveValue > -option_add_variation_margin and side == BLACK)):
-                    writeAnalyzerBestLine = False
-                else:
-                    writeAnalyzerBestLine = True
-
-                    # Find the threat of the last move of opp by doing a null move
-                    # from this current position. If this value is positive then
-                    # the current side to move is in trouble because by doing
-                    # nothing the opponent gains score. This will also detect initiative
-                    if not game_node.board().is_check() and not game_node.board().is_stalemate():
-                        tempBoardt = game_node.board()
-                        tempBoardt.push(move.null())  # Send null move
-                        tFENt = str(tempBoardt.fen())  
-                        nMultiPv = 1
-                        gameMoveThreatList = analyze_fen(sEngine, tFENt, eng_option,\
-                                                         nMoveTime, nMultiPv, nshortPv)
-                        if gameMoveThreatList is not None:
-                            gameMoveThreat = gameMoveThreatList[0]
-                            # gameMoveThreat = +0.00/20 27.Rc4 b6 28.Rc3 Rh1 29.a4 Rh2+ 30.Kf3
-                            threatPvStr = gameMoveThreat.split(' ')
-                            tpvlen = len(threatPvStr)
-                            # Display odd number of moves in the pv, the first item in threatPvStr is score/depth
-                            if tpvlen >= 3:
-                                if tpvlen%2 == 0:
-                                    threatPv = ' '.join(threatPvStr[1:])
-                                else:
-                                    threatPv = ' '.join(threatPvStr[1:-1])
-                            else:
-                                threatPv = ' '.join(threatPvStr[1:])
-                            threatEval = threatPvStr[0]
-                            threatEvalSplit = threatEval.split('/')
-                            threatValue = float(threatEvalSplit[0])
-                            threat_depth = int(threatEvalSplit[1])                            
-
-            # (4) (a) Write singular move symbol or (b) alternative bad lines
-            # or (c) good or very good move symbols to a game move
-            if not writeAnalyzerBestLine:
-                with codecs.open(outputFN, 'a', 'utf8') as f:
-                    # If position is complex
-                    if anaPvMove == sanMove and abs(anaValue) < +6.0\
-                            and abs(anaValue2) < +6.0:
-                        # If moveChanges is high add !! to the gameMoveNag, if low just add !
-                        gameMoveNag = None
-                        if moveChanges >= 5 and abs(gameMoveValue) >= +1.0:
-                            gameMoveNag = '$3'
-                        elif moveChanges >= 3 and abs(gameMoveValue) >= +1.0:
-                            gameMoveNag = '$1'
-                        writeInferiorLine = False
-                        # Write inferior line if pv2 score is not too close and not too far from pv1 score
-                        if (side == WHITE and anaValue - anaValue2 >= +option_add_variation_margin\
-                                and anaValue - anaValue2 < (+3.0 + option_add_variation_margin)) or\
-                                (side == BLACK and anaValue - anaValue2 <= -option_add_variation_margin\
-                                 and anaValue - anaValue2 > (-3.0 - option_add_variation_margin)):
-                            writeInferiorLine = True
-                            posNag = position_nags(anaValue2)
-                            gamePosNag = position_nags(gameMoveValue)
-                            pv2MoveNag = one_value_move_nags(side, anaValue2)
-                            if pv2MoveNag is not None:
-                                # Get the move in pv2 and add a NAG
-                                anaPv2Rev = anaPv2.split(' ')
-                                # There must be more than 1 move in pv
-                                if len(anaPv2Rev) >= 2:
-                                    pv2_move = anaPv2Rev[0]
-                                    pv2_move = pv2_move + ' ' + pv2MoveNag  + ' { ' + random_reason(lang) + ' } '
-                                    mvRem = ' '.join(anaPv2Rev[1:-1])
-                                    newAnaPv2 = pv2_move + ' ' + mvRem
-                                    # Get random bad comment and append it before the pv2
-                                    badComment = random_bad(lang)
-                                    # Write the bad variation depends on white and black
-                                    if gameMoveNag is None:
-                                        if side == WHITE:
-                                            f.write('%d. %s %s {%+0.2f/%d} ({%s} %s %s {%+0.2f/%d}) '\
-                                                    %(fmvn, sanMove,
-                                                    gamePosNag, gameMoveValue, gameMoveDepth,
-                                                    badComment,
-                                                    newAnaPv2, posNag, anaValue2, anaDepth2))
-                                        else:
-                                            f.write('%s %s {%+0.2f/%d} ({%s} %s %s {%+0.2f/%d}) '\
-                                                    %(sanMove,
-                                                    gamePosNag, gameMoveValue, gameMoveDepth,
-                                                    badComment,
-                                                    newAnaPv2, posNag, anaValue2, anaDepth2))
-                                    else:
-                                        if side == WHITE:
-                                            f.write('%d. %s %s %s {%+0.2f/%d} ({%s} %s %s {%+0.2f/%d}) '\
-                                                    %(fmvn, sanMove,
-                                                    gameMoveNag, gamePosNag, gameMoveValue, gameMoveDepth,
-                                                    badComment,
-                                                    newAnaPv2, posNag, anaValue2, anaDepth2))
-                                        else:
-                                            f.write('%s %s %s {%+0.2f/%d} ({%s} %s %s {%+0.2f/%d}) '\
-                                                    %(sanMove,
-                                                    gameMoveNag, gamePosNag, gameMoveValue, gameMoveDepth,
-                                                    badComment,
-                                                    newAnaPv2, posNag, anaValue2, anaDepth2))                                
-                        # if writing inferior line is not possible
-                        if not writeInferiorLine or pv2MoveNag is None or len(anaPv2Rev) < 2:
-                            if gameMoveNag is None:
-                                if side == WHITE:
-                                    f.write('%d. %s ' %(fmvn, sanMove))
-                                else:
-                                    f.write('%s ' %(sanMove))
-                            else:
-                                if side == WHITE:
-                                    f.write('%d. %s %s ' %(fmvn, sanMove, gameMoveNag))
-                                else:
-                                    f.write('%s %s ' %(sanMove, gameMoveNag))
-                    # else if easy move
-                    else:
-                        if isOnlyMove:
-                            assert anaPvMove == sanMove
-                            # $7 = Singular move comment
-                            if side == WHITE:
-                                f.write('%d. %s %s ' %(fmvn, sanMove, "$7"))
-                            else:
-                                f.write('%s %s ' %(sanMove, "$7"))
-                        else:  # Write the game move only
-                            if side == WHITE:
-                                f.write('%d. %s ' %(fmvn, sanMove))
-                            else:
-                                f.write('%s ' %(sanMove))
+            index = GameIndex(index_fn, outputFN)
+        settingsKey = settings_key(opts)
+        tmp_fn = outputFN + '.tmp'
+        if os.path.isfile(tmp_fn):
+            os.remove(tmp_fn)
+
+        def annotate_or_copy(game, gameCnt, opts):
+            key = game_key(game, settingsKey)
+            annotated_game = index.annotated_game(key)
+            if annotated_game is not None:
+                METRICS.count('games_copied')
+            else:
+                annotated_game = annotate_game(game, gameCnt, opts)
+            return key, annotated_game
+
+        def write_game(gameCnt, result):
+            key, annotated_game = result
+            if annotated_game is not None:
+                offset = writer.write_game(annotated_game)
+                index.add(key, offset, writer.size - offset)
+
+        with PgnWriter(tmp_fn) as writer:
+            if nJobs > 1:
+                annotate_games_parallel(input_games(), opts, nJobs, write_game,
+                                        annotate_fn=annotate_or_copy)
+            else:
+                for gameCnt, game in input_games():
+                    write_game(gameCnt, annotate_or_copy(game, gameCnt, opts))
+            writer.sync()
+        index.commit(tmp_fn)
+        counts = METRICS.summary()['run']['counts']
+        print('Games analyzed: %d, copied: %d'
+              %(counts.get('game', 0), counts.get('games_copied', 0)))
 
-            # Else write the pv as suggested by the engine      
+    # Read the games in the pgn file one by one
+    def annotate_all():
+        with PgnWriter(outputFN) as writer:
+            next_game = 1
+            if journal is not None:
+                runKey = run_key(pgn_file, opts, gameFilter, first_game, last_game)
+                if journal.done and journal.run_key == runKey:
+                    print('The run of journal %s is complete' % journal_fn)
+                    return
+                if journal.done:
+                    print('The input file or the settings changed, starting a new journal %s'
+                          % journal_fn)
+                    journal.reset()
+                if not journal.is_started():
+                    journal.start(pgn_file, writer.size, runKey)
+                elif journal.games_done:
+                    print('Resuming after game %d of journal %s'
+                          %(journal.games_done, journal_fn))
+                if writer.size < journal.output_end:
+                    print('Error!! output file %s is shorter than in journal %s'
+                          %(outputFN, journal_fn))
+                    sys.exit(1)
+                # Remove the games written after the last journaled game
+                if writer.size > journal.output_end:
+                    writer.truncate(journal.output_end)
+                next_game += journal.games_done
+
+            def write_game(gameCnt, annotated_game):
+                if annotated_game is not None:
+                    writer.write_game(annotated_game)
+                if journal is not None:
+                    writer.sync()
+                    journal.game_done(gameCnt, writer.size)
+
+            if nJobs > 1:
+                annotate_games_parallel(input_games(next_game), opts, nJobs, write_game)
             else:
-                assert writeAnalyzerBestLine
-                # Get position NAG for pv. The pv is a line based from engine
-                PvPosNag = position_nags(anaValue)                
-                # Get move NAG for game move
-                assert sanMove != anaPvMove
-                gameMoveNag = move_nags(side, anaValue, gameMoveValue)                
-                # Get position NAG for position after this game move
-                gamePosNag = position_nags(gameMoveValue)
-                # Select a comment based on difference between engine score and game move score
-                goodComment = get_good_comment(anaValue, gameMoveValue, side, lang)
-                with codecs.open(outputFN, 'a', 'utf8') as f:
-                    # If game move pos assessment is a mate due to perhaps of
-                    # a blunder then show +/-M, instead of score/depth
-                    move_score_val = "%+0.2f" % gameMoveValue
-                    posGameMoveComment = str(move_score_val) + '/' + str(gameMoveDepth)                  
-                    if (int(100*gameMoveValue) >= INF-MAX_PLY) or (int(100*gameMoveValue) <= -INF+MAX_PLY):
-                        assert gameMoveValue != BAD_SCORE
-                        num_mate = value_to_mate(100*gameMoveValue)
-                        assert num_mate != 0
-                        smate = mate_indicator(num_mate)
-                        posGameMoveComment = smate
-                    # If pv1 score is a mate then show +/-M, instead of score/depth
-                    pv1_score_val = "%+0.2f" % anaValue
-                    posPv1Comment = str(pv1_score_val) + '/' + str(anaDepth)
-                    pv1MateScore = False
-                    if (int(100*anaValue) >= INF-MAX_PLY and side == WHITE) or\
-                               (int(100*anaValue) <= -INF+MAX_PLY and side == BLACK):
-                        assert anaValue != BAD_SCORE
-                        num_mate = value_to_mate(100*anaValue)
-                        assert num_mate != 0
-                        smate = mate_indicator(num_mate)                        
-                        posPv1Comment = smate
-                        pv1MateScore = True                      
-                    # Break down the pv to get the first move
-                    pv1_split = anaPv.split(' ')
-                    # Get the first move in the pv including the move number
-                    pv1_move = pv1_split[0]
-                    # Insert the pv1_move_nag after the first move
-                    if pv1MateScore:
-                        new_mv = pv1_move + ' ' + '{with mate attack} '
-                    else:
-                        new_mv = pv1_move + ' '
-                    # Reconstruct the pv line
-                    new_anaPv = new_mv + ' '.join(pv1_split[1:])
-                    # Write the game move and pv variation
-                    if side == WHITE:
-                        if pv1MateScore:
-                            if gameMoveNag is None:
-                                f.write('\n%d. %s %s {%s} ({%s} %s %s) '\
-                                        %(fmvn, game_node.board().san(next_node.move),
-                                        gamePosNag, posGameMoveComment,
-                                        goodComment, new_anaPv, PvPosNag))
-                            else:
-                                f.write('\n%d. %s %s %s {%s} ({%s} %s %s) '\
-                                    %(fmvn, game_node.board().san(next_node.move), gameMoveNag,
-                                    gamePosNag, posGameMoveComment,
-                                    goodComment, new_anaPv, PvPosNag))
-                        else:
-                            if gameMoveNag is None:
-                                f.write('\n%d. %s %s {%s} ({%s} %s %s {%s}) '\
-                                    %(fmvn, game_node.board().san(next_node.move),
-                                    gamePosNag, posGameMoveComment,
-                                    goodComment, new_anaPv, PvPosNag, posPv1Comment))
-                            else: 
-                                f.write('\n%d. %s %s %s {%s} ({%s} %s %s {%s}) '\
-                                        %(fmvn, game_node.board().san(next_node.move), gameMoveNag,
-                                        gamePosNag, posGameMoveComment,
-                                        goodComment, new_anaPv, PvPosNag, posPv1Comment))
-                    else:  # side is black
-                        if pv1MateScore:
-                            if gameMoveNag is None:
-                                f.write('\n%d... %s %s {%s} ({%s} %s %s) '\
-                                        %(fmvn, game_node.board().san(next_node.move),
-                                        gamePosNag, posGameMoveComment,
-                                        goodComment, new_anaPv, PvPosNag))
-                            else:
-                                f.write('\n%d... %s %s %s {%s} ({%s} %s %s) '\
-                                        %(fmvn, game_node.board().san(next_node.move), gameMoveNag,
-                                        gamePosNag, posGameMoveComment,
-                                        goodComment, new_anaPv, PvPosNag))
-                        else:
-                            if gameMoveNag is None:                                    
-                                f.write('\n%d... %s %s {%s} ({%s} %s %s {%s}) '\
-                                        %(fmvn, game_node.board().san(next_node.move),
-                                        gamePosNag, posGameMoveComment,
-                                        goodComment, new_anaPv, PvPosNag, posPv1Comment))
-                            else:
-                                f.write('\n%d... %s %s %s {%s} ({%s} %s %s {%s}) '\
-                                    %(fmvn, game_node.board().san(next_node.move), gameMoveNag,
-                                    gamePosNag, posGameMoveComment,
-                                    goodComment, new_anaPv, PvPosNag, posPv1Comment))
-
-                    # If the game move is not the same to that of pv2 move then write it as variation,
-                    # depending on the pv2 score and game move score
-                    if anaPvMove2 != sanMove and anaValue2 != BAD_SCORE and anaPv2Len >= 2:                        
-                        # Get pos nag of pv2
-                        pv2PosNag = position_nags(anaValue2)
-                        
-                        # If pv2 score is equal or better than the game move score then write
-                        # it as a playable alternative line
-                        if (side == WHITE and anaValue2 >= gameMoveValue) or\
-                                   (side == BLACK and anaValue2 <= gameMoveValue):
-                            if (side == WHITE and anaValue2 >= -ONLY_MOVE_SCORE) or\
-                                       (side == BLACK and anaValue2 <= +ONLY_MOVE_SCORE):
-                                
-                                # If pv1 showed that this has a mate score then check
-                                # if pv2 is also showing mate score, otherwise cut the pv2 length
-                                # to nshortPv = 7 plies, as we know we extend the pv length
-                                # when there is a mate score from pv1
-                                if (int(100*anaValue2) >= INF-MAX_PLY and side == WHITE) or\
-                                       (int(100*anaValue2) <= -INF+MAX_PLY and side == BLACK):
-
-                                    # Convert score to mate number
-                                    num_mate = value_to_mate(100*anaValue2)
-                                    assert num_mate != 0
-                                    smate = mate_indicator(num_mate)
-                                    posPv2Comment = smate
-                                    com_val, alt_index = get_alternative_comment(ALTER_COM, alt_index, lang)
-                                    f.write('\n({ %s } %s %s {%s}) '\
-                                            %(com_val, anaPv2, pv2PosNag, posPv2Comment))
-                                else:
-                                    
-                                    # Else if not mate score Reduce the pv length to nshortPv = 7 plies (default)
-                                    new_ana_pv2 = anaPv2.split(' ')
-                                    new_ana_pv2 = ' '.join(new_ana_pv2[:nshortPv])
-                                    com_val, alt_index = get_alternative_comment(ALTER_COM, alt_index, lang)
-                                    f.write('\n({ %s } %s %s {%+0.2f/%d}) '\
-                                        %(com_val, new_ana_pv2, pv2PosNag, anaValue2, anaDepth2))
-                        # else if pv2MoveScore < gameMoveScore
-                        else:
-                            # Add move nag to the first move of pv2
-                            anaPv2MoveNag = one_value_move_nags(side, anaValue2)
-                            if anaPv2MoveNag is not None:                                
-                                # new_ana_pv2 = anaPv2.split(' ')
-                                anaPv2List = anaPv2.split(' ')
-                                anaPv2WithReason = anaPvMove2 + ' %s { %s } ' % (anaPv2MoveNag, random_reason(lang))
-                                # Cut 1 ply at end of pv, to emphasize that the other side is the last mover
-                                newAnaPv2 = anaPv2WithReason + ' '.join(anaPv2List[1:-1])
-                                badComment = random_bad(lang)
-                                f.write('\n({ %s } %s %s {%+0.2f/%d}) '\
-                                        %(badComment,
-                                          newAnaPv2, pv2PosNag, anaValue2, anaDepth2))
-                    # Print the threat pv if score of opponent or last move is good
-                    if threatValue > 0.0 and threatValue != BAD_SCORE:                        
-                        # Translate threatValue to white pov
-                        # Use side == WHITE because we do a null move
-                        wpov_threatValue = threatValue
-                        if side == WHITE:
-                            wpov_threatValue = -1*threatValue
-                        if int(100*threatValue) >= +INF-MAX_PLY:
-                            num_mate = value_to_mate(100*threatValue)
-                            if side == WHITE:
-                                f.write('\n({%s %d} %d. %s %s) '\
-                                        %(BLACK_MATE_THREAT_COMMENT[lang], abs(num_mate), fmvn, '--', threatPv))
-                            else:
-                                f.write('\n({%s %d} %d... %s %s) '\
-                                        %(WHITE_MATE_THREAT_COMMENT[lang], abs(num_mate), fmvn, '--', threatPv))
-                        else:
-                            posNag = position_nags(wpov_threatValue)
-                            if side == WHITE:
-                                f.write('\n({%s} %d. %s %s %s {%+0.2f/%d}) '\
-                                        %(BLACK_THREAT_COMMENT[lang], fmvn, '--',
-                                          threatPv, posNag, wpov_threatValue, threat_depth))
-                            else:
-                                f.write('\n({%s} %d... %s %s %s {%+0.2f/%d}) '\
-                                        %(WHITE_THREAT_COMMENT[lang], fmvn, '--',
-                                          threatPv, posNag, wpov_threatValue, threat_depth))
-
-            # Record blunders and mistakes for summary       
-            if anaPvMove != sanMove and writeAnalyzerBestLine:
-                mnag = move_nags(side, anaValue, gameMoveValue)
-                # $4=??, $2=?, $6=?!
-                if side and mnag == '$4':
-                    Blunder['white'] += 1
-                elif side and mnag == '$2':
-                    Mistake['white'] += 1
-                elif side and mnag == '$6':
-                    Dubious['white'] += 1
-
-                elif not side and mnag == '$4':
-                    Blunder['black'] += 1
-                elif not side and mnag == '$2':
-                    Mistake['black'] += 1
-                elif not side and mnag == '$6':
-                    Dubious['black'] += 1
-
-            game_node = next_node  # Read next position of this game
-
-        # Print result at the end of notation
-        with codecs.open(outputFN, 'a', 'utf8') as output_fo:
-            # Add mode game comment only when all moves are analyzed
-            if lastFmvn >= maxMoveNum:
-                if modelGameWhite and modelGameBlack:
-                    output_fo.write('{%s}\n' %(WHITE_BLACK_MODEL_COMMENT[lang]))
-                elif modelGameWhite:
-                    output_fo.write('{%s}\n' %(WHITE_MODEL_COMMENT[lang]))
-                elif modelGameBlack:
-                    output_fo.write('{%s}\n' %(BLACK_MODEL_COMMENT[lang]))
-            # output_fo.write('{WhiteBlunder: %d, BlackBlunder: %d}\n' %(Blunder['white'], Blunder['black']))
-            output_fo.write('{WBlunder: %d, WMistake: %d, WDubious: %d, BBlunder: %d, BMistake: %d, BDubious: %d} %s\n\n'\
-                            %(Blunder['white'], Mistake['white'], Dubious['white'],
-                              Blunder['black'], Mistake['black'], Dubious['black'], hre))
-
-        game = chess.pgn.read_game(ifo)  # Read next game of the pgn file
-
-    ifo.close()
+                for gameCnt, game in input_games(next_game):
+                    write_game(gameCnt, annotate_game(game, gameCnt, opts))
+            if journal is not None:
+                journal.finish()
+
+    annotate_fn = annotate_incremental if option_incremental else annotate_all
+    if profiler is not None:
+        run_profiled(profiler, profile_fn, annotate_fn)
+    else:
+        annotate_fn()
+
+    if ifo is not None:
+        ifo.close()
+    if pgn_map is not None:
+        pgn_map.close()
+    if header_index is not None:
+        header_index.close()
+    if offset_index is not None:
+        offset_index.close()
+    if book is not None:
+        book.close()
+    if journal is not None:
+        journal.close()
+    close_engine_pools()
+    close_position_cache()
+
+    wall_seconds = time.perf_counter() - t0
+    METRICS.add_time('run', wall_seconds)
+    if metrics_fn is not None:
+        save_metrics(metrics_fn, wall_seconds)
 
     print("\nDone!!")
 
@@ -1942,8 +3959,7 @@ def main(argv):
     # ['--file', 'bilbaomast16win.pgn',
     # '--engine', 'stockfish_120716_x64_modern.exe',
     # '--eoption', 'Hash value 128, Threads value 1']
-    # analyze_games(argv)
-    newMain() 
+    analyze_games(argv)
 
 if __name__ == "__main__":
     main(sys.argv[1:])
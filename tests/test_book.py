@@ -0,0 +1,63 @@
+import struct
+
+import chess
+import chess.polyglot
+
+import bench
+import main
+
+
+CASTLING_FEN = 'r3k2r/pppq1ppp/2npbn2/4p3/4P3/2NPBN2/PPPQ1PPP/R3K2R w KQkq - 0 1'
+
+
+def polyglot_move(board, move):
+    """ Returns the raw polyglot move, castling is the king taking its rook """
+    if board.is_castling(move):
+        rook_file = 7 if chess.square_file(move.to_square) == 6 else 0
+        move = chess.Move(move.from_square,
+                          chess.square(rook_file, chess.square_rank(move.from_square)))
+    promotion = move.promotion - 1 if move.promotion else 0
+    return (chess.square_file(move.to_square) | chess.square_rank(move.to_square) << 3 |
+            chess.square_file(move.from_square) << 6 | chess.square_rank(move.from_square) << 9 |
+            promotion << 12)
+
+
+def write_book(book_fn, book):
+    entries = []
+    for fen, moves in book:
+        board = chess.Board(fen)
+        for uci_move, weight in moves:
+            entries.append((chess.polyglot.zobrist_hash(board),
+                            polyglot_move(board, chess.Move.from_uci(uci_move)), weight))
+    entries.sort(key=lambda entry: entry[0])
+    with open(book_fn, 'wb') as f:
+        for key, raw_move, weight in entries:
+            f.write(struct.pack('>QHHI', key, raw_move, weight, 0))
+
+
+def test_polyglot_book_probes_like_the_legacy_probing(tmp_path):
+    after_e4 = chess.Board()
+    after_e4.push_uci('e2e4')
+    book_fn = str(tmp_path / 'book.bin')
+    write_book(book_fn, [(chess.STARTING_FEN, [('e2e4', 100), ('d2d4', 50), ('g1f3', 10)]),
+                         (after_e4.fen(), [('c7c5', 30), ('e7e5', 60)]),
+                         (CASTLING_FEN, [('e1g1', 20), ('e1c1', 20), ('a2a3', 1)])])
+
+    probes = [(chess.Board(), uci_move) for uci_move in ('e2e4', 'd2d4', 'g1f3', 'a2a3')]
+    probes += [(after_e4, uci_move) for uci_move in ('e7e5', 'c7c5', 'e7e6')]
+    probes += [(chess.Board(CASTLING_FEN), uci_move) for uci_move in ('e1g1', 'e1c1', 'h2h3')]
+    probes += [(chess.Board('4k3/8/8/8/8/8/8/4K3 w - - 0 1'), 'e1e2')]
+
+    for size in (main.BOOK_CACHE_SIZE, 1):
+        book = main.PolyglotBook(book_fn, size)
+        try:
+            for _ in range(2):
+                for board, uci_move in probes:
+                    assert (book.best_move(board), book.is_book_move(board, uci_move)) ==\
+                        bench.legacy_book_probe(book_fn, board, uci_move)
+        finally:
+            book.close()
+
+    book = main.PolyglotBook(book_fn)
+    assert set(book.book_moves(chess.Board(CASTLING_FEN))) == {'e1g1', 'e1c1', 'a2a3'}
+    book.close()
@@ -0,0 +1,44 @@
+import chess
+
+import main
+
+
+def classify(fen, san):
+    board = chess.Board(fen)
+    return main.classify_position(board, board.parse_san(san))
+
+
+def test_mate_move():
+    fen = 'r1bqkb1r/pppp1ppp/2n2n2/4p2Q/2B1P3/8/PPPP1PPP/RNB1K1NR w KQkq - 4 4'
+    assert classify(fen, 'Qxf7#') == main.MATE_MOVE
+    assert classify(fen, 'Qxe5+') is None
+
+
+def test_dead_draw():
+    assert classify('8/8/4k3/8/8/3BK3/8/8 w - - 0 1', 'Kd4') == main.DEAD_DRAW
+    assert classify('8/8/4k3/8/8/3RK3/8/8 w - - 0 1', 'Kd4') is None
+
+
+def test_single_legal_move():
+    fen = '7k/8/8/8/8/8/6q1/7K w - - 0 1'
+    assert chess.Board(fen).legal_moves.count() == 1
+    assert classify(fen, 'Kxg2') == main.SINGLE_MOVE
+
+
+def test_quiet_move():
+    assert classify(chess.STARTING_FEN, 'e4') is None
+
+
+def test_classify_does_not_change_the_board():
+    board = chess.Board('r1bqkb1r/pppp1ppp/2n2n2/4p2Q/2B1P3/8/PPPP1PPP/RNB1K1NR w KQkq - 4 4')
+    fen = board.fen()
+    main.classify_position(board, board.parse_san('Qxf7#'))
+    assert board.fen() == fen and not board.move_stack
+
+
+def test_recapture_square():
+    board = chess.Board('4k3/8/8/3p4/4P3/5P2/8/4K3 b - - 0 1')
+    assert main.recapture_square(board, board.parse_san('dxe4')) == chess.E4
+    board = chess.Board('4k3/8/8/3p4/4P3/8/8/4K3 b - - 0 1')
+    assert main.recapture_square(board, board.parse_san('dxe4')) is None
+    assert main.recapture_square(board, board.parse_san('d4')) is None
@@ -0,0 +1,77 @@
+import io
+
+import chess.pgn
+import pytest
+
+import main
+
+
+HEADERS = [
+    {'White': 'Carlsen, M', 'Black': 'Caruana, F', 'Date': '2018.11.09', 'ECO': 'C42',
+     'WhiteElo': '2835', 'BlackElo': '2832'},
+    {'White': 'Caruana, F', 'Black': 'Carlsen, M', 'Date': '2018.11.10', 'ECO': 'B33',
+     'WhiteElo': '2832', 'BlackElo': '2835'},
+    {'White': 'Ding', 'Black': 'Nepo', 'Date': '2023.??.??', 'ECO': 'C4',
+     'WhiteElo': '2788', 'BlackElo': '?'},
+    {'White': 'Anon', 'Black': 'Carlsen, M', 'Date': '????.??.??',
+     'WhiteElo': '1500', 'BlackElo': '2850'},
+    {'White': 'O"Neil', 'Black': '?', 'ECO': 'A00'},
+    {'Black': 'Ding', 'Date': '2018', 'ECO': 'c42', 'WhiteElo': '2900', 'BlackElo': '2800'},
+    {},
+]
+
+FILTERS = [
+    {},
+    {'player': 'Carlsen, M'},
+    {'player': 'Ding'},
+    {'player': '?'},
+    {'player': 'O"Neil'},
+    {'player': 'nobody'},
+    {'eco': 'C'},
+    {'eco': 'C42'},
+    {'eco': 'B3'},
+    {'minElo': 2800},
+    {'minElo': 0},
+    {'dateFrom': '2018.11.10'},
+    {'dateFrom': '2018'},
+    {'dateTo': '2018.11.09'},
+    {'dateTo': '2018'},
+    {'dateFrom': '2018.11', 'dateTo': '2018.11'},
+    {'player': 'Carlsen, M', 'eco': 'C', 'minElo': 2830, 'dateFrom': '2018', 'dateTo': '2018'},
+]
+
+
+@pytest.fixture(scope='module')
+def pgn_file(tmp_path_factory):
+    games = []
+    for n, headers in enumerate(HEADERS):
+        game = chess.pgn.Game()
+        game.headers.clear()
+        game.headers['Event'] = str(n + 1)
+        for tag, value in headers.items():
+            game.headers[tag] = value
+        game.add_main_variation(chess.Move.from_uci('e2e4'))
+        games.append(str(game))
+    pgn_file = tmp_path_factory.mktemp('games') / 'games.pgn'
+    pgn_file.write_text('\n\n'.join(games) + '\n')
+    return pgn_file
+
+
+@pytest.mark.parametrize('options', FILTERS)
+def test_header_index_selects_the_games_of_the_filter(pgn_file, tmp_path, options):
+    gameFilter = main.GameFilter(**options)
+    with open(str(pgn_file)) as ifo:
+        matched = []
+        while True:
+            headers = chess.pgn.read_headers(ifo)
+            if headers is None:
+                break
+            if gameFilter.matches(headers):
+                matched.append(int(headers['Event']))
+
+    index = main.HeaderIndex(str(tmp_path / 'games.index'), str(pgn_file))
+    try:
+        assert len(index) == len(HEADERS)
+        assert [number for number, _ in index.find(gameFilter)] == matched
+    finally:
+        index.close()
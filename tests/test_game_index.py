@@ -0,0 +1,28 @@
+import json
+import os
+import concurrent.futures
+
+import main
+
+
+def test_annotated_games_read_in_parallel(tmp_path):
+    output_fn = str(tmp_path / 'out.pgn')
+    texts = ['1. e4 {game %d} %s *\n\n' % (n, 'x' * (n * 37 % 500)) for n in range(200)]
+    games = {}
+    with open(output_fn, 'wb') as f:
+        for n, text in enumerate(texts):
+            data = text.encode('utf-8')
+            games['key%d' % n] = [f.tell(), len(data)]
+            f.write(data)
+    st = os.stat(output_fn)
+    index_fn = str(tmp_path / 'out.index')
+    with open(index_fn, 'w') as f:
+        json.dump({'output_size': st.st_size, 'output_mtime': st.st_mtime_ns,
+                   'games': games}, f)
+
+    index = main.GameIndex(index_fn, output_fn)
+    keys = ['key%d' % (n % 200) for n in range(4000)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(index.annotated_game, keys))
+    index.close()
+    assert results == [texts[n % 200] for n in range(4000)]
@@ -0,0 +1,63 @@
+import json
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+GAMES = ['[Event "1"]\n\n1. e4 e5 2. Nf3 Nc6 3. Bb5 *\n\n',
+         '[Event "2"]\n\n1. d4 d5 2. c4 e6 3. Nc3 *\n\n',
+         '[Event "3"]\n\n1. c4 e5 2. Nc3 Nf6 *\n\n']
+
+
+def annotate(tmp_path, games, movetime=10):
+    (tmp_path / 'games.pgn').write_text(''.join(games))
+    args = [sys.executable, os.path.join(REPO_DIR, 'main.py'),
+            '--file', str(tmp_path / 'games.pgn'), '--outfile', str(tmp_path / 'out.pgn'),
+            '--engine', '%s %s' % (sys.executable, os.path.join(REPO_DIR, 'fake_engine.py')),
+            '--movetime', str(movetime), '--incremental', '1']
+    out = subprocess.run(args, cwd=str(tmp_path), stdout=subprocess.PIPE,
+                         universal_newlines=True, check=True).stdout
+    return [line for line in out.splitlines() if line.startswith('Games analyzed')][-1]
+
+
+def output_games(tmp_path):
+    """ Returns the annotated games of the output in order """
+    data = (tmp_path / 'out.pgn').read_bytes()
+    with open(str(tmp_path / 'out.index')) as f:
+        offsets = sorted(json.load(f)['games'].values())
+    assert sum(size for _, size in offsets) == len(data)
+    return [data[offset:offset + size] for offset, size in offsets]
+
+
+def test_incremental_run(tmp_path):
+    assert annotate(tmp_path, GAMES) == 'Games analyzed: 3, copied: 0'
+    first = output_games(tmp_path)
+
+    # Unchanged games are copied byte for byte
+    assert annotate(tmp_path, GAMES) == 'Games analyzed: 0, copied: 3'
+    assert output_games(tmp_path) == first
+
+    # A changed game is analyzed again, the others are copied
+    changed = [GAMES[0], GAMES[1].replace('3. Nc3', '3. Nf3'), GAMES[2]]
+    assert annotate(tmp_path, changed) == 'Games analyzed: 1, copied: 2'
+    second = output_games(tmp_path)
+    assert second[0] == first[0] and second[2] == first[2]
+    assert b'3. Nf3' in second[1] and b'3. Nc3' not in second[1]
+
+    # Changed settings analyze all games again
+    inode = os.stat(str(tmp_path / 'out.pgn')).st_ino
+    assert annotate(tmp_path, changed, movetime=11) == 'Games analyzed: 3, copied: 0'
+
+    # The output is replaced by the new file, a new inode, not rewritten in place
+    assert os.stat(str(tmp_path / 'out.pgn')).st_ino != inode
+    assert sorted(os.listdir(str(tmp_path))) == ['games.pgn', 'out.index', 'out.pgn']
+
+
+def test_tmp_file_of_a_killed_run_is_not_used(tmp_path):
+    annotate(tmp_path, GAMES)
+    first = output_games(tmp_path)
+    (tmp_path / 'out.pgn.tmp').write_bytes(b'1. e4 {half')
+    assert annotate(tmp_path, GAMES) == 'Games analyzed: 0, copied: 3'
+    assert output_games(tmp_path) == first
+    assert not os.path.exists(str(tmp_path / 'out.pgn.tmp'))
@@ -0,0 +1,76 @@
+import pytest
+
+import main
+
+
+CLOCK_COMMENT_PGN = '''[Event "a"]
+[White "A"]
+[Black "B"]
+
+1. e4 { thinking
+[%clk 0:01:00] } 1... e5 1-0
+
+[Event "b"]
+[White "C"]
+[Black "D"]
+
+1. d4 d5 0-1
+'''
+
+HEADERLESS_PGN = '''1. e4 e5 2. Nf3 *
+
+1. d4 d5 *
+
+1. c4 *
+'''
+
+
+def stream_games(pgn_file, gameFilter=None):
+    with main.open_pgn(str(pgn_file)) as ifo:
+        return [(n, g.moves, dict(g.headers)) for n, g in main.numbered_games(ifo, gameFilter)]
+
+
+def mmap_games(pgn_file, tmp_path, gameFilter=None):
+    index = main.OffsetIndex(str(tmp_path / 'games.offsets'), str(pgn_file))
+    pgn_map = main.MmapPgn(str(pgn_file))
+    try:
+        return [(n, g.moves, dict(g.headers))
+                for n, g in main.mmap_games(pgn_map, index, gameFilter)]
+    finally:
+        pgn_map.close()
+        index.close()
+
+
+@pytest.mark.parametrize('text', [CLOCK_COMMENT_PGN, HEADERLESS_PGN,
+                                  CLOCK_COMMENT_PGN.replace('\n', '\r\n'),
+                                  '\ufeff' + CLOCK_COMMENT_PGN, ''])
+def test_mmap_games_match_stream(tmp_path, text):
+    pgn_file = tmp_path / 'games.pgn'
+    pgn_file.write_text(text, encoding='utf-8', newline='')
+    assert mmap_games(pgn_file, tmp_path) == stream_games(pgn_file)
+
+
+def test_comment_wrapping_onto_header_like_line(tmp_path):
+    pgn_file = tmp_path / 'games.pgn'
+    pgn_file.write_text(CLOCK_COMMENT_PGN)
+    games = mmap_games(pgn_file, tmp_path)
+    assert len(games) == 2
+    assert [m.uci() for m in games[0][1]] == ['e2e4', 'e7e5']
+    assert games[0][2]['Result'] == '1-0'
+    assert games[1][2]['White'] == 'C'
+
+
+def test_headerless_games_are_split(tmp_path):
+    pgn_file = tmp_path / 'games.pgn'
+    pgn_file.write_text(HEADERLESS_PGN)
+    games = mmap_games(pgn_file, tmp_path)
+    assert [len(moves) for n, moves, headers in games] == [3, 2, 1]
+
+
+@pytest.mark.parametrize('gameFilter', [main.GameFilter(player='C'),
+                                        main.GameFilter(player='?'),
+                                        main.GameFilter(player='nobody')])
+def test_mmap_filter_matches_stream(tmp_path, gameFilter):
+    pgn_file = tmp_path / 'games.pgn'
+    pgn_file.write_text(CLOCK_COMMENT_PGN + '\n' + HEADERLESS_PGN)
+    assert mmap_games(pgn_file, tmp_path, gameFilter) == stream_games(pgn_file, gameFilter)
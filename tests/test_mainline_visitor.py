@@ -0,0 +1,69 @@
+import io
+
+import chess.pgn
+
+import main
+
+
+GAMES_PGN = '''[Event "variations"]
+[White "A"]
+[Black "B"]
+[Result "1-0"]
+
+1. e4 $1 {best by test} e5 (1... c5 2. Nf3 (2. c3 d5) d6) 2. Nf3 $2 Nc6
+(2... d6 {Philidor} 3. d4) 3. Bb5 {Spanish} a6 ; line comment
+4. Ba4 1-0
+
+[Event "setup"]
+[SetUp "1"]
+[FEN "4k3/8/8/8/8/8/4P3/4K3 w - - 0 40"]
+
+40. e4 Kd7 (40... Ke7 41. e5) 41. e5 *
+
+[Event "no result header"]
+
+1. d4 d5 0-1
+
+1. c4 {a headerless game} e5 *
+
+[Event "illegal move"]
+[White "C"]
+[Black "D"]
+[Result "*"]
+
+1. e4 e5 2. Ke3 Nc6 3. Nf3 *
+
+[Event "last"]
+
+1. Nf3 Nf6 1/2-1/2
+'''
+
+
+def read_all(text, Visitor):
+    games = []
+    ifo = io.StringIO(text)
+    while True:
+        game = chess.pgn.read_game(ifo, Visitor=Visitor)
+        if game is None:
+            return games
+        games.append(game)
+
+
+def test_same_headers_and_moves_as_read_game(capsys):
+    builder_games = read_all(GAMES_PGN, chess.pgn.GameBuilder)
+    mainline_games = read_all(GAMES_PGN, main.MainlineVisitor)
+    assert len(mainline_games) == len(builder_games) == 6
+    for builder_game, mainline_game in zip(builder_games, mainline_games):
+        assert dict(mainline_game.headers) == dict(builder_game.headers)
+        assert list(mainline_game.mainline_moves()) == list(builder_game.mainline_moves())
+        assert mainline_game.board() == builder_game.board()
+        assert bool(mainline_game.errors) == bool(builder_game.errors)
+    assert [bool(game.errors) for game in mainline_games] == [False]*4 + [True, False]
+    assert 'illegal' in capsys.readouterr().out
+
+
+def test_filtered_game_is_skipped():
+    gameFilter = main.GameFilter(player='C')
+    games = read_all(GAMES_PGN, lambda: main.MainlineVisitor(gameFilter))
+    assert [game.skipped for game in games] == [True]*4 + [False, True]
+    assert all(not game.moves for game in games if game.skipped)
@@ -0,0 +1,46 @@
+import os
+
+import main
+
+
+def test_closed_writer_leaves_whole_games(tmp_path):
+    output_fn = str(tmp_path / 'out.pgn')
+    with main.PgnWriter(output_fn) as writer:
+        assert writer.write_game('1. e4 *\n\n') == 0
+        assert writer.write_game('1. d4 *\n\n') == 9
+        assert os.path.isfile(output_fn + '.end')
+    assert not os.path.exists(output_fn + '.end')
+    with open(output_fn, 'rb') as f:
+        assert f.read() == b'1. e4 *\n\n1. d4 *\n\n'
+
+
+def test_half_written_game_of_a_killed_run_is_cut(tmp_path):
+    output_fn = str(tmp_path / 'out.pgn')
+    writer = main.PgnWriter(output_fn)
+    writer.write_game('1. e4 *\n\n')
+    # Killed in the middle of the next game, the writer is never closed
+    writer.fo.write(b'1. d4 {ha')
+    writer.fo.flush()
+
+    with main.PgnWriter(output_fn) as writer:
+        assert writer.size == 9
+        writer.write_game('1. c4 *\n\n')
+    with open(output_fn, 'rb') as f:
+        assert f.read() == b'1. e4 *\n\n1. c4 *\n\n'
+
+
+def test_interrupted_write_is_cut_on_close(tmp_path):
+    output_fn = str(tmp_path / 'out.pgn')
+    with main.PgnWriter(output_fn) as writer:
+        writer.write_game('1. e4 *\n\n')
+        writer.fo.write(b'1. d4 {ha')
+    with open(output_fn, 'rb') as f:
+        assert f.read() == b'1. e4 *\n\n'
+
+
+def test_existing_output_is_kept(tmp_path):
+    output_fn = str(tmp_path / 'out.pgn')
+    with open(output_fn, 'wb') as f:
+        f.write(b'1. e4 *\n\n')
+    with main.PgnWriter(output_fn) as writer:
+        assert writer.size == 9
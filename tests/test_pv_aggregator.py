@@ -0,0 +1,88 @@
+import random
+
+import chess
+
+import main
+
+
+def legacy_summarized_pv(analysis_data, multipvv):
+    """ get_summarized_pv() of analyze_fen() before PvAggregator """
+    final_pv_list = []
+    max_depth = max([item[0] for item in analysis_data] + [0])
+    for i in range(max_depth):
+        record_depth = [item for item in analysis_data if i+1 == item[0]]
+        time_sorted_list = sorted(record_depth, key=lambda item: item[2], reverse=True)
+        for j in range(multipvv):
+            for n in time_sorted_list:
+                if j + 1 == n[1]:
+                    final_pv_list.append(n)
+                    break
+    final_pv_list = sorted(final_pv_list, key=lambda item: item[0], reverse=True)
+
+    if multipvv > 1:
+        while len(final_pv_list) > 1:
+            if final_pv_list[0][0] == final_pv_list[1][0] and\
+                    final_pv_list[0][4].split(' ')[0] != final_pv_list[1][4].split(' ')[0]:
+                break
+            final_pv_list = [n for n in final_pv_list if n[0] != final_pv_list[0][0]]
+    return final_pv_list
+
+
+PVS = ['e2e4 e7e5 g1f3', 'd2d4 d7d5 c2c4', 'g1f3 g8f6 c2c4', 'c2c4 e7e5 b1c3']
+
+
+def random_record(rnd, multipvv):
+    """ Returns the exact lines of a search, depth 1 is complete and the
+        time grows with every line. Deeper depths may miss a multipv line,
+        repeat the first move of pv 1, get a line again or arrive late.
+    """
+    record = []
+    timev = 0
+    max_depth = rnd.randint(1, 20)
+    for depthv in range(1, max_depth + 1):
+        pvs = rnd.sample(PVS, multipvv)
+        for multipvv_num in range(1, multipvv + 1):
+            if depthv > 1 and multipvv_num > 1 and rnd.random() < 0.2:
+                continue
+            pvv = pvs[multipvv_num - 1]
+            if depthv > 1 and multipvv_num > 1 and rnd.random() < 0.1:
+                pvv = pvs[0]
+            for _ in range(rnd.choice([1, 1, 1, 2])):
+                timev += rnd.randint(1, 50)
+                record.append([depthv, multipvv_num, timev, rnd.randint(-300, 300), pvv])
+        if depthv > 2 and rnd.random() < 0.1:
+            timev += 1
+            record.append([depthv - 1, 1, timev, rnd.randint(-300, 300), rnd.choice(PVS)])
+    return record
+
+
+def aggregated(record, multipvv):
+    pvs = main.PvAggregator(multipvv)
+    for line in record:
+        pvs.add(*line)
+    return pvs.summary()
+
+
+def test_summary_matches_the_legacy_summarizer():
+    rnd = random.Random(7)
+    board = chess.Board()
+    for multipvv in (1, 2):
+        for _ in range(500):
+            record = random_record(rnd, multipvv)
+            assert main.analysis_lines(board, aggregated(record, multipvv), multipvv, 5) ==\
+                main.analysis_lines(board, legacy_summarized_pv(record, multipvv), multipvv, 5)
+
+
+def test_summary_of_a_depth_without_two_different_moves():
+    record = [[1, 1, 1, 10, 'e2e4 e7e5'], [1, 2, 1, 5, 'd2d4 d7d5'],
+              [2, 1, 2, 20, 'e2e4 e7e5'], [2, 2, 2, 15, 'e2e4 c7c5'],
+              [3, 1, 3, 30, 'e2e4 e7e5']]
+    assert aggregated(record, 2) == legacy_summarized_pv(record, 2) == record[:2]
+
+
+def test_summary_after_the_deepest_complete_depth_breaks():
+    record = [[1, 1, 1, 10, 'e2e4 e7e5'], [1, 2, 1, 5, 'd2d4 d7d5'],
+              [2, 1, 2, 20, 'e2e4 e7e5'], [2, 2, 2, 15, 'd2d4 d7d5'],
+              [3, 1, 3, 30, 'e2e4 e7e5'],
+              [2, 1, 4, 15, 'd2d4 d7d5']]
+    assert aggregated(record, 2) == legacy_summarized_pv(record, 2) == record[:2]
@@ -0,0 +1,91 @@
+import json
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+GAMES_PGN = '''[Event "1"]
+[White "a"]
+[Black "b"]
+[Result "1-0"]
+
+1. e4 e5 2. Qh5 Nc6 3. Bc4 Nf6 4. Qxf7# 1-0
+
+[Event "2"]
+[White "c"]
+[Black "d"]
+[Result "0-1"]
+
+1. f3 e5 2. g4 Qh4# 0-1
+
+[Event "3"]
+[White "e"]
+[Black "f"]
+[Result "*"]
+
+1. d4 d5 2. c4 e6 3. Nc3 *
+
+'''
+
+
+def annotate(tmp_path, movetime=10):
+    args = [sys.executable, os.path.join(REPO_DIR, 'main.py'),
+            '--file', str(tmp_path / 'games.pgn'), '--outfile', str(tmp_path / 'out.pgn'),
+            '--engine', '%s %s' % (sys.executable, os.path.join(REPO_DIR, 'fake_engine.py')),
+            '--movetime', str(movetime), '--resume', '1']
+    return subprocess.run(args, cwd=str(tmp_path), stdout=subprocess.PIPE,
+                          universal_newlines=True, check=True).stdout
+
+
+def read_journal(tmp_path):
+    with open(str(tmp_path / 'out.journal')) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_resume_truncates_to_the_last_journaled_game(tmp_path):
+    (tmp_path / 'games.pgn').write_text(GAMES_PGN)
+    annotate(tmp_path)
+    output = (tmp_path / 'out.pgn').read_bytes()
+    journal = read_journal(tmp_path)
+    assert [record.get('game') for record in journal[1:-1]] == [1, 2, 3]
+    assert journal[-1] == {'done': True}
+    end1 = journal[1]['end']
+
+    # A crash after game 2 was written but before it was journaled,
+    # with a half-written game and a cut journal line
+    with open(str(tmp_path / 'out.pgn'), 'wb') as f:
+        f.write(output[:journal[2]['end']] + b'1. e4 {half')
+    with open(str(tmp_path / 'out.journal'), 'w') as f:
+        for record in journal[:2]:
+            f.write(json.dumps(record) + '\n')
+        f.write('{"game": 2, "en')
+
+    annotate(tmp_path)
+    resumed = (tmp_path / 'out.pgn').read_bytes()
+    assert resumed[:end1] == output[:end1]
+    assert b'{half' not in resumed
+    assert resumed.count(b'\n1. ') + resumed.startswith(b'1. ') == 3
+    journal = read_journal(tmp_path)
+    assert [record.get('game') for record in journal[1:-1]] == [1, 2, 3]
+    assert journal[-1] == {'done': True}
+    assert journal[-2]['end'] == len(resumed)
+
+
+def test_complete_run_is_done_again_only_if_the_input_or_settings_changed(tmp_path):
+    (tmp_path / 'games.pgn').write_text(GAMES_PGN)
+    annotate(tmp_path)
+    output = (tmp_path / 'out.pgn').read_bytes()
+
+    assert 'is complete' in annotate(tmp_path)
+    assert (tmp_path / 'out.pgn').read_bytes() == output
+
+    assert 'starting a new journal' in annotate(tmp_path, movetime=11)
+    journal = read_journal(tmp_path)
+    assert journal[0]['output'] == len(output)
+    assert [record.get('game') for record in journal[1:-1]] == [1, 2, 3]
+    assert journal[-1] == {'done': True}
+
+    (tmp_path / 'games.pgn').write_text(GAMES_PGN.split('[Event "3"]')[0])
+    assert 'starting a new journal' in annotate(tmp_path, movetime=11)
+    assert [record.get('game') for record in read_journal(tmp_path)[1:-1]] == [1, 2]
@@ -0,0 +1,35 @@
+import chess
+
+import main
+
+
+def test_white_to_move():
+    board = chess.Board()
+    assert main.ucipv_to_sanpv(board, 'e2e4 e7e5 g1f3') == '1.e4 e5 2.Nf3'
+    assert board == chess.Board() and not board.move_stack
+
+
+def test_black_to_move_starts_with_dots():
+    board = chess.Board()
+    board.push_uci('e2e4')
+    assert main.ucipv_to_sanpv(board, 'e7e5 g1f3 b8c6') == '1...e5 2.Nf3 Nc6'
+    assert board.move_stack == [chess.Move.from_uci('e2e4')]
+
+
+def test_move_number_wraps_to_the_next_move():
+    board = chess.Board('4k3/8/8/8/8/8/8/R3K3 b Q - 10 99')
+    assert main.ucipv_to_sanpv(board, 'e8f7 a1a7 f7e6 e1d2') == '99...Kf7 100.Ra7+ Ke6 101.Kd2'
+    assert board.fullmove_number == 99 and board.turn == chess.BLACK
+
+
+def test_illegal_move_cuts_the_pv():
+    board = chess.Board()
+    assert main.ucipv_to_sanpv(board, 'e2e4 e2e4 g1f3') == '1.e4'
+    assert main.ucipv_to_sanpv(board, 'e2e5 e7e5') == ''
+    assert main.ucipv_to_sanpv(board, 'e2e4 xx') == '1.e4'
+    assert board == chess.Board() and not board.move_stack
+
+
+def test_max_plies():
+    board = chess.Board()
+    assert main.ucipv_to_sanpv(board, 'e2e4 e7e5 g1f3 b8c6', 3) == '1.e4 e5 2.Nf3'
@@ -0,0 +1,45 @@
+import os
+import sqlite3
+import sys
+import threading
+
+import chess
+import pytest
+
+import main
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_ENGINE = '%s %s' % (sys.executable, os.path.join(REPO_DIR, 'fake_engine.py'))
+
+
+@pytest.fixture
+def busy_pool():
+    """ The only engine of the pool is busy for 0.5 s """
+    pool = main.get_engine_pool(FAKE_ENGINE, [])
+    main.get_engine_id(FAKE_ENGINE, [])
+    eng = pool.acquire()
+    release = threading.Timer(0.5, pool.release, [eng])
+    release.start()
+    yield pool
+    release.join()
+    main.close_engine_pools()
+
+
+def test_wait_for_an_engine_is_not_search_time(busy_pool):
+    timer = main.SearchTimer(100, 300, 2, adaptive=False)
+    assert main.analyze_fen(FAKE_ENGINE, chess.STARTING_FEN, [], 100, 2, 5, None, timer)
+    assert 0 <= timer.elapsed_ms < 400
+
+
+def test_cache_keeps_the_search_time(busy_pool, tmp_path):
+    cache_fn = str(tmp_path / 'cache.db')
+    main.open_position_cache(cache_fn)
+    try:
+        timer = main.SearchTimer(100, 300, 2, adaptive=False)
+        assert main.analyze_fen(FAKE_ENGINE, chess.STARTING_FEN, [], 100, 2, 5, None, timer)
+    finally:
+        main.close_position_cache()
+    conn = sqlite3.connect(cache_fn)
+    assert conn.execute('SELECT movetime FROM analysis').fetchall() == [(timer.elapsed_ms,)]
+    conn.close()
+    assert timer.elapsed_ms < 400
@@ -0,0 +1,56 @@
+import pytest
+
+import main
+
+
+def shard_games(first_game, last_game, shards):
+    games = []
+    for shard in range(1, shards + 1):
+        first, last = main.shard_range(first_game, last_game, shard, shards)
+        games.extend(range(first, last + 1))
+    return games
+
+
+@pytest.mark.parametrize('first_game', [1, 4])
+def test_shard_ranges_cover_every_game_once(first_game):
+    for count in range(0, 13):
+        last_game = first_game + count - 1
+        for shards in range(1, count + 4):
+            assert shard_games(first_game, last_game, shards) ==\
+                list(range(first_game, last_game + 1))
+
+
+def test_shards_of_more_games_than_the_file_has():
+    # A --game-range past the end is cut to the games of the file
+    assert shard_games(8, 5, 3) == []
+
+
+def test_shards_of_the_offset_index(tmp_path):
+    pgn_file = tmp_path / 'games.pgn'
+    pgn_file.write_text(''.join('[Event "%d"]\n\n1. e4 *\n\n' % n for n in range(1, 6)))
+    index = main.OffsetIndex(str(tmp_path / 'games.offsets'), str(pgn_file))
+    for shards in range(1, 9):
+        events = []
+        for shard in range(1, shards + 1):
+            first, last = main.shard_range(1, len(index), shard, shards)
+            events.extend(game.headers['Event']
+                          for _, game in main.offset_games(str(pgn_file), index, None, first, last))
+        assert events == [str(n) for n in range(1, 6)]
+
+
+def test_merge_shard_outputs_with_empty_shards(tmp_path):
+    output_fn = str(tmp_path / 'out.pgn')
+    texts = [b'game 1\n\n', b'', b'game 2\n\ngame 3\n\n', b'']
+    for shard, text in enumerate(texts, 1):
+        with open(main.shard_output_name(output_fn, shard, len(texts)), 'wb') as f:
+            f.write(text)
+    assert main.merge_shard_outputs(output_fn, len(texts))
+    with open(output_fn, 'rb') as f:
+        assert f.read() == b''.join(texts)
+    assert not main.merge_shard_outputs(output_fn, len(texts) + 1)
+
+
+@pytest.mark.parametrize('text', ['0/2', '3/2', '1/0'])
+def test_parse_shard_rejects_bad_shards(text):
+    with pytest.raises(ValueError):
+        main.parse_shard(text)